@@ -0,0 +1,1683 @@
+"""Офлайн-бенчмарк горячих путей бота: проверка цен, /list и /stats.
+
+Бот запускается против локальной заглушки Dexscreener и фиктивного Telegram-бота
+на синтетической нагрузке. Пример:
+
+    python bench.py --chats 500 --tokens-per-chat 50 --universe 3000 --skew 1.2
+
+Скрипт печатает время прохода проверки, число запросов к API, объём записи в
+SQLite, число отправленных сообщений и пиковый RSS. Если самый долгий проход
+дольше --budget секунд, скрипт завершается с кодом 1.
+
+Перед вызовами /list и /stats кэш цен очищается, а заглушка начинает отвечать
+через --handler-latency секунд. Первый ответ обработчика должен прийти раньше
+ответа API, а недостающие цены — дописаться правками; иначе код выхода тоже 1.
+
+С флагом --batching та же нагрузка проверяется --sweeps проходами дважды: с запросом к API на
+каждый адрес, как до пакетных запросов, и пачками по MAX_ADDRESSES_PER_REQUEST адресов.
+Печатается число запросов к API и во сколько раз пачки его уменьшают:
+
+    python bench.py --batching --chats 200 --tokens-per-chat 20 --universe 1000
+
+С флагом --fanout одна и та же раскладка подписок по Ципфу проверяется тремя способами: обходом
+чатов с запросом цены на каждую пару (чат, токен) без кэша и с кэшем, как до индекса подписчиков,
+и одним проходом по уникальным токенам индекса. Печатаются число обращений к кэшу, доля
+попаданий в него и число адресов и запросов, ушедших в API:
+
+    python bench.py --fanout --chats 200 --tokens-per-chat 20 --skew 1.1
+
+С флагом --transport вместо этого сравниваются long polling и вебхук: заглушка
+Bot API отдаёт синтетические команды /start через getUpdates или POST на вебхук,
+и для каждого режима печатаются перцентили времени от отправки команды до ответа:
+
+    python bench.py --transport --updates 2000 --rate 200
+
+С флагом --hedging сравниваются запросы цен к одному источнику и к двум со страховочными
+запросами: обе заглушки отвечают с задержкой --latency, но доля --slow-fraction ответов
+задерживается до --slow-latency. Печатаются перцентили задержки и число запросов к API:
+
+    python bench.py --hedging --lookups 1000 --slow-fraction 0.05 --slow-latency 2
+
+С флагом --cold-start в базу записываются --chats чатов по --tokens-per-chat токенов, и в отдельных
+процессах замеряются время загрузки состояния при старте, прирост пикового RSS и время первого
+обращения к чату — с полной загрузкой чатов и с ленивой (LAZY_CHAT_LOADING):
+
+    python bench.py --cold-start --chats 100000 --tokens-per-chat 5
+
+С флагом --streaming бот подключается к локальной заглушке потокового источника цен (WebSocket),
+которая --ticks раз с интервалом --tick-interval сдвигает цену случайного токена выше любого порога.
+Печатаются перцентили времени от отправки цены заглушкой до отправки оповещения подписчику
+и время, за которое новый токен попадает в подписку потока:
+
+    python bench.py --streaming --ticks 500 --tick-interval 0.01
+
+С флагом --pooling заглушка Dexscreener работает по HTTPS с самоподписанным сертификатом
+(нужна утилита openssl). Печатаются перцентили задержки запроса цен и число открытых
+TCP/TLS-соединений: с новым клиентом на каждый запрос, как до общего пула, и с общим пулом бота:
+
+    python bench.py --pooling --lookups 1000 --concurrency 5
+
+Режимы-проверки печатают поле ok и завершают скрипт с кодом 1, если оно ложно.
+С флагом --coalescing --callers задач одновременно запрашивают цену одного ещё не
+закэшированного адреса; к API должен уйти ровно один запрос, в том числе когда
+половина ожидающих отменяется до ответа:
+
+    python bench.py --coalescing --callers 100
+
+С флагом --conversations --flows пользователей в общих групповых чатах проходят диалог /add
+(адрес, название, процент), и шаги разных диалогов перемешаны. После первых двух шагов
+бот перезапускается, а состояние диалогов читается из базы. Каждый токен должен попасть
+в свой чат со своими названием и процентом, а незавершённых диалогов не должно остаться:
+
+    python bench.py --conversations --flows 1000
+
+С флагом --persistence для каждого размера таблицы из --rows (через запятую) на каждое из --alerts
+оповещений сохраняется новая цена подписки: полной перезаписью таблицы, как до записи только
+изменённых строк (не больше 20 оповещений — перезапись большой таблицы долгая), отдельной
+транзакцией очереди записи на каждое оповещение и одной транзакцией на все. Стоимость
+оповещения в очереди записи не должна расти вместе с таблицей:
+
+    python bench.py --persistence --rows 1000,100000 --alerts 200
+
+С флагом --vectorized на --subscriptions подписках к --universe токенам проверка порогов
+одним векторным проходом SubscriptionStore сравнивается с прежним циклом по словарям
+подписчиков; результаты обоих способов должны совпасть:
+
+    python bench.py --vectorized --subscriptions 1000000 --universe 20000
+
+С флагом --sending --alerts оповещений для --chats чатов и уведомления о сбоях уходят через
+MessageDispatcher в фиктивный бот, который один раз отвечает RetryAfter. Печатается время
+постановки в очередь и проверяется, что выдержаны общий лимит и лимит на чат, оповещения
+ушли раньше уведомлений и ни одно сообщение не потерялось:
+
+    python bench.py --sending --chats 200 --alerts 200
+
+С флагом --busy-chat заглушка Dexscreener отвечает через --slow-latency секунд. Чат отправляет /list,
+а через 0.3 с — /start. Ответ на /start не должен ждать, пока /list дописывается по ответам API:
+
+    python bench.py --busy-chat --slow-latency 2
+
+С флагом --import чат отправляет /import с --tokens-per-chat адресами (не больше MAX_TOKENS_PER_USER).
+Все адреса должны проверяться пакетными запросами: к API уходит по запросу на каждые
+MAX_ADDRESSES_PER_REQUEST адресов, и все токены попадают в базу:
+
+    python bench.py --import --tokens-per-chat 50
+
+С флагом --checkers для каждого N из списка (например, 1,2,4) над одной базой запускаются N процессов
+проверяльщика (как python bot.py checker) против заглушки Dexscreener. Все подписки из --chats чатов
+по --tokens-per-chat токенов срабатывают при первой проверке. Печатается, сколько токенов в секунду
+проверяют N процессов вместе, ускорение относительно одного процесса и число повторных оповещений
+в alert_outbox; ускорение должно расти линейно, а повторов быть не должно:
+
+    python bench.py --checkers 1,2,4 --chats 2000 --universe 6000 --latency 0.5
+
+С флагом --replay записанные ряды цен прогоняются через проверку порогов дважды: с опросом
+всех токенов раз в DEFAULT_POLL_INTERVAL, как до адаптивного планировщика, и с PollScheduler.
+Ряды читаются из таблицы price_history базы бота (--replay-db) или генерируются: --series
+токенов со случайным блужданием разной волатильности за --hours часов с шагом --sample-interval.
+Задержка оповещения считается от момента, когда цена вышла за порог, и печатается в интервалах
+DEFAULT_POLL_INTERVAL, чтобы не зависеть от длины рядов. Выход за порог, который закончился
+раньше, чем его увидела проверка, считается пропущенным. Адаптивный опрос должен делать
+меньше запросов без роста p95 задержки и доли пропущенных выходов:
+
+    python bench.py --replay --series 200 --hours 6
+    python bench.py --replay --replay-db tokens.db
+"""
+import argparse
+import asyncio
+import bisect
+import http.client
+import itertools
+import json
+import math
+import os
+import random
+import resource
+import socket
+import sqlite3
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+
+import httpx
+import numpy as np
+import websockets
+from telegram.error import RetryAfter
+
+import bot
+
+
+class DexscreenerStub:
+    """Локальная заглушка эндпоинта /tokens: цена каждого токена — случайное блуждание.
+    
+    Доля slow_fraction ответов задерживается на slow_latency вместо latency.
+    С tls_context заглушка отвечает по HTTPS. connections — число принятых соединений.
+    """
+    
+    def __init__(self, volatility, latency, seed, slow_fraction=0, slow_latency=0, tls_context=None):
+        self.volatility = volatility
+        self.latency = latency
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.prices = {}
+        # Когда каждый адрес был запрошен впервые
+        self.first_seen = {}
+        self.requests = 0
+        # Сколько адресов запрошено всего, с повторами
+        self.addresses = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.scheme = "http"
+        if tls_context is not None:
+            # Рукопожатие делается в потоке соединения, а не в потоке, принимающем соединения
+            self.server.socket = tls_context.wrap_socket(self.server.socket, server_side=True,
+                                                         do_handshake_on_connect=False)
+            self.scheme = "https"
+    
+    @property
+    def base_url(self):
+        return f"{self.scheme}://127.0.0.1:{self.server.server_address[1]}"
+    
+    @property
+    def url(self):
+        return f"{self.base_url}/latest/dex/tokens/"
+    
+    def next_price(self, token_address):
+        with self.lock:
+            self.first_seen.setdefault(token_address, time.monotonic())
+            price = self.prices.get(token_address, 1.0)
+            price *= math.exp(self.random.gauss(0, self.volatility / 100))
+            self.prices[token_address] = price
+        return price
+    
+    def body(self, addresses):
+        pairs = []
+        for address in addresses:
+            price = self.next_price(address)
+            pairs.append({
+                "baseToken": {"address": address},
+                "priceUsd": f"{price:.10f}",
+                "fdv": price * 1e9,
+                "priceChange": {"h24": round(self.random.uniform(-20, 20), 2)},
+                "liquidity": {"usd": 100000},
+            })
+        return {"pairs": pairs}
+    
+    def delay(self):
+        with self.lock:
+            self.requests += 1
+            slow = self.random.random() < self.slow_fraction
+        return self.slow_latency if slow else self.latency
+    
+    def handler(self):
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            
+            def log_message(self, *args):
+                pass
+            
+            def setup(self):
+                with stub.lock:
+                    stub.connections += 1
+                if isinstance(self.request, ssl.SSLSocket):
+                    self.request.do_handshake()
+                super().setup()
+            
+            def do_GET(self):
+                delay = stub.delay()
+                if delay:
+                    time.sleep(delay)
+                addresses = self.path.split("?", 1)[0].rsplit("/", 1)[-1].split(",")
+                with stub.lock:
+                    stub.addresses += len(addresses)
+                body = json.dumps(stub.body(addresses)).encode()
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Бот отменил запрос, потому что раньше ответил другой источник
+                    pass
+        
+        return Handler
+    
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def stop(self):
+        self.server.shutdown()
+
+
+class GeckoTerminalStub(DexscreenerStub):
+    """Заглушка эндпоинта GeckoTerminal /tokens/multi с пулами в included."""
+    
+    @property
+    def url(self):
+        return f"{self.base_url}/api/v2/networks/solana/tokens/multi/"
+    
+    def body(self, addresses):
+        tokens = []
+        pools = []
+        for address in addresses:
+            price = self.next_price(address)
+            pool_id = f"solana_pool_{address}"
+            tokens.append({
+                "id": f"solana_{address}",
+                "type": "token",
+                "attributes": {"address": address, "price_usd": f"{price:.10f}", "fdv_usd": f"{price * 1e9}"},
+                "relationships": {"top_pools": {"data": [{"id": pool_id, "type": "pool"}]}},
+            })
+            pools.append({
+                "id": pool_id,
+                "type": "pool",
+                "attributes": {"reserve_in_usd": "100000",
+                               "price_change_percentage": {"h24": f"{self.random.uniform(-20, 20):.2f}"}},
+            })
+        return {"data": tokens, "included": pools}
+
+
+class TelegramStub:
+    """Локальная заглушка Bot API: отдаёт обновления через getUpdates и запоминает время ответов бота."""
+    
+    def __init__(self):
+        self.updates = []
+        self.condition = threading.Condition()
+        self.replies = {}
+        # (время, чат) каждого sendMessage и время каждого editMessageText
+        self.messages = []
+        self.edits = []
+        self.message_ids = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+    
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+    
+    def push(self, update):
+        with self.condition:
+            self.updates.append(update)
+            self.condition.notify_all()
+    
+    def get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                pending = [update for update in self.updates if update["update_id"] >= offset]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    # Подтверждённые через offset обновления больше не нужны
+                    self.updates = pending
+                    return pending
+                self.condition.wait(remaining)
+    
+    def call(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            return self.get_updates(int(params.get("offset") or 0), min(float(params.get("timeout") or 0), 1))
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            self.replies.setdefault(chat_id, time.monotonic())
+            with self.condition:
+                self.messages.append((time.monotonic(), chat_id))
+                self.message_ids += 1
+                message_id = self.message_ids
+            return {"message_id": message_id, "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        if method == "editMessageText":
+            with self.condition:
+                self.edits.append(time.monotonic())
+        return True
+    
+    def handler(self):
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            
+            def log_message(self, *args):
+                pass
+            
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = dict(parse_qsl(body))
+                method = self.path.rsplit("/", 1)[-1]
+                payload = json.dumps({"ok": True, "result": stub.call(method, params)}).encode()
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # При остановке бот закрывает соединение, не дождавшись ответа на getUpdates
+                    pass
+        
+        return Handler
+    
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def stop(self):
+        self.server.shutdown()
+
+
+class FakeBot:
+    """Фиктивный Telegram-бот: только запоминает отправленные сообщения."""
+    
+    def __init__(self):
+        self.sent = []
+        self.edits = 0
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((time.monotonic(), chat_id, len(text)))
+
+
+class FloodBot(FakeBot):
+    """Фиктивный бот, который на flood_at-й отправке один раз отвечает RetryAfter."""
+    
+    def __init__(self, flood_at, retry_after):
+        super().__init__()
+        self.flood_at = flood_at
+        self.retry_after = retry_after
+        self.attempts = 0
+    
+    async def send_message(self, chat_id, text, **kwargs):
+        self.attempts += 1
+        if self.attempts == self.flood_at:
+            raise RetryAfter(self.retry_after)
+        await super().send_message(chat_id, text, **kwargs)
+
+
+class FakeApplication:
+    """Фиктивное Application: бот и задачи, которые обработчики запускают через create_task."""
+    
+    def __init__(self, fake_bot):
+        self.bot = fake_bot
+        self.tasks = []
+    
+    def create_task(self, coroutine, update=None, *, name=None):
+        task = asyncio.create_task(coroutine, name=name)
+        self.tasks.append(task)
+        return task
+
+
+class FakeMessage:
+    def __init__(self, fake_bot, chat_id):
+        self.bot = fake_bot
+        self.chat_id = chat_id
+        self.message_id = len(fake_bot.sent)
+        self.replied_at = None
+    
+    async def reply_text(self, text, **kwargs):
+        await self.bot.send_message(self.chat_id, text, **kwargs)
+        self.replied_at = time.perf_counter()
+        return FakeMessage(self.bot, self.chat_id)
+    
+    async def edit_text(self, text, **kwargs):
+        self.bot.edits += 1
+
+
+class PriceStreamStub:
+    """Локальная заглушка потокового источника цен: принимает подписки и рассылает цены по WebSocket."""
+    
+    def __init__(self):
+        self.subscribed = set()
+        self.connections = set()
+        self.control_messages = 0
+        self.server = None
+    
+    @property
+    def url(self):
+        return f"ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}"
+    
+    async def handler(self, connection):
+        self.connections.add(connection)
+        try:
+            async for message in connection:
+                request = json.loads(message)
+                self.control_messages += 1
+                if request["op"] == "subscribe":
+                    self.subscribed.update(request["tokens"])
+                else:
+                    self.subscribed.difference_update(request["tokens"])
+        finally:
+            self.connections.discard(connection)
+    
+    async def start(self):
+        self.server = await websockets.serve(self.handler, "127.0.0.1", 0)
+    
+    async def publish(self, prices):
+        message = json.dumps({"prices": prices})
+        for connection in list(self.connections):
+            await connection.send(message)
+    
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+def fake_update(fake_bot, chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), message=FakeMessage(fake_bot, chat_id))
+
+
+def zipf_weights(count, skew):
+    return [1 / (rank + 1) ** skew for rank in range(count)]
+
+
+def build_workload(args, rng):
+    """Раскладывает подписки по чатам: популярность токенов распределена по закону Ципфа."""
+    universe = [f"Tok{index:06d}" for index in range(args.universe)]
+    weights = zipf_weights(args.universe, args.skew)
+    tokens_per_chat = min(args.tokens_per_chat, bot.MAX_TOKENS_PER_USER, args.universe)
+    for chat_id in range(1, args.chats + 1):
+        chosen = set()
+        while len(chosen) < tokens_per_chat:
+            chosen.update(rng.choices(universe, weights, k=tokens_per_chat - len(chosen)))
+        for token_address in chosen:
+            bot.set_tracked_token(chat_id, token_address, {
+                "last_price": 1.0,
+                "percent": rng.choice([1, 5, 10, 25, 50]),
+                "last_market_cap": 1e9,
+                "name": token_address[:6],
+            })
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    stub = DexscreenerStub(args.volatility, args.latency, args.seed)
+    stub.start()
+    bot.DEXSCREENER_TOKENS_URL = stub.url
+    bot.price_sources = [bot.DexscreenerSource()]
+    
+    fake_bot = FakeBot()
+    application = FakeApplication(fake_bot)
+    await bot.post_init(application)
+    # Лимиты Telegram в бенчмарке не нужны: меряем саму проверку, а не ожидание отправки
+    bot.dispatcher.global_bucket = bot.TokenBucket(1e9, 1e9)
+    bot.dispatcher.chat_rate = 1e9
+    
+    bot.subscriptions = bot.SubscriptionStore()
+    bot.scheduler = bot.PollScheduler()
+    build_workload(args, rng)
+    subscription_count = len(bot.subscriptions)
+    context = SimpleNamespace(bot=fake_bot, args=[], application=application)
+    
+    sweep_times = []
+    for _ in range(args.sweeps):
+        # Каждый проход проверяет все токены — худший случай для бюджета задачи
+        now = time.time()
+        for token_address in bot.token_subscribers:
+            bot.scheduler.schedule(token_address, now)
+        # Кэш старше минимального интервала всё равно не используется; сдвигаем время, как будто прошёл тик
+        for entry in bot.cache.entries.values():
+            entry["timestamp"] -= bot.MIN_POLL_INTERVAL
+        started = time.perf_counter()
+        await bot.check_prices(context)
+        sweep_times.append(time.perf_counter() - started)
+    sweep_requests = stub.requests
+    
+    # Обработчики должны ответить сразу, не дожидаясь API: очищаем оба уровня кэша
+    # и замедляем заглушку, чтобы недостающие цены дописывались правками
+    bot.state_writer.stop()
+    with bot.get_db() as conn:
+        conn.execute("DELETE FROM token_cache")
+    bot.state_writer.start()
+    bot.cache.entries.clear()
+    stub.latency = args.handler_latency
+    
+    handler_chats = rng.sample(range(1, args.chats + 1), min(args.handler_calls, args.chats))
+    handler_times = {"list": [], "stats": []}
+    first_response_times = []
+    for name, handler in (("list", bot.list_tokens), ("stats", bot.stats)):
+        for chat_id in handler_chats:
+            update = fake_update(fake_bot, chat_id)
+            started = time.perf_counter()
+            await handler(update, context)
+            handler_times[name].append(time.perf_counter() - started)
+            first_response_times.append(update.message.replied_at - started)
+    # Правки идут фоновыми задачами обработчиков
+    await asyncio.gather(*application.tasks)
+    
+    await bot.post_stop(application)
+    await bot.post_shutdown(application)
+    bot.state_writer.stop()
+    stub.stop()
+    
+    report = {
+        "chats": args.chats,
+        "subscriptions": subscription_count,
+        "unique_tokens": len(bot.token_subscribers),
+        "sweep_mean_s": statistics.mean(sweep_times),
+        "sweep_max_s": max(sweep_times),
+        "sweep_requests": sweep_requests,
+        "handler_requests": stub.requests - sweep_requests,
+        "list_mean_ms": statistics.mean(handler_times["list"]) * 1000 if handler_times["list"] else 0,
+        "stats_mean_ms": statistics.mean(handler_times["stats"]) * 1000 if handler_times["stats"] else 0,
+        "first_response_max_ms": max(first_response_times) * 1000 if first_response_times else 0,
+        "message_edits": fake_bot.edits,
+        "handlers_ok": (max(first_response_times, default=0) < args.handler_latency
+                        and stub.requests > sweep_requests and fake_bot.edits > 0),
+        "sqlite_flushes": bot.state_writer.flushes,
+        "sqlite_rows_written": bot.state_writer.rows_written,
+        "messages_sent": len(fake_bot.sent),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    return report
+
+
+async def run_batching(args):
+    """Сравнивает число запросов к API за проходы проверки: по одному адресу на запрос и пачками."""
+    stub = DexscreenerStub(args.volatility, args.latency, args.seed)
+    stub.start()
+    bot.DEXSCREENER_TOKENS_URL = stub.url
+    bot.price_sources = [bot.DexscreenerSource()]
+    
+    fake_bot = FakeBot()
+    application = FakeApplication(fake_bot)
+    await bot.post_init(application)
+    bot.dispatcher.global_bucket = bot.TokenBucket(1e9, 1e9)
+    bot.dispatcher.chat_rate = 1e9
+    bot.subscriptions = bot.SubscriptionStore()
+    bot.scheduler = bot.PollScheduler()
+    build_workload(args, random.Random(args.seed))
+    context = SimpleNamespace(bot=fake_bot, args=[], application=application)
+    
+    batch_size = bot.MAX_ADDRESSES_PER_REQUEST
+    report = {}
+    for mode, size in (("per_token", 1), ("batched", batch_size)):
+        bot.MAX_ADDRESSES_PER_REQUEST = size
+        requests_before = stub.requests
+        sweep_times = []
+        for _ in range(args.sweeps):
+            # Как в основном режиме: каждый проход проверяет все токены, кэш уже не годится
+            now = time.time()
+            for token_address in bot.token_subscribers:
+                bot.scheduler.schedule(token_address, now)
+            for entry in bot.cache.entries.values():
+                entry["timestamp"] -= bot.MIN_POLL_INTERVAL
+            started = time.perf_counter()
+            await bot.check_prices(context)
+            sweep_times.append(time.perf_counter() - started)
+        report[mode] = {"tokens": len(bot.token_subscribers), "sweeps": args.sweeps,
+                        "upstream_requests": stub.requests - requests_before,
+                        "sweep_mean_s": statistics.mean(sweep_times)}
+    bot.MAX_ADDRESSES_PER_REQUEST = batch_size
+    
+    await bot.post_stop(application)
+    await bot.post_shutdown(application)
+    stub.stop()
+    ratio = report["per_token"]["upstream_requests"] / max(report["batched"]["upstream_requests"], 1)
+    report["batched"]["reduction"] = ratio
+    # Сокращение близко к размеру пачки, если токенов заметно больше одной пачки
+    report["batched"]["ok"] = ratio >= 0.8 * min(batch_size, report["batched"]["tokens"])
+    return report
+
+
+async def run_fanout(args):
+    """Сравнивает обход подписок по чатам без кэша и с кэшем с проходом по индексу уникальных токенов."""
+    # Задержка не нужна: считаются обращения и запросы, а не время
+    stub = DexscreenerStub(args.volatility, 0, args.seed)
+    stub.start()
+    bot.DEXSCREENER_TOKENS_URL = stub.url
+    bot.price_sources = [bot.DexscreenerSource()]
+    
+    fake_bot = FakeBot()
+    application = FakeApplication(fake_bot)
+    await bot.post_init(application)
+    bot.dispatcher.global_bucket = bot.TokenBucket(1e9, 1e9)
+    bot.dispatcher.chat_rate = 1e9
+    bot.subscriptions = bot.SubscriptionStore()
+    bot.scheduler = bot.PollScheduler()
+    build_workload(args, random.Random(args.seed))
+    context = SimpleNamespace(bot=fake_bot, args=[], application=application)
+    chats = {chat_id: list(tokens) for chat_id, tokens in bot.tracked_tokens.chats.items()}
+    
+    report = {}
+    # Кэш с нулевым временем жизни промахивается на каждом обращении
+    for mode, ttl in (("chat_walk_no_cache", 0), ("chat_walk_cache", bot.CACHE_TIMEOUT),
+                      ("token_index", bot.CACHE_TIMEOUT)):
+        bot.state_writer.stop()
+        with bot.get_db() as conn:
+            conn.execute("DELETE FROM token_cache")
+        bot.state_writer.start()
+        bot.cache = bot.TokenCache(bot.CACHE_MAX_SIZE, ttl)
+        requests_before, addresses_before = stub.requests, stub.addresses
+        if mode == "token_index":
+            now = time.time()
+            for token_address in bot.token_subscribers:
+                bot.scheduler.schedule(token_address, now)
+            await bot.check_prices(context)
+        else:
+            # Как до индекса: чат за чатом, цена каждого токена запрашивается отдельно
+            for tokens in chats.values():
+                for token_address in tokens:
+                    await bot.async_get_token_price(token_address)
+        stats = bot.cache.stats()
+        hits = stats["hits"] + stats["db_hits"]
+        lookups = hits + stats["misses"]
+        report[mode] = {
+            "subscriptions": len(bot.subscriptions),
+            "tokens": len(bot.token_subscribers),
+            "cache_lookups": lookups,
+            "cache_hit_pct": hits / lookups * 100 if lookups else 0.0,
+            "upstream_addresses": stub.addresses - addresses_before,
+            "upstream_requests": stub.requests - requests_before,
+        }
+    
+    await bot.post_stop(application)
+    await bot.post_shutdown(application)
+    stub.stop()
+    # Проход по индексу запрашивает каждый уникальный токен ровно один раз
+    indexed = report["token_index"]
+    indexed["ok"] = indexed["upstream_addresses"] == indexed["tokens"] == indexed["cache_lookups"]
+    return report
+
+
+def message_update(update_id, chat_id, user_id, text, chat_type="private"):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": chat_type},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def command_update(update_id, chat_id):
+    return message_update(update_id, chat_id, chat_id, "/start")
+
+
+def send_updates(args, deliver):
+    """Отдаёт args.updates команд с темпом args.rate в секунду; у каждой команды свой чат."""
+    sent = {}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for index in range(args.updates):
+            delay = started + index / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            chat_id = index + 1
+            sent[chat_id] = time.monotonic()
+            executor.submit(deliver, command_update(index + 1, chat_id))
+    return sent
+
+
+def percentiles(latencies):
+    cuts = statistics.quantiles(latencies, n=100)
+    return {"p50_ms": cuts[49] * 1000, "p95_ms": cuts[94] * 1000, "p99_ms": cuts[98] * 1000, "max_ms": max(latencies) * 1000}
+
+
+async def run_transport(args, mode):
+    """Прогоняет синтетические команды через настоящий Application в режиме polling или webhook."""
+    telegram = TelegramStub()
+    telegram.start()
+    bot.tracked_tokens = bot.ChatTokenStore()
+    bot.token_subscribers = {}
+    bot.subscriptions = bot.SubscriptionStore()
+    bot.scheduler = bot.PollScheduler()
+    application = bot.build_application(bot.Application.builder().token("1:bench").base_url(telegram.url))
+    
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    local = threading.local()
+    if mode == "polling":
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        deliver = telegram.push
+    else:
+        secret = "bench-secret"
+        # Свободный порт для вебхука выбирает система
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        await application.updater.start_webhook(listen="127.0.0.1", port=port, url_path=bot.WEBHOOK_PATH,
+                                                webhook_url=f"http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}",
+                                                secret_token=secret)
+        
+        def deliver(update):
+            # Соединение с keep-alive на каждый поток, как у серверов Telegram
+            if not hasattr(local, "connection"):
+                local.connection = http.client.HTTPConnection("127.0.0.1", port)
+            body = json.dumps(update)
+            local.connection.request("POST", f"/{bot.WEBHOOK_PATH}", body, {
+                "Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret})
+            local.connection.getresponse().read()
+    
+    sent = await asyncio.to_thread(send_updates, args, deliver)
+    deadline = time.monotonic() + 30
+    while len(telegram.replies) < len(sent) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    
+    await application.updater.stop()
+    await application.stop()
+    await bot.post_stop(application)
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    telegram.stop()
+    
+    latencies = [telegram.replies[chat_id] - started for chat_id, started in sent.items() if chat_id in telegram.replies]
+    report = {"updates": len(sent), "answered": len(latencies)}
+    if len(latencies) > 1:
+        report.update(percentiles(latencies))
+    return report
+
+
+async def run_hedging(args):
+    """Замеряет задержку пакетных запросов цен к одному источнику и к двум со страховкой."""
+    rng = random.Random(args.seed)
+    dexscreener = DexscreenerStub(args.volatility, args.latency, args.seed, args.slow_fraction, args.slow_latency)
+    geckoterminal = GeckoTerminalStub(args.volatility, args.latency, args.seed + 1, args.slow_fraction, args.slow_latency)
+    dexscreener.start()
+    geckoterminal.start()
+    bot.DEXSCREENER_TOKENS_URL = dexscreener.url
+    bot.GECKOTERMINAL_TOKENS_URL = geckoterminal.url
+    application = SimpleNamespace(bot=FakeBot())
+    await bot.post_init(application)
+    universe = [f"Tok{index:06d}" for index in range(args.universe)]
+    
+    report = {}
+    for mode, sources in (("single", [bot.DexscreenerSource()]),
+                          ("hedged", [bot.DexscreenerSource(), bot.GeckoTerminalSource()])):
+        bot.price_sources = sources
+        requests_before = dexscreener.requests + geckoterminal.requests
+        latencies = []
+        
+        async def lookup():
+            chunk = rng.sample(universe, min(bot.MAX_ADDRESSES_PER_REQUEST, len(universe)))
+            started = time.perf_counter()
+            await bot.fetch_chunk(chunk)
+            latencies.append(time.perf_counter() - started)
+        
+        # Запросы идут волнами по --concurrency штук, как пачки одного прохода проверки
+        for _ in range(0, args.lookups, args.concurrency):
+            await asyncio.gather(*(lookup() for _ in range(args.concurrency)))
+        report[mode] = {
+            "lookups": len(latencies),
+            "upstream_requests": dexscreener.requests + geckoterminal.requests - requests_before,
+            **percentiles(latencies),
+        }
+    
+    await bot.post_stop(application)
+    await bot.post_shutdown(application)
+    dexscreener.stop()
+    geckoterminal.stop()
+    return report
+
+
+def self_signed_certificate(directory):
+    """Создаёт через openssl самоподписанный сертификат для 127.0.0.1; возвращает пути к сертификату и ключу."""
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", keyfile, "-out", certfile,
+                    "-days", "1", "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1"],
+                   check=True, capture_output=True)
+    return certfile, keyfile
+
+
+async def run_pooling(args):
+    """Замеряет задержку запросов цен к HTTPS-заглушке и число соединений без общего пула и с ним."""
+    rng = random.Random(args.seed)
+    certfile, keyfile = self_signed_certificate(os.path.dirname(bot.DB_PATH))
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    # httpx доверяет сертификатам из SSL_CERT_FILE, так что клиент бота создаётся как обычно
+    os.environ["SSL_CERT_FILE"] = certfile
+    stub = DexscreenerStub(args.volatility, args.latency, args.seed, tls_context=context)
+    stub.start()
+    bot.DEXSCREENER_TOKENS_URL = stub.url
+    bot.open_http_client()
+    source = bot.DexscreenerSource()
+    universe = [f"Tok{index:06d}" for index in range(args.universe)]
+    
+    async def per_call(url):
+        # Так запросы шли до общего клиента: отдельная сессия и новое соединение на каждый запрос
+        async with httpx.AsyncClient(timeout=bot.REQUEST_DEADLINE) as client:
+            return await client.get(url)
+    
+    async def pooled(url):
+        return await bot.request_with_retry(url, source.name)
+    
+    report = {}
+    for mode, get in (("per_call", per_call), ("pooled", pooled)):
+        connections_before = stub.connections
+        latencies = []
+        
+        async def lookup():
+            chunk = rng.sample(universe, min(bot.MAX_ADDRESSES_PER_REQUEST, len(universe)))
+            started = time.perf_counter()
+            response = await get(source.url(chunk))
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - started)
+        
+        for _ in range(0, args.lookups, args.concurrency):
+            await asyncio.gather(*(lookup() for _ in range(args.concurrency)))
+        report[mode] = {
+            "lookups": len(latencies),
+            "connections": stub.connections - connections_before,
+            **percentiles(latencies),
+        }
+    
+    await bot.http_client.aclose()
+    stub.stop()
+    return report
+
+
+async def run_coalescing(args):
+    """Проверяет single-flight: одновременные запросы цены одного адреса дают один запрос к API."""
+    stub = DexscreenerStub(args.volatility, args.latency, args.seed)
+    stub.start()
+    bot.DEXSCREENER_TOKENS_URL = stub.url
+    bot.price_sources = [bot.DexscreenerSource()]
+    bot.open_http_client()
+    
+    report = {}
+    for mode, cancelled in (("concurrent", 0), ("half_cancelled", args.callers // 2)):
+        # Для каждого режима свой адрес, чтобы он точно не оказался в кэше
+        token_address = f"Coalesce{mode}"
+        requests_before = stub.requests
+        tasks = [asyncio.create_task(bot.async_get_token_price(token_address)) for _ in range(args.callers)]
+        # Даём всем задачам дойти до ожидания общего запроса, затем отменяем часть из них
+        await asyncio.sleep(0)
+        for task in tasks[:cancelled]:
+            task.cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        answered = sum(isinstance(result, dict) and "error" not in result for result in results[cancelled:])
+        upstream_requests = stub.requests - requests_before
+        report[mode] = {
+            "callers": args.callers,
+            "cancelled": cancelled,
+            "answered": answered,
+            "upstream_requests": upstream_requests,
+            "ok": upstream_requests == 1 and answered == args.callers - cancelled,
+        }
+    
+    await bot.http_client.aclose()
+    stub.stop()
+    return report
+
+
+async def run_application(telegram, updates, timeout=120, spacing=0):
+    """Запускает бота в режиме polling, отдаёт ему updates с паузой spacing и ждёт по ответу на каждое.
+    
+    Возвращает время отправки каждого обновления.
+    """
+    # Как при старте процесса: токены, индексы и диалоги читаются из базы
+    bot.conversations.entries.clear()
+    bot.load_state()
+    application = bot.build_application(bot.Application.builder().token("1:bench").base_url(telegram.url))
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+    
+    replies_before = telegram.message_ids
+    pushed = []
+    for index, update in enumerate(updates):
+        if index and spacing:
+            await asyncio.sleep(spacing)
+        pushed.append(time.monotonic())
+        telegram.push(update)
+    deadline = time.monotonic() + timeout
+    while telegram.message_ids - replies_before < len(updates) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    
+    await application.updater.stop()
+    await application.stop()
+    await bot.post_stop(application)
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    return pushed
+
+
+async def run_busy_chat(args):
+    """Проверяет, что пока /list дописывается по ответам API, следующая команда чата отвечается сразу."""
+    dexscreener = DexscreenerStub(args.volatility, args.slow_latency, args.seed)
+    dexscreener.start()
+    bot.DEXSCREENER_TOKENS_URL = dexscreener.url
+    bot.price_sources = [bot.DexscreenerSource()]
+    
+    # Цен токенов нет ни в кэше, ни в истории: /list отвечает заглушками и ждёт API
+    chat_id = 1
+    rewrite_tracked_tokens({chat_id: {f"Busy{index:03d}": {"last_price": 1.0, "percent": 5, "last_market_cap": 1e9,
+                                                            "name": f"Busy {index}"} for index in range(5)}})
+    telegram = TelegramStub()
+    telegram.start()
+    pushed = await run_application(telegram, [message_update(1, chat_id, chat_id, "/list"),
+                                              message_update(2, chat_id, chat_id, "/start")], spacing=0.3)
+    telegram.stop()
+    dexscreener.stop()
+    
+    (list_reply, _), (start_reply, _) = telegram.messages[:2]
+    last_edit = max(telegram.edits, default=list_reply)
+    return {"list": {
+        "reply_ms": (list_reply - pushed[0]) * 1000,
+        "edits": len(telegram.edits),
+        "last_edit_ms": (last_edit - pushed[0]) * 1000,
+        "next_command_reply_ms": (start_reply - pushed[1]) * 1000,
+        # Ответ на вторую команду не ждёт ответа API и приходит раньше последней правки /list
+        "ok": bool(telegram.edits) and start_reply < last_edit and start_reply - pushed[1] < args.slow_latency / 2,
+    }}
+
+
+async def run_import(args):
+    """Проверяет, что /import проверяет все адреса пакетными запросами к API."""
+    dexscreener = DexscreenerStub(args.volatility, args.latency, args.seed)
+    dexscreener.start()
+    bot.DEXSCREENER_TOKENS_URL = dexscreener.url
+    bot.price_sources = [bot.DexscreenerSource()]
+    
+    chat_id = 1
+    count = min(args.tokens_per_chat, bot.MAX_TOKENS_PER_USER)
+    lines = [f"Import{index:04d}, Token {index}, {index % 50 + 1}" for index in range(count)]
+    telegram = TelegramStub()
+    telegram.start()
+    await run_application(telegram, [message_update(1, chat_id, chat_id, "/import\n" + "\n".join(lines))])
+    telegram.stop()
+    dexscreener.stop()
+    # Остановка записи сбрасывает очередь в базу
+    bot.state_writer.stop()
+    bot.state_writer.start()
+    
+    imported = bot.get_db().execute("SELECT COUNT(*) FROM tracked_tokens WHERE chat_id = ?", (chat_id,)).fetchone()[0]
+    expected_requests = -(-count // bot.MAX_ADDRESSES_PER_REQUEST)
+    return {"import": {
+        "addresses": count,
+        "imported": imported,
+        "upstream_requests": dexscreener.requests,
+        "expected_requests": expected_requests,
+        "ok": imported == count and dexscreener.requests == expected_requests,
+    }}
+
+
+async def run_conversations(args):
+    """Проверяет, что перемешанные диалоги /add разных пользователей не смешиваются, в том числе через перезапуск."""
+    rng = random.Random(args.seed)
+    dexscreener = DexscreenerStub(args.volatility, args.latency, args.seed)
+    dexscreener.start()
+    bot.DEXSCREENER_TOKENS_URL = dexscreener.url
+    bot.price_sources = [bot.DexscreenerSource()]
+    
+    # По 10 пользователей в каждом групповом чате; шаги одного диалога идут по порядку,
+    # а диалоги между собой перемешаны случайно
+    expected = {}
+    flows = []
+    for index in range(args.flows):
+        chat_id, user_id = -(index // 10) - 1, index + 1
+        address, name, percent = f"Addr{index:06d}", f"Name {index}", index % 99 + 1
+        expected[(chat_id, address)] = (name, percent)
+        flows.append([(chat_id, user_id, text) for text in (f"/add {address}", name, str(percent))])
+    steps = []
+    positions = [0] * len(flows)
+    live = list(range(len(flows)))
+    while live:
+        index = rng.choice(live)
+        steps.append(flows[index][positions[index]])
+        positions[index] += 1
+        if positions[index] == len(flows[index]):
+            live.remove(index)
+    # Процент отправляется уже после перезапуска: состояние диалогов должно пережить его через базу.
+    # Номера обновлений растут в порядке отправки, как у Telegram
+    phases = ([step for step in steps if not step[2].isdigit()], [step for step in steps if step[2].isdigit()])
+    update_ids = itertools.count(1)
+    persisted = None
+    for phase in phases:
+        telegram = TelegramStub()
+        telegram.start()
+        await run_application(telegram, [message_update(next(update_ids), chat_id, user_id, text, "group")
+                                         for chat_id, user_id, text in phase])
+        telegram.stop()
+        # Остановка и запуск записи сбрасывают очередь в базу, как при завершении процесса
+        bot.state_writer.stop()
+        bot.state_writer.start()
+        if persisted is None:
+            persisted = bot.get_db().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    
+    rows = bot.get_db().execute("SELECT chat_id, token_address, name, percent FROM tracked_tokens").fetchall()
+    crosstalk = sum(expected.get((chat_id, address)) != (name, percent) for chat_id, address, name, percent in rows)
+    left = bot.get_db().execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+    dexscreener.stop()
+    return {"add": {
+        "flows": args.flows,
+        "persisted_conversations": persisted,
+        "tokens": len(rows),
+        "crosstalk": crosstalk,
+        "left_conversations": left,
+        "ok": len(rows) == args.flows and crosstalk == 0 and persisted == args.flows and left == 0,
+    }}
+
+
+async def wait_for(condition, timeout=10):
+    started = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError("заглушка потока не дождалась подписки")
+        await asyncio.sleep(0.001)
+    return time.perf_counter() - started
+
+
+async def run_streaming(args):
+    """Замеряет задержку оповещений, когда цены приходят из потокового источника."""
+    rng = random.Random(args.seed)
+    stream = PriceStreamStub()
+    await stream.start()
+    bot.PRICE_STREAM_URL = stream.url
+    bot.subscriptions = bot.SubscriptionStore()
+    bot.scheduler = bot.PollScheduler()
+    build_workload(args, rng)
+    
+    fake_bot = FakeBot()
+    application = SimpleNamespace(bot=fake_bot)
+    await bot.post_init(application)
+    # Лимиты Telegram не нужны: меряем путь от цены до оповещения, а не ожидание отправки
+    bot.dispatcher.global_bucket = bot.TokenBucket(1e9, 1e9)
+    bot.dispatcher.chat_rate = 1e9
+    await wait_for(lambda: stream.subscribed == set(bot.token_subscribers))
+    initial_messages = stream.control_messages
+    
+    # Каждый тик поднимает цену токена на 60% — выше любого порога, так что оповещение получают все подписчики
+    prices = dict.fromkeys(bot.token_subscribers, 1.0)
+    tokens = list(prices)
+    latencies = []
+    for _ in range(args.ticks):
+        token_address = rng.choice(tokens)
+        prices[token_address] *= 1.6
+        expected = set(bot.token_subscribers[token_address])
+        sent_before = len(fake_bot.sent)
+        started = time.monotonic()
+        await stream.publish([{"token": token_address, "price": prices[token_address],
+                               "market_cap": prices[token_address] * 1e9, "price_change_24h": 60.0}])
+        await wait_for(lambda: len(fake_bot.sent) - sent_before >= len(expected))
+        latencies += [sent_at - started for sent_at, chat_id, _ in fake_bot.sent[sent_before:] if chat_id in expected]
+        await asyncio.sleep(args.tick_interval)
+    
+    # Новый токен должен попасть в подписку одним сообщением, не переподписывая остальные
+    messages_before = stream.control_messages
+    bot.set_tracked_token(1, "NewToken", {"last_price": 1.0, "percent": 5, "last_market_cap": 1e9, "name": "New"})
+    resubscribe = await wait_for(lambda: "NewToken" in stream.subscribed)
+    
+    await bot.post_stop(application)
+    await bot.post_shutdown(application)
+    await stream.stop()
+    return {"streaming": {
+        "ticks": args.ticks,
+        "alerts": len(latencies),
+        "subscribed_tokens": len(tokens),
+        "initial_subscribe_messages": initial_messages,
+        **percentiles(latencies),
+        "resubscribe_ms": resubscribe * 1000,
+        "resubscribe_messages": stream.control_messages - messages_before,
+    }}
+
+
+def fill_cold_start_db(args, rng):
+    """Записывает подписки чатов прямо в базу, минуя очередь записи: популярность токенов — по Ципфу."""
+    universe = [f"Tok{index:06d}" for index in range(args.universe)]
+    cum_weights = list(itertools.accumulate(zipf_weights(args.universe, args.skew)))
+    tokens_per_chat = min(args.tokens_per_chat, bot.MAX_TOKENS_PER_USER, args.universe)
+    now = time.time()
+    conn = bot.get_db()
+    with conn:
+        for chat_id in range(1, args.chats + 1):
+            chosen = set()
+            while len(chosen) < tokens_per_chat:
+                chosen.update(rng.choices(universe, cum_weights=cum_weights, k=tokens_per_chat - len(chosen)))
+            conn.executemany("INSERT INTO tracked_tokens VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (chat_id, token_address, 1.0, rng.choice([1, 5, 10, 25, 50]), 1e9, f"Token {token_address}", now)
+                for token_address in chosen
+            ])
+
+
+def rewrite_tracked_tokens(chats):
+    """Сохранение подписок до очереди записи: таблица удаляется и записывается заново целиком."""
+    conn = sqlite3.connect(bot.DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM tracked_tokens")
+    for chat_id, tokens in chats.items():
+        for token_address, data in tokens.items():
+            cursor.execute(
+                "INSERT INTO tracked_tokens VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, token_address, data["last_price"], data["percent"],
+                 data["last_market_cap"], data["name"], time.time())
+            )
+    conn.commit()
+    conn.close()
+
+
+def run_persistence(args):
+    """Замеряет стоимость сохранения одного оповещения при разном числе подписок в базе."""
+    rng = random.Random(args.seed)
+    sizes = [int(value) for value in args.rows.split(",")]
+    # Очередь записи сбрасывается вручную, чтобы каждая транзакция попала в замер
+    bot.state_writer.stop()
+    writer_conn = sqlite3.connect(bot.DB_PATH)
+    writer_conn.execute("PRAGMA synchronous=NORMAL")
+    report = {}
+    for rows in sizes:
+        conn = bot.get_db()
+        with conn:
+            conn.execute("DELETE FROM tracked_tokens")
+            conn.executemany("INSERT INTO tracked_tokens VALUES (?, ?, ?, ?, ?, ?, ?)", [
+                (index // 20 + 1, f"Tok{index:06d}", 1.0, 5, 1e9, f"Token {index}", time.time()) for index in range(rows)
+            ])
+        bot.load_state()
+        keys = [(index // 20 + 1, f"Tok{index:06d}") for index in range(rows)]
+        alerts = [(*rng.choice(keys), rng.uniform(0.5, 2)) for _ in range(args.alerts)]
+        
+        chats = bot.load_tracked_tokens()
+        rewrite_alerts = alerts[:20]
+        started = time.perf_counter()
+        for chat_id, token_address, price in rewrite_alerts:
+            chats[chat_id][token_address].update(last_price=price, last_market_cap=price * 1e9)
+            rewrite_tracked_tokens(chats)
+        report[f"full_rewrite_{rows}"] = {"alerts": len(rewrite_alerts),
+                                          "per_alert_us": (time.perf_counter() - started) / len(rewrite_alerts) * 1e6,
+                                          "rows_written": rows * len(rewrite_alerts)}
+        
+        for mode in ("write_behind_each", "write_behind_batched"):
+            rows_before = bot.state_writer.rows_written
+            started = time.perf_counter()
+            for chat_id, token_address, price in alerts:
+                bot.update_tracked_token(chat_id, token_address, last_price=price, last_market_cap=price * 1e9)
+                if mode == "write_behind_each":
+                    bot.state_writer.flush(writer_conn)
+            bot.state_writer.flush(writer_conn)
+            report[f"{mode}_{rows}"] = {"alerts": len(alerts),
+                                        "per_alert_us": (time.perf_counter() - started) / len(alerts) * 1e6,
+                                        "rows_written": bot.state_writer.rows_written - rows_before}
+    writer_conn.close()
+    bot.state_writer.start()
+    
+    # Запись через очередь затрагивает только изменённые строки: её стоимость почти не зависит
+    # от размера таблицы (индекс первичного ключа даёт лишь логарифмический рост)
+    for mode in ("write_behind_each", "write_behind_batched"):
+        smallest = report[f"{mode}_{sizes[0]}"]["per_alert_us"]
+        for rows in sizes:
+            report[f"{mode}_{rows}"]["ok"] = report[f"{mode}_{rows}"]["per_alert_us"] <= 3 * smallest
+    return report
+
+
+def find_triggered_loop(prices, tracked_tokens, token_subscribers):
+    """Проверка порогов до колоночного хранилища: цикл по подписчикам каждого токена."""
+    triggered = []
+    for token_address, current_price in prices.items():
+        for chat_id in token_subscribers.get(token_address, ()):
+            data = tracked_tokens[chat_id][token_address]
+            last_price = data["last_price"]
+            percent_change = abs((current_price - last_price) / last_price * 100)
+            if percent_change >= data["percent"]:
+                triggered.append((chat_id, token_address, percent_change))
+    return triggered
+
+
+def run_vectorized(args):
+    """Сравнивает время прохода проверки порогов циклом по словарям и векторным проходом."""
+    rng = random.Random(args.seed)
+    tokens_per_chat = min(50, args.universe)
+    # Цена подписки — цена токена на момент прошлого оповещения, текущая цена сдвинута на --volatility %
+    base_prices = [rng.uniform(0.01, 100) for _ in range(args.universe)]
+    rows = []
+    for index in range(args.subscriptions):
+        chat_id, position = divmod(index, tokens_per_chat)
+        # 7919 — простое число: токены одного чата не повторяются
+        token_index = (chat_id * tokens_per_chat + position * 7919) % args.universe
+        last_price = base_prices[token_index] * math.exp(rng.gauss(0, args.volatility / 100))
+        rows.append((chat_id + 1, f"Tok{token_index:06d}", last_price, rng.choice([1, 5, 10, 25, 50]), 1e9))
+    tracked_tokens = {}
+    token_subscribers = {}
+    for chat_id, token_address, last_price, percent, last_market_cap in rows:
+        tracked_tokens.setdefault(chat_id, {})[token_address] = {
+            "last_price": last_price, "percent": percent, "last_market_cap": last_market_cap}
+        token_subscribers.setdefault(token_address, set()).add(chat_id)
+    store = bot.SubscriptionStore()
+    store.extend(rows)
+    prices = {f"Tok{index:06d}": price * math.exp(rng.gauss(0, args.volatility / 100))
+              for index, price in enumerate(base_prices)}
+    
+    timings = {"loop": [], "vectorized": []}
+    for _ in range(args.sweeps):
+        started = time.perf_counter()
+        expected = find_triggered_loop(prices, tracked_tokens, token_subscribers)
+        timings["loop"].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        triggered = store.find_triggered(prices)
+        timings["vectorized"].append(time.perf_counter() - started)
+    same = ({(chat_id, token_address) for chat_id, token_address, _ in expected}
+            == {(chat_id, token_address) for chat_id, token_address, _ in triggered})
+    return {mode: {"subscriptions": len(rows), "tokens": len(prices), "pass_ms": min(times) * 1000,
+                   "triggered": len(expected if mode == "loop" else triggered), "ok": same}
+            for mode, times in timings.items()}
+
+
+def synthetic_series(args):
+    """Генерирует ряды цен: логарифмическое случайное блуждание с волатильностью, своей у каждого токена."""
+    rng = np.random.default_rng(args.seed)
+    times = list(range(0, int(args.hours * 3600), args.sample_interval))
+    series = {}
+    for index in range(args.series):
+        # Ст. отклонение за секунду, %: от почти неподвижных токенов до мемкоинов
+        sigma = rng.choice([0.005, 0.01, 0.05, 0.2]) / 100 * math.sqrt(args.sample_interval)
+        steps = rng.normal(0, sigma, len(times))
+        steps[0] = 0
+        series[f"Tok{index:06d}"] = (times, (rng.uniform(0.01, 100) * np.exp(np.cumsum(steps))).tolist())
+    return series
+
+
+def recorded_series(path):
+    """Читает ряды цен из таблицы price_history базы бота; время отсчитывается от первой записи."""
+    conn = sqlite3.connect(path)
+    try:
+        rows = conn.execute("SELECT token_address, ts, price FROM price_history "
+                            "WHERE price > 0 ORDER BY token_address, ts").fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        raise SystemExit(f"В {path} нет записей price_history")
+    start = min(ts for _, ts, _ in rows)
+    series = {}
+    for token_address, ts, price in rows:
+        times, prices = series.setdefault(token_address, ([], []))
+        times.append(ts - start)
+        prices.append(price)
+    return series
+
+
+def replay_series(series, step, percent, adaptive):
+    """Прогоняет ряды цен через проверку порогов с фиксированным или адаптивным опросом."""
+    duration = max(times[-1] for times, _ in series.values()) + 1
+    store = bot.SubscriptionStore()
+    scheduler = bot.PollScheduler()
+    last_alert = {}
+    # Токен -> момент, когда цена вышла за порог и с тех пор за ним остаётся
+    crossings = {}
+    delays = []
+    missed = 0
+    lookups = 0
+    next_fixed = 0
+    for now in range(0, duration, step):
+        current = {}
+        for token_address, (times, prices) in series.items():
+            index = bisect.bisect_right(times, now) - 1
+            if index >= 0:
+                current[token_address] = prices[index]
+        for token_address, price in current.items():
+            if token_address not in last_alert:
+                # Подписка появляется с первой записанной ценой токена
+                last_alert[token_address] = price
+                store.set(1, token_address, price, percent, 1)
+                scheduler.add(token_address, now)
+            elif abs(price - last_alert[token_address]) / last_alert[token_address] * 100 >= percent:
+                crossings.setdefault(token_address, now)
+            elif crossings.pop(token_address, None) is not None:
+                # Цена вернулась к порогу раньше, чем её проверили
+                missed += 1
+        
+        if adaptive:
+            due = scheduler.due(now)
+        elif now >= next_fixed:
+            due = list(last_alert)
+            next_fixed = now + bot.DEFAULT_POLL_INTERVAL
+        else:
+            due = []
+        if not due:
+            continue
+        lookups += len(due)
+        prices = {token_address: current[token_address] for token_address in due}
+        for chat_id, token_address, _ in store.find_triggered(prices):
+            delays.append(now - crossings.pop(token_address, now))
+            last_alert[token_address] = prices[token_address]
+            store.set(chat_id, token_address, prices[token_address], percent, 1)
+        if adaptive:
+            distances = store.threshold_distances(prices)
+            for token_address in due:
+                scheduler.observe(token_address, prices[token_address], now, distances.get(token_address))
+    # Задержка в интервалах фиксированного опроса: у него она по построению не больше одного
+    delays = np.array(delays, dtype=float) / bot.DEFAULT_POLL_INTERVAL
+    return {"tokens": len(series), "lookups": lookups, "alerts": len(delays),
+            "delay_mean_intervals": float(delays.mean()) if len(delays) else 0.0,
+            "delay_p95_intervals": float(np.percentile(delays, 95)) if len(delays) else 0.0,
+            "missed_pct": missed / (missed + len(delays)) * 100 if missed + len(delays) else 0.0}
+
+
+def run_replay(args):
+    """Сравнивает фиксированный и адаптивный опрос на записанных рядах цен."""
+    series = recorded_series(args.replay_db) if args.replay_db else synthetic_series(args)
+    report = {mode: replay_series(series, args.sample_interval, args.percent, mode == "adaptive")
+              for mode in ("fixed", "adaptive")}
+    fixed, adaptive = report["fixed"], report["adaptive"]
+    adaptive["ok"] = (adaptive["lookups"] < fixed["lookups"]
+                      and adaptive["delay_p95_intervals"] <= fixed["delay_p95_intervals"]
+                      and adaptive["missed_pct"] <= fixed["missed_pct"])
+    return report
+
+
+async def run_sending(args):
+    """Замеряет отправку сообщений проверки через MessageDispatcher с лимитами Telegram."""
+    fake_bot = FloodBot(flood_at=10, retry_after=1)
+    dispatcher = bot.MessageDispatcher(fake_bot)
+    dispatcher.start()
+    
+    # Оповещения получают чаты с положительными ID, уведомления о сбоях — с отрицательными;
+    # пять уведомлений уходят в один чат, чтобы сработал лимит на чат
+    started = time.perf_counter()
+    for index in range(args.alerts):
+        dispatcher.add_alert(index % args.chats + 1, f"Оповещение {index}")
+    dispatcher.flush_alerts()
+    for index in range(20):
+        dispatcher.send(-index - 2, f"Уведомление {index}")
+    for index in range(5):
+        dispatcher.send(-1, f"Уведомление в один чат {index}")
+    queue_ms = (time.perf_counter() - started) * 1000
+    expected = min(args.alerts, args.chats) + 25
+    
+    deadline = time.monotonic() + expected / bot.GLOBAL_SEND_RATE + 30
+    while len(fake_bot.sent) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    await dispatcher.stop()
+    
+    times = [sent_at for sent_at, _, _ in fake_bot.sent]
+    # Token bucket с запасом в одно сообщение пропускает за любую секунду не больше rate + 1 сообщений
+    max_per_second = max(bisect.bisect_right(times, sent_at + 1) - index for index, sent_at in enumerate(times))
+    chat_times = {}
+    for sent_at, chat_id, _ in fake_bot.sent:
+        chat_times.setdefault(chat_id, []).append(sent_at)
+    gaps = [later - earlier for sent in chat_times.values() for earlier, later in zip(sent, sent[1:])]
+    min_chat_gap = min(gaps, default=math.inf)
+    chat_ids = [chat_id for _, chat_id, _ in fake_bot.sent]
+    alerts_first = all(chat_id > 0 for chat_id in chat_ids[:min(args.alerts, args.chats)])
+    return {"dispatch": {
+        "messages": len(fake_bot.sent),
+        "queue_ms": queue_ms,
+        "send_s": times[-1] - times[0] if times else 0.0,
+        "max_per_second": max_per_second,
+        "min_chat_gap_s": min_chat_gap,
+        "ok": (len(fake_bot.sent) == expected and max_per_second <= bot.GLOBAL_SEND_RATE + 1
+               and min_chat_gap >= 1 / bot.CHAT_SEND_RATE - 0.01 and alerts_first),
+    }}
+
+
+def cold_start_child(args):
+    """Загружает состояние так же, как main() бота, и печатает замеры в JSON (запускается в отдельном процессе)."""
+    bot.DB_PATH = args.db
+    bot.LAZY_CHAT_LOADING = args.cold_start_child == "lazy"
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    bot.load_state()
+    startup = time.perf_counter() - started
+    rss_after = peak_rss_mb()
+    
+    chat_ids = random.Random(args.seed).sample(range(1, args.chats + 1), min(100, args.chats))
+    started = time.perf_counter()
+    for chat_id in chat_ids:
+        bot.tracked_tokens.get(chat_id)
+    first_access = (time.perf_counter() - started) / len(chat_ids)
+    print(json.dumps({
+        "startup_s": startup,
+        "state_rss_mb": rss_after - rss_before,
+        "peak_rss_mb": rss_after,
+        "first_access_us": first_access * 1e6,
+        "chats_in_memory": len(bot.tracked_tokens),
+        "subscriptions": len(bot.subscriptions),
+    }))
+
+
+def checker_child(args):
+    """Запускает цикл проверяльщика, как `python bot.py checker`, над базой --db и заглушкой --api-url."""
+    bot.DB_PATH = args.db
+    bot.DEXSCREENER_TOKENS_URL = args.api_url
+    bot.price_sources = [bot.DexscreenerSource()]
+    asyncio.run(bot.run_checker())
+
+
+def run_checkers(args):
+    """Замеряет, как пропускная способность проверки растёт с числом процессов проверяльщика."""
+    fill_cold_start_db(args, random.Random(args.seed))
+    conn = bot.get_db()
+    subscriptions, tokens = conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT token_address) FROM tracked_tokens").fetchone()
+    counts = [int(value) for value in args.checkers.split(",")]
+    report = {}
+    for count in counts:
+        # Все подписки смотрят на цену 1.0, а заглушка отдаёт 2.0 без колебаний: каждая подписка
+        # срабатывает ровно один раз, и любое второе оповещение по ней — повтор
+        stub = DexscreenerStub(0, args.latency, args.seed)
+        stub.prices = {f"Tok{index:06d}": 2.0 for index in range(args.universe)}
+        stub.start()
+        worker_ids = [f"bench-checker-{index}" for index in range(count)]
+        with conn:
+            conn.execute("UPDATE tracked_tokens SET last_price = 1.0, last_market_cap = 1e9")
+            conn.execute("DELETE FROM alert_outbox")
+            # Цены прошлого прогона в общем кэше в базе иначе заменили бы запросы к API
+            conn.execute("DELETE FROM token_cache")
+            conn.execute("DELETE FROM price_history")
+            # Проверяльщики отмечены живыми заранее: кольцо с первого тика делится на всех
+            conn.execute("DELETE FROM checker_workers")
+            conn.executemany("INSERT INTO checker_workers (worker_id, heartbeat) VALUES (?, ?)",
+                             [(worker_id, time.time()) for worker_id in worker_ids])
+        children = [subprocess.Popen([sys.executable, __file__, "--checker-child", "--db", bot.DB_PATH,
+                                      "--api-url", stub.url],
+                                     env={**os.environ, "WORKER_ID": worker_id, "LOG_LEVEL": "WARNING"})
+                    for worker_id in worker_ids]
+        deadline = time.monotonic() + args.checker_timeout
+        alerted = 0
+        while alerted < subscriptions and time.monotonic() < deadline:
+            time.sleep(0.2)
+            alerted = conn.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT chat_id, token_address FROM alert_outbox)").fetchone()[0]
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+        stub.stop()
+        
+        rows = conn.execute("SELECT COUNT(*) FROM alert_outbox").fetchone()[0]
+        seen = sorted(stub.first_seen.values())
+        # От первого запроса до первого запроса последнего токена: запуск процессов не учитывается
+        sweep = seen[-1] - seen[0] if len(seen) > 1 else 0
+        report[f"checkers_{count}"] = {
+            "tokens": tokens,
+            "subscriptions": subscriptions,
+            "sweep_s": sweep,
+            "tokens_per_s": len(seen) / sweep if sweep else 0.0,
+            "upstream_requests": stub.requests,
+            "alerts": rows,
+            "duplicates": rows - alerted,
+            "missing": subscriptions - alerted,
+        }
+    baseline = report[f"checkers_{counts[0]}"]["tokens_per_s"]
+    for count in counts:
+        results = report[f"checkers_{count}"]
+        results["speedup"] = results["tokens_per_s"] / baseline if baseline else 0.0
+        # Линейный рост с допуском на общий процессор
+        results["ok"] = (results["duplicates"] == 0 and results["missing"] == 0
+                         and results["speedup"] >= 0.7 * count / counts[0])
+    return report
+
+
+def run_cold_start(args):
+    fill_cold_start_db(args, random.Random(args.seed))
+    report = {}
+    for mode in ("eager", "lazy"):
+        # Отдельный процесс на режим, чтобы RSS одного не смешивался с другим
+        child = subprocess.run(
+            [sys.executable, __file__, "--cold-start-child", mode, "--db", bot.DB_PATH,
+             "--chats", str(args.chats), "--seed", str(args.seed)],
+            capture_output=True, text=True, check=True
+        )
+        report[mode] = json.loads(child.stdout.splitlines()[-1])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--tokens-per-chat", type=int, default=20)
+    parser.add_argument("--universe", type=int, default=1000, help="число разных токенов")
+    parser.add_argument("--skew", type=float, default=1.1, help="показатель Ципфа для популярности токенов")
+    parser.add_argument("--volatility", type=float, default=2.0, help="ст. отклонение изменения цены за запрос, %%")
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка заглушки API, с")
+    parser.add_argument("--sweeps", type=int, default=3)
+    parser.add_argument("--handler-calls", type=int, default=20, help="сколько раз вызвать /list и /stats")
+    parser.add_argument("--handler-latency", type=float, default=0.5,
+                        help="задержка заглушки API при вызовах /list и /stats, с")
+    parser.add_argument("--budget", type=float, default=60, help="бюджет одного прохода проверки, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    parser.add_argument("--batching", action="store_true",
+                        help="сравнить число запросов к API по одному адресу и пачками")
+    parser.add_argument("--fanout", action="store_true",
+                        help="сравнить обход подписок по чатам без кэша и с кэшем с проходом по индексу токенов")
+    parser.add_argument("--transport", action="store_true", help="сравнить задержку команд в режимах polling и webhook")
+    parser.add_argument("--updates", type=int, default=1000, help="сколько команд отправить в каждом режиме")
+    parser.add_argument("--rate", type=float, default=200, help="темп отправки команд в секунду")
+    parser.add_argument("--hedging", action="store_true", help="сравнить один источник цен и два со страховкой")
+    parser.add_argument("--lookups", type=int, default=1000, help="сколько пакетных запросов цен сделать в каждом режиме")
+    parser.add_argument("--concurrency", type=int, default=5, help="одновременных пакетных запросов")
+    parser.add_argument("--slow-fraction", type=float, default=0.05, help="доля медленных ответов заглушек API")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="задержка медленного ответа, с")
+    parser.add_argument("--cold-start", action="store_true", help="сравнить полную и ленивую загрузку чатов при старте")
+    parser.add_argument("--streaming", action="store_true", help="замерить задержку оповещений с потоковым источником цен")
+    parser.add_argument("--ticks", type=int, default=500, help="сколько цен отправить через поток")
+    parser.add_argument("--tick-interval", type=float, default=0.01, help="пауза между ценами потока, с")
+    parser.add_argument("--pooling", action="store_true",
+                        help="сравнить запросы к HTTPS-заглушке с новым соединением на каждый запрос и через общий пул")
+    parser.add_argument("--coalescing", action="store_true",
+                        help="проверить, что одновременные запросы одного адреса дают один запрос к API")
+    parser.add_argument("--callers", type=int, default=100, help="сколько задач одновременно запрашивают адрес")
+    parser.add_argument("--conversations", action="store_true",
+                        help="проверить, что перемешанные диалоги /add не смешиваются и переживают перезапуск")
+    parser.add_argument("--flows", type=int, default=1000, help="сколько диалогов /add провести")
+    parser.add_argument("--persistence", action="store_true",
+                        help="сравнить стоимость сохранения оповещения: перезапись таблицы и очередь записи")
+    parser.add_argument("--rows", default="1000,100000", help="размеры таблицы подписок через запятую")
+    parser.add_argument("--alerts", type=int, default=200, help="сколько оповещений сохранить в каждом режиме")
+    parser.add_argument("--vectorized", action="store_true",
+                        help="сравнить проверку порогов циклом по словарям и векторным проходом")
+    parser.add_argument("--subscriptions", type=int, default=1000000, help="сколько подписок проверять")
+    parser.add_argument("--sending", action="store_true",
+                        help="проверить отправку сообщений проверки с лимитами Telegram")
+    parser.add_argument("--replay", action="store_true",
+                        help="сравнить фиксированный и адаптивный опрос на записанных рядах цен")
+    parser.add_argument("--replay-db", help="база бота, из таблицы price_history которой читаются ряды цен")
+    parser.add_argument("--series", type=int, default=200, help="сколько рядов цен сгенерировать")
+    parser.add_argument("--hours", type=float, default=6, help="длина сгенерированных рядов, ч")
+    parser.add_argument("--sample-interval", type=int, default=5, help="шаг рядов и воспроизведения, с")
+    parser.add_argument("--percent", type=float, default=5, help="порог оповещения подписки, %%")
+    parser.add_argument("--busy-chat", action="store_true",
+                        help="проверить, что команда чата не ждёт, пока /list дописывается по ответам API")
+    parser.add_argument("--import", dest="import_tokens", action="store_true",
+                        help="проверить число запросов к API при /import")
+    parser.add_argument("--checkers", help="числа процессов проверяльщика через запятую, например 1,2,4")
+    parser.add_argument("--checker-timeout", type=float, default=120, help="сколько ждать оповещений по всем подпискам, с")
+    parser.add_argument("--cold-start-child", choices=("eager", "lazy"), help=argparse.SUPPRESS)
+    parser.add_argument("--checker-child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    parser.add_argument("--api-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.cold_start_child:
+        cold_start_child(args)
+        return
+    if args.checker_child:
+        checker_child(args)
+        return
+    
+    with tempfile.TemporaryDirectory() as directory:
+        bot.DB_PATH = os.path.join(directory, "bench.db")
+        bot.init_db()
+        bot.state_writer.start()
+        try:
+            if args.batching:
+                report = asyncio.run(run_batching(args))
+            elif args.fanout:
+                report = asyncio.run(run_fanout(args))
+            elif args.transport:
+                report = {mode: asyncio.run(run_transport(args, mode)) for mode in ("polling", "webhook")}
+            elif args.hedging:
+                report = asyncio.run(run_hedging(args))
+            elif args.cold_start:
+                report = run_cold_start(args)
+            elif args.streaming:
+                report = asyncio.run(run_streaming(args))
+            elif args.pooling:
+                report = asyncio.run(run_pooling(args))
+            elif args.coalescing:
+                report = asyncio.run(run_coalescing(args))
+            elif args.conversations:
+                report = asyncio.run(run_conversations(args))
+            elif args.persistence:
+                report = run_persistence(args)
+            elif args.vectorized:
+                report = run_vectorized(args)
+            elif args.sending:
+                report = asyncio.run(run_sending(args))
+            elif args.replay:
+                report = run_replay(args)
+            elif args.busy_chat:
+                report = asyncio.run(run_busy_chat(args))
+            elif args.import_tokens:
+                report = asyncio.run(run_import(args))
+            elif args.checkers:
+                report = run_checkers(args)
+            else:
+                report = asyncio.run(run(args))
+        finally:
+            bot.state_writer.stop()
+            bot.close_db()
+    
+    # Режимы сравнения печатают строку на каждый вариант; бюджет проверяется только у прохода проверки
+    comparison = (args.batching or args.fanout or args.transport or args.hedging or args.cold_start or args.streaming
+                  or args.pooling or args.coalescing or args.conversations or args.persistence or args.vectorized
+                  or args.sending or args.replay or args.busy_chat or args.import_tokens or args.checkers)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    elif comparison:
+        for mode, results in report.items():
+            print(f"{mode}: " + ", ".join(f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}"
+                                          for key, value in results.items()))
+    else:
+        for key, value in report.items():
+            print(f"{key:>20}: {value:.3f}" if isinstance(value, float) else f"{key:>20}: {value}")
+    if not comparison and report["sweep_max_s"] > args.budget:
+        print(f"Проход проверки дольше бюджета {args.budget} с", file=sys.stderr)
+        sys.exit(1)
+    if not comparison and not report["handlers_ok"]:
+        print("/list и /stats ждали ответа API или не дописали цены правками", file=sys.stderr)
+        sys.exit(1)
+    failed = [mode for mode, results in report.items() if comparison and results.get("ok") is False]
+    if failed:
+        print(f"Проверка не пройдена: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,234 @@
-import requests
+import httpx
+import numpy as np
+import websockets
 import time
 import os
+import re
 import asyncio
+import bisect
+import csv
+import gc
+import hashlib
+import heapq
+import html
+import io
+import itertools
+import json
+import logging
+import math
+import signal
+import socket
 import sqlite3
-from telegram import Update
-from telegram.ext import Application, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+import sys
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import (Application, BasePersistence, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler,
+                          ContextTypes, ConversationHandler, MessageHandler, PersistenceInput, filters)
+
+logger = logging.getLogger(__name__)
 
 # Состояния для ConversationHandler
 ADDRESS, NAME, PERCENT, EDIT_ADDRESS, EDIT_PERCENT = range(5)
 
+# Имена диалогов в таблице conversations
+ADD_CONVERSATION = "add"
+EDIT_CONVERSATION = "edit"
+
 # Путь к базе данных SQLite
 DB_PATH = "tokens.db"
 
-# Хранилище токенов: загружается из и сохраняется в SQLite (глобальная переменная для совместимости с текущим кодом)
-tracked_tokens = {}
+# Общее соединение с базой данных; открывается при первом обращении через get_db()
+db_conn = None
+
+# Обратный индекс: адрес токена -> множество chat_id подписчиков (строится из tracked_tokens)
+token_subscribers = {}
+
+# Колоночное хранилище числовых полей подписок для векторной проверки порогов (строится из tracked_tokens)
+subscriptions = None
+
+# Ленивая загрузка чатов: при старте читается только индекс подписок (адреса и пороги), а названия
+# и поля токенов чата — при первом обращении к нему. Чат без обращений дольше CHAT_IDLE_TTL секунд
+# выгружается из памяти; проверка выгрузки — раз в CHAT_EVICT_INTERVAL секунд
+LAZY_CHAT_LOADING = os.getenv("LAZY_CHAT_LOADING", "").lower() in ("1", "true", "yes")
+CHAT_IDLE_TTL = int(os.getenv("CHAT_IDLE_TTL", "600"))
+CHAT_EVICT_INTERVAL = 60
+INDEX_LOAD_BATCH = 10000  # По сколько строк читается индекс подписок при старте
+
+# Адаптивное расписание проверки токенов: интервал подбирается по волатильности токена
+# и расстоянию до ближайшего порога подписчиков, в пределах MIN..MAX_POLL_INTERVAL (в секундах)
+MIN_POLL_INTERVAL = int(os.getenv("MIN_POLL_INTERVAL", "10"))
+MAX_POLL_INTERVAL = int(os.getenv("MAX_POLL_INTERVAL", "300"))
+DEFAULT_POLL_INTERVAL = 60
+SCHEDULER_TICK = 5  # Как часто задача проверки смотрит, каким токенам подошёл срок
+POLL_SAFETY_FACTOR = 0.08  # Доля ожидаемого времени до срабатывания порога, через которую токен проверяется снова
+VOLATILITY_SMOOTHING = 0.3
+
+# Расписание проверки токенов; строится в main() по загруженным токенам
+scheduler = None
+
+# Фоновая запись в SQLite: интервал сброса очереди (в секундах) и размер очереди, при котором сброс происходит раньше
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "2"))
+FLUSH_BATCH_SIZE = int(os.getenv("FLUSH_BATCH_SIZE", "500"))
 
-# Временное хранилище данных во время добавления или редактирования токена
-temp_data = {}
+# Незаконченный диалог /add или /edit сбрасывается после CONVERSATION_TIMEOUT секунд без ответа
+CONVERSATION_TIMEOUT = int(os.getenv("CONVERSATION_TIMEOUT", "600"))
 
-# Кэш для данных токенов: загружается из и сохраняется в SQLite
-cache = {}
+# Кэш для данных токенов: ограниченный LRU в памяти поверх таблицы token_cache в SQLite
 CACHE_TIMEOUT = 300  # 5 минут в секундах
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_PURGE_INTERVAL = 3600  # Как часто удалять устаревшие строки из token_cache (в секундах)
+CACHE_REFRESH_AHEAD = 0.8  # Доля CACHE_TIMEOUT, после которой запись обновляется в фоне, не дожидаясь промаха
+
+# История цен: не чаще одного сэмпла на токен за HISTORY_MIN_INTERVAL. Сэмплы старше HISTORY_RAW_RETENTION
+# прореживаются до одного на HISTORY_DOWNSAMPLE_BUCKET, старше HISTORY_RETENTION — удаляются (всё в секундах)
+HISTORY_MIN_INTERVAL = int(os.getenv("HISTORY_MIN_INTERVAL", "60"))
+HISTORY_RAW_RETENTION = 24 * 3600
+HISTORY_DOWNSAMPLE_BUCKET = 15 * 60
+HISTORY_RETENTION = 30 * 24 * 3600
+HISTORY_COMPACT_INTERVAL = 3600
+
+# Запросы к API, которые выполняются прямо сейчас: адрес токена -> future с результатом.
+# Параллельные запросы того же адреса ждут существующий future вместо нового запроса
+inflight = {}
+background_tasks = set()
+
+# Эндпоинты Dexscreener и GeckoTerminal принимают до 30 адресов через запятую за один запрос
+DEXSCREENER_TOKENS_URL = "https://api.dexscreener.com/latest/dex/tokens/"
+GECKOTERMINAL_TOKENS_URL = "https://api.geckoterminal.com/api/v2/networks/solana/tokens/multi/"
+MAX_ADDRESSES_PER_REQUEST = 30
+
+# Источники цен в порядке приоритета, например "dexscreener,geckoterminal". Если основной источник
+# не ответил за p95 своей задержки (в пределах HEDGE_MIN_DELAY..HEDGE_MAX_DELAY секунд) или ответил
+# сбоем, тот же запрос уходит следующему источнику. По умолчанию запросы идут только в Dexscreener
+PRICE_SOURCES = [name.strip() for name in os.getenv("PRICE_SOURCES", "dexscreener").split(",") if name.strip()]
+HEDGE_PERCENTILE = 0.95
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_MAX_DELAY = float(os.getenv("HEDGE_MAX_DELAY", "5"))
+SOURCE_LATENCY_WINDOW = 200  # Сколько последних запросов к источнику учитывается в оценке p95
+SOURCE_MIN_SAMPLES = 20  # Пока замеров меньше, страховочный запрос ждёт HEDGE_MAX_DELAY
+SOURCE_FAILURE_THRESHOLD = 3  # Столько сбоев подряд выводят источник из ротации
+SOURCE_COOLDOWN = 60  # На столько секунд
+
+# Потоковый источник цен (WebSocket), если задан PRICE_STREAM_URL: бот подписывается на адреса отслеживаемых
+# токенов и проверяет пороги по каждой пришедшей цене. Опрос API остаётся для токенов, по которым поток молчит
+# дольше STREAM_STALE_AFTER секунд, и для всех токенов, пока соединение разорвано. Протокол — JSON:
+# бот отправляет {"op": "subscribe" | "unsubscribe", "tokens": [адреса]}, сервер присылает
+# {"token", "price", "market_cap", "price_change_24h"} или {"prices": [таких объектов]}
+PRICE_STREAM_URL = os.getenv("PRICE_STREAM_URL")
+STREAM_STALE_AFTER = 60
+STREAM_SUBSCRIBE_BATCH = 100  # Адресов в одном сообщении подписки
+STREAM_RECONNECT_DELAY = 1  # Задержка переподключения удваивается после каждой неудачи до STREAM_MAX_RECONNECT_DELAY
+STREAM_MAX_RECONNECT_DELAY = 60
+
+# Клиент потокового источника цен; создаётся при запуске, если задан PRICE_STREAM_URL
+price_stream = None
+
+# Ограничение одновременных запросов к API и дедлайн одного запроса (в секундах)
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "5"))
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "15"))
+
+# Пул соединений общего HTTP-клиента: размер пула и время жизни keep-alive соединений (в секундах)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Повторные запросы: количество попыток, база экспоненциальной задержки и её верхняя граница (в секундах)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1
+MAX_RETRY_DELAY = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Общий асинхронный HTTP-клиент и семафор; создаются в post_init приложения
+http_client = None
+request_semaphore = None
+
+# Блокировка, не дающая двум проверкам цен выполняться одновременно
+check_lock = asyncio.Lock()
 
 # Лимит токенов на пользователя
 MAX_TOKENS_PER_USER = 50
 
+# Импорт списка токенов: предельный размер загружаемого файла (в байтах) и процент оповещения,
+# если он не указан в строке
+IMPORT_MAX_FILE_SIZE = 256 * 1024
+DEFAULT_IMPORT_PERCENT = 10
+
+# Ограничения Telegram на исходящие сообщения: общий поток и поток в один чат (сообщений в секунду)
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", "25"))
+CHAT_SEND_RATE = float(os.getenv("CHAT_SEND_RATE", "1"))
+MAX_MESSAGE_LENGTH = 4096
+
+# /list и /stats отвечают сразу по кэшу и истории, а затем правят сообщение по мере ответов API:
+# не чаще раза в EDIT_INTERVAL секунд (лимит Telegram на правки) и по LIST_PAGE_SIZE токенов на странице,
+# чтобы страница с длинными названиями укладывалась в MAX_MESSAGE_LENGTH
+EDIT_INTERVAL = float(os.getenv("EDIT_INTERVAL", "1"))
+LIST_PAGE_SIZE = 8
+
+# Приоритеты исходящих сообщений: оповещения о ценах отправляются раньше уведомлений об ошибках
+PRIORITY_ALERT = 0
+PRIORITY_NOTICE = 1
+
+# Очередь исходящих сообщений; создаётся в post_init приложения
+dispatcher = None
+
+# Метрики: включаются переменной окружения METRICS_ENABLED=1 и отдаются в формате Prometheus на METRICS_PORT
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_PREFIX = "pricesol_"
+
+# Уровень логов процесса (DEBUG, INFO, WARNING...)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# HTTP-сервер метрик; запускается в post_init, если метрики включены
+metrics_server = None
+
+# Приём обновлений: если задан WEBHOOK_URL (внешний адрес сервиса, например https://<app>.up.railway.app),
+# бот поднимает встроенный HTTP-сервер для вебхука Telegram вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Telegram присылает его в заголовке; запросы без него отклоняются
+
+# Сколько обновлений обрабатывается одновременно; обновления одного чата всё равно идут по очереди
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+
+# Шардирование проверки цен. При SHARDED_CHECKERS=1 процесс бота сам цены не проверяет, а только рассылает
+# оповещения из таблицы alert_outbox. Их пишут проверяльщики (python bot.py checker), каждый из которых
+# владеет долей адресов токенов по консистентному хэшированию среди живых проверяльщиков
+SHARDED_CHECKERS = os.getenv("SHARDED_CHECKERS", "").lower() in ("1", "true", "yes")
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+WORKER_HEARTBEAT_TTL = 20  # Проверяльщик без отметки дольше этого (в секундах) считается выбывшим
+SHARD_RELOAD_INTERVAL = 10  # Как часто проверяльщик перечитывает подписки своей доли (в секундах)
+HASH_RING_REPLICAS = 64  # Виртуальных узлов на проверяльщика в кольце
+OUTBOX_POLL_INTERVAL = 1  # Как часто процесс бота забирает оповещения проверяльщиков (в секундах)
+OUTBOX_BATCH_SIZE = 1000
+
+# ID проверяльщика, если процесс запущен командой `python bot.py checker`; иначе None
+checker_id = None
+
+# Принадлежность токенов этому проверяльщику по кольцу из shard_workers: между перечитываниями
+# доли хэши заново считаются только для новых токенов
+shard_owners = {}
+shard_workers = None
+
 # ID администратора для уведомлений о сбоях (задайте через переменную окружения ADMIN_CHAT_ID)
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")  # Добавьте в Railway переменную окружения
 
+# Сводка сбоев для администратора отправляется раз в окно (в секундах).
+# Пользователь получает уведомление о недоступности токена не чаще раза за период подавления,
+# который удваивается, пока сбой продолжается (в секундах)
+ERROR_SUMMARY_WINDOW = int(os.getenv("ERROR_SUMMARY_WINDOW", "300"))
+ERROR_NOTICE_BACKOFF = 300
+MAX_ERROR_NOTICE_BACKOFF = 6 * 3600
+
 def format_number(value, is_price=False):
     """Форматирует большие числа в сокращённый вид только для Market Cap."""
     if is_price:  # Для цены всегда полный формат
@@ -38,9 +237,25 @@ def format_number(value, is_price=False):
         return f"${value / 1000000:.2f}M"
     return f"${value:,.2f}"
 
+def get_db():
+    """Возвращает общее долгоживущее соединение с базой данных (режим WAL)."""
+    global db_conn
+    if db_conn is None:
+        db_conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        db_conn.execute("PRAGMA journal_mode=WAL")
+        db_conn.execute("PRAGMA synchronous=NORMAL")
+    return db_conn
+
+def close_db():
+    """Закрывает общее соединение с базой данных."""
+    global db_conn
+    if db_conn is not None:
+        db_conn.close()
+        db_conn = None
+
 def init_db():
     """Инициализирует базу данных SQLite."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Таблица для отслеживаемых токенов
@@ -53,13 +268,30 @@ def init_db():
                      (token_address TEXT, price REAL, market_cap REAL, price_change_24h REAL, 
                       timestamp REAL, PRIMARY KEY (token_address))''')
     
+    # История цен: первичный ключ (token_address, ts) без rowid покрывает выборки по окну времени
+    cursor.execute('''CREATE TABLE IF NOT EXISTS price_history
+                     (token_address TEXT, ts INTEGER, price REAL, market_cap REAL,
+                      PRIMARY KEY (token_address, ts)) WITHOUT ROWID''')
+    
+    # Незаконченные диалоги /add и /edit: шаг диалога и собранные на прошлых шагах данные (JSON)
+    cursor.execute('''CREATE TABLE IF NOT EXISTS conversations
+                     (name TEXT, chat_id INTEGER, user_id INTEGER, state INTEGER, data TEXT, updated REAL,
+                      PRIMARY KEY (name, chat_id, user_id))''')
+    
+    # Живые проверяльщики и время их последней отметки
+    cursor.execute('''CREATE TABLE IF NOT EXISTS checker_workers
+                     (worker_id TEXT PRIMARY KEY, heartbeat REAL)''')
+    
+    # Сообщения проверяльщиков для процесса бота; для оповещений хранятся и новые цены подписки
+    cursor.execute('''CREATE TABLE IF NOT EXISTS alert_outbox
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, token_address TEXT, text TEXT,
+                      priority INTEGER, last_price REAL, last_market_cap REAL)''')
+    
     conn.commit()
-    conn.close()
 
 def load_tracked_tokens():
     """Загружает отслеживаемые токены из базы данных."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    cursor = get_db().cursor()
     cursor.execute("SELECT chat_id, token_address, last_price, percent, last_market_cap, name, timestamp FROM tracked_tokens")
     rows = cursor.fetchall()
     tracked_tokens = {}
@@ -73,107 +305,1567 @@ def load_tracked_tokens():
             "last_market_cap": last_market_cap,
             "name": name
         }
-    conn.close()
     return tracked_tokens
 
-def save_tracked_tokens():
-    """Сохраняет отслеживаемые токены в базу данных."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM tracked_tokens")
+class Metrics:
+    """Счётчики и гистограммы задержек горячих путей бота.
+    
+    Метрики идентифицируются именем и набором меток. Когда сбор выключен,
+    все методы сразу возвращаются, так что инструментирование почти ничего не стоит.
+    Запись идёт и из потока state_writer, поэтому изменения защищены блокировкой.
+    """
+    
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+    
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        """Замеряет длительность блока в гистограмму name."""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+    
+    def render(self, gauges):
+        """Текстовый формат Prometheus; gauges — текущие значения вида {имя: число}."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: {"buckets": list(value["buckets"]), "sum": value["sum"], "count": value["count"]}
+                          for key, value in self.histograms.items()}
+        lines = []
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} gauge")
+            lines.append(f"{METRICS_PREFIX}{name} {value}")
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+                typed.add(name)
+            lines.append(f"{METRICS_PREFIX}{name}{self.format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+                typed.add(name)
+            for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                lines.append(f"{METRICS_PREFIX}{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{METRICS_PREFIX}{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+            lines.append(f"{METRICS_PREFIX}{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+            lines.append(f"{METRICS_PREFIX}{name}_count{self.format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+    
+    def summary(self, gauges):
+        """Краткая сводка для команды /metrics."""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (value["sum"], value["count"]) for key, value in self.histograms.items()}
+        lines = ["📈 <b>Метрики:</b>"]
+        lines += [f"{name}: <b>{value}</b>" for name, value in sorted(gauges.items())]
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{self.format_labels(labels)}: <b>{value}</b>")
+        for (name, labels), (total, count) in sorted(histograms.items()):
+            average = total / count * 1000 if count else 0
+            lines.append(f"{name}{self.format_labels(labels)}: <b>{count}</b> шт., в среднем <b>{average:.1f} мс</b>")
+        return "\n".join(lines)
+
+metrics = Metrics(METRICS_ENABLED)
+
+# SQL для записи и удаления строк каждой таблицы; ключ строки — её первичный ключ
+WRITE_STATEMENTS = {
+    "tracked_tokens": (
+        "INSERT OR REPLACE INTO tracked_tokens VALUES (?, ?, ?, ?, ?, ?, ?)",
+        "DELETE FROM tracked_tokens WHERE chat_id = ? AND token_address = ?",
+    ),
+    # Правка процента и названия без цены подписки (см. mark_token_dirty); строки не удаляются
+    "token_settings": (
+        "UPDATE tracked_tokens SET percent = ?, name = ?, timestamp = ? WHERE chat_id = ? AND token_address = ?",
+        None,
+    ),
+    "token_cache": (
+        "INSERT OR REPLACE INTO token_cache VALUES (?, ?, ?, ?, ?)",
+        "DELETE FROM token_cache WHERE token_address = ?",
+    ),
+    "price_history": (
+        "INSERT OR REPLACE INTO price_history VALUES (?, ?, ?, ?)",
+        "DELETE FROM price_history WHERE token_address = ? AND ts = ?",
+    ),
+    "conversations": (
+        "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?)",
+        "DELETE FROM conversations WHERE name = ? AND chat_id = ? AND user_id = ?",
+    ),
+}
+
+class StateWriter:
+    """Отложенная (write-behind) запись состояния в SQLite из фонового потока.
+    
+    Изменения ставятся в очередь и объединяются по ключу строки: до базы доходит
+    только последний снимок. Очередь сбрасывается одной транзакцией раз в
+    flush_interval секунд или сразу при накоплении batch_size изменений, так что
+    при сбое теряется не больше одного интервала.
+    """
+    
+    def __init__(self, flush_interval, batch_size):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}
+        # Строки, которые сейчас записываются в базу: до конца транзакции читатели их там не видят
+        self.flushing = {}
+        self.statements = []
+        # Повторно входимая блокировка: внутри batch() можно вызывать put()
+        self.lock = threading.RLock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = None
+        self.flushes = 0
+        self.rows_written = 0
+    
+    def put(self, table, key, row):
+        """Ставит в очередь запись строки (row=None — удаление строки с ключом key)."""
+        with self.lock:
+            self.pending[(table, key)] = row
+            queued = len(self.pending)
+        if queued >= self.batch_size:
+            self.wakeup.set()
+    
+    def execute(self, sql, params=()):
+        """Ставит в очередь произвольный запрос; выполняется после строк в той же транзакции."""
+        with self.lock:
+            self.statements.append((sql, params))
+    
+    def discard(self, table, key):
+        """Убирает из очереди ещё не записанное изменение строки."""
+        with self.lock:
+            self.pending.pop((table, key), None)
+    
+    def queued(self, tables, prefix):
+        """Ещё не записанные в базу изменения строк tables, ключ которых начинается с prefix.
+        
+        Возвращает список (таблица, ключ, строка или None) в порядке записи.
+        """
+        with self.lock:
+            items = list(self.flushing.items()) + list(self.pending.items())
+        return [(table, key, row) for (table, key), row in items if table in tables and key[:len(prefix)] == prefix]
+    
+    @contextmanager
+    def batch(self):
+        """Изменения, поставленные внутри блока, попадут в базу одной транзакцией."""
+        with self.lock:
+            yield
+    
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="state-writer", daemon=True)
+        self.thread.start()
+    
+    def run(self):
+        conn = sqlite3.connect(DB_PATH)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            while not self.stopping:
+                self.wakeup.wait(self.flush_interval)
+                self.wakeup.clear()
+                self.flush(conn)
+            # Дописываем всё, что успело накопиться до остановки
+            self.flush(conn)
+        finally:
+            conn.close()
+    
+    def flush(self, conn):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            statements, self.statements = self.statements, []
+            self.flushing = batch
+        if not batch and not statements:
+            return
+        try:
+            with metrics.timer("sqlite_flush_seconds"), conn:
+                for (table, key), row in batch.items():
+                    upsert_sql, delete_sql = WRITE_STATEMENTS[table]
+                    if row is None:
+                        conn.execute(delete_sql, key)
+                    else:
+                        conn.execute(upsert_sql, row)
+                for sql, params in statements:
+                    conn.execute(sql, params)
+            with self.lock:
+                self.flushing = {}
+            self.flushes += 1
+            self.rows_written += len(batch)
+            for table, _ in batch:
+                metrics.inc("sqlite_rows_written_total", table=table)
+        except sqlite3.Error:
+            logger.exception("Не удалось сохранить состояние в базу данных")
+            # Возвращаем несохранённые изменения в очередь, не затирая более свежие
+            with self.lock:
+                for item_key, row in batch.items():
+                    self.pending.setdefault(item_key, row)
+                self.statements[:0] = statements
+                self.flushing = {}
+    
+    def stop(self):
+        """Останавливает поток, дождавшись записи всех накопленных изменений."""
+        self.stopping = True
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+state_writer = StateWriter(FLUSH_INTERVAL, FLUSH_BATCH_SIZE)
+
+class ChatTokenStore:
+    """Токены чатов {chat_id: {адрес: данные}} с загрузкой из SQLite по требованию.
+    
+    В ленивом режиме чат читается из tracked_tokens по первичному ключу при первом
+    обращении, поверх прочитанного накладываются ещё не записанные изменения из
+    очереди state_writer, а чаты без обращений дольше idle_ttl выгружаются.
+    Иначе хранилище работает как обычный словарь заранее загруженных чатов.
+    """
+    
+    def __init__(self, chats=None, lazy=False, idle_ttl=CHAT_IDLE_TTL):
+        self.chats = OrderedDict(chats or {})
+        self.last_access = {}
+        self.lazy = lazy
+        self.idle_ttl = idle_ttl
+        self.loads = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self.chats)
+    
+    def load(self, chat_id):
+        """Читает токены чата из базы с учётом очереди записи; None, если токенов нет."""
+        # Очередь снимается до чтения базы: строка, записанная между этими шагами, попадёт хотя бы в одно из них
+        queued = state_writer.queued(("tracked_tokens", "token_settings"), (chat_id,))
+        rows = get_db().execute(
+            "SELECT token_address, last_price, percent, last_market_cap, name FROM tracked_tokens WHERE chat_id = ?",
+            (chat_id,)
+        ).fetchall()
+        tokens = {}
+        for token_address, last_price, percent, last_market_cap, name in rows:
+            tokens[token_address] = {"last_price": last_price, "percent": percent,
+                                     "last_market_cap": last_market_cap, "name": name}
+        for table, (_, token_address), row in queued:
+            if table == "token_settings":
+                if token_address in tokens:
+                    tokens[token_address].update(percent=row[0], name=row[1])
+            elif row is None:
+                tokens.pop(token_address, None)
+            else:
+                tokens[token_address] = {"last_price": row[2], "percent": row[3],
+                                         "last_market_cap": row[4], "name": row[5]}
+        self.loads += 1
+        metrics.inc("chat_loads_total")
+        return tokens or None
+    
+    def lookup(self, chat_id):
+        """Токены чата из памяти или (в ленивом режиме) из базы; None, если их нет."""
+        tokens = self.chats.get(chat_id)
+        if not self.lazy:
+            return tokens
+        if tokens is None:
+            tokens = self.load(chat_id)
+            if tokens is None:
+                return None
+            self.chats[chat_id] = tokens
+        else:
+            self.chats.move_to_end(chat_id)
+        self.last_access[chat_id] = time.monotonic()
+        return tokens
+    
+    def resident(self, chat_id):
+        """Токены чата, только если он уже в памяти; база не читается."""
+        return self.chats.get(chat_id)
+    
+    def __contains__(self, chat_id):
+        return self.lookup(chat_id) is not None
+    
+    def __getitem__(self, chat_id):
+        tokens = self.lookup(chat_id)
+        if tokens is None:
+            raise KeyError(chat_id)
+        return tokens
+    
+    def __setitem__(self, chat_id, tokens):
+        self.chats[chat_id] = tokens
+        self.chats.move_to_end(chat_id)
+        self.last_access[chat_id] = time.monotonic()
+    
+    def get(self, chat_id, default=None):
+        tokens = self.lookup(chat_id)
+        return default if tokens is None else tokens
+    
+    def setdefault(self, chat_id, default):
+        tokens = self.lookup(chat_id)
+        if tokens is None:
+            tokens = self[chat_id] = default
+        return tokens
+    
+    def evict_idle(self, now=None):
+        """Выгружает чаты, к которым не обращались дольше idle_ttl секунд; возвращает их число."""
+        if not self.lazy:
+            return 0
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        # Чаты упорядочены по последнему обращению, поэтому хватает просмотреть начало
+        while self.chats:
+            chat_id = next(iter(self.chats))
+            if now - self.last_access.get(chat_id, 0) < self.idle_ttl:
+                break
+            del self.chats[chat_id]
+            self.last_access.pop(chat_id, None)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+# Токены чатов; в main() заменяется хранилищем с загруженными из базы чатами или ленивым
+tracked_tokens = ChatTokenStore()
+
+async def evict_idle_chats(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически выгружает из памяти давно неактивные чаты."""
+    evicted = tracked_tokens.evict_idle()
+    if evicted:
+        logger.info(f"Выгружено неактивных чатов: {evicted}, в памяти: {len(tracked_tokens)}")
+
+def mark_token_dirty(chat_id, token_address, settings_only=False):
+    """Ставит в очередь записи текущее состояние отслеживаемого токена (или его удаление).
+    
+    settings_only — записать только процент и название. При SHARDED_CHECKERS цену подписки
+    меняют проверяльщики, и вся строка из памяти бота вернула бы в базу старую цену.
+    """
+    key = (chat_id, token_address)
+    data = tracked_tokens.get(chat_id, {}).get(token_address)
+    if settings_only and data is not None:
+        state_writer.put("token_settings", key, (data["percent"], data["name"], time.time(), chat_id, token_address))
+        return
+    row = None
+    if data is not None:
+        row = (chat_id, token_address, data["last_price"], data["percent"],
+               data["last_market_cap"], data["name"], time.time())
+    with state_writer.batch():
+        # Ранняя правка настроек не должна выполниться после новой записи всей строки
+        state_writer.discard("token_settings", key)
+        state_writer.put("tracked_tokens", key, row)
+
+class SubscriptionStore:
+    """Колоночное хранилище подписок для векторной проверки порогов оповещений.
+    
+    Каждой паре (chat_id, token_address) выделяется слот, а last_price, percent,
+    last_market_cap и номер токена хранятся в массивах NumPy по номеру слота.
+    Освободившиеся слоты и номера токенов переиспользуются, массивы растут удвоением.
+    """
+    
+    def __init__(self, capacity=1024):
+        self.slots = {}
+        self.keys = []
+        self.free_slots = []
+        self.token_ids = {}
+        self.token_refs = []
+        self.free_token_ids = []
+        self.last_price = np.zeros(capacity)
+        self.percent = np.zeros(capacity)
+        self.last_market_cap = np.zeros(capacity)
+        self.token_index = np.zeros(capacity, dtype=np.int64)
+        self.active = np.zeros(capacity, dtype=bool)
+    
+    def __len__(self):
+        return len(self.slots)
+    
+    def grow(self):
+        """Удваивает ёмкость всех колонок."""
+        capacity = len(self.active) * 2
+        for column in ("last_price", "percent", "last_market_cap", "token_index", "active"):
+            old = getattr(self, column)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, column, new)
+    
+    def acquire_token_id(self, token_address):
+        token_id = self.token_ids.get(token_address)
+        if token_id is None:
+            if self.free_token_ids:
+                token_id = self.free_token_ids.pop()
+            else:
+                token_id = len(self.token_refs)
+                self.token_refs.append(0)
+            self.token_ids[token_address] = token_id
+        self.token_refs[token_id] += 1
+        return token_id
+    
+    def release_token_id(self, token_address):
+        token_id = self.token_ids[token_address]
+        self.token_refs[token_id] -= 1
+        if self.token_refs[token_id] == 0:
+            del self.token_ids[token_address]
+            self.free_token_ids.append(token_id)
+    
+    def set(self, chat_id, token_address, last_price, percent, last_market_cap):
+        """Добавляет подписку или обновляет её поля на месте."""
+        key = (chat_id, token_address)
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.keys[slot] = key
+            else:
+                slot = len(self.keys)
+                self.keys.append(key)
+                if slot >= len(self.active):
+                    self.grow()
+            self.slots[key] = slot
+            self.token_index[slot] = self.acquire_token_id(token_address)
+            self.active[slot] = True
+        self.last_price[slot] = last_price
+        self.percent[slot] = percent
+        self.last_market_cap[slot] = last_market_cap
+    
+    def extend(self, rows):
+        """Добавляет пачку новых подписок (chat_id, token_address, last_price, percent, last_market_cap).
+        
+        Колонки заполняются срезами, а не построчно, как в set(), поэтому загрузка
+        из базы идёт быстрее. Подписок из пачки в хранилище быть не должно.
+        """
+        if not rows:
+            return
+        chat_ids, token_addresses, last_prices, percents, last_market_caps = zip(*rows)
+        start = len(self.keys)
+        end = start + len(rows)
+        while end > len(self.active):
+            self.grow()
+        keys = list(zip(chat_ids, token_addresses))
+        self.keys.extend(keys)
+        self.slots.update(zip(keys, range(start, end)))
+        self.token_index[start:end] = [self.acquire_token_id(token_address) for token_address in token_addresses]
+        self.last_price[start:end] = last_prices
+        self.percent[start:end] = percents
+        self.last_market_cap[start:end] = last_market_caps
+        self.active[start:end] = True
+    
+    def set_prices(self, chat_id, token_address, last_price, last_market_cap):
+        """Обновляет цены существующей подписки; неизвестную подписку пропускает."""
+        slot = self.slots.get((chat_id, token_address))
+        if slot is not None:
+            self.last_price[slot] = last_price
+            self.last_market_cap[slot] = last_market_cap
+    
+    def remove(self, chat_id, token_address):
+        """Удаляет подписку и освобождает её слот."""
+        slot = self.slots.pop((chat_id, token_address), None)
+        if slot is None:
+            return
+        self.keys[slot] = None
+        self.active[slot] = False
+        self.free_slots.append(slot)
+        self.release_token_id(token_address)
+    
+    def percent_changes(self, prices):
+        """Изменение цены в процентах для всех слотов и маска слотов, для которых оно известно.
+        
+        prices — словарь адрес -> текущая цена (токены без цены пропускаются).
+        """
+        size = len(self.keys)
+        current_by_token = np.full(len(self.token_refs), np.nan)
+        for token_address, price in prices.items():
+            token_id = self.token_ids.get(token_address)
+            if token_id is not None:
+                current_by_token[token_id] = price
+        
+        current = current_by_token[self.token_index[:size]]
+        last_price = self.last_price[:size]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent_change = np.abs((current - last_price) / last_price * 100)
+        valid = self.active[:size] & (last_price > 0) & ~np.isnan(current)
+        return percent_change, valid
+    
+    def find_triggered(self, prices):
+        """Одним векторным проходом находит подписки, у которых изменение цены достигло порога.
+        
+        Возвращает список (chat_id, token_address, percent_change).
+        """
+        if not self.keys or not prices:
+            return []
+        percent_change, valid = self.percent_changes(prices)
+        triggered = valid & (percent_change >= self.percent[:len(self.keys)])
+        slots = np.flatnonzero(triggered)
+        return [(*self.keys[slot], float(percent_change[slot])) for slot in slots]
+    
+    def triggered_for(self, token_address, price, chat_ids):
+        """Подписки чатов chat_ids на один токен, у которых изменение до price достигло порога.
+        
+        В отличие от find_triggered, смотрит только слоты этих подписок, а не все.
+        Возвращает список (chat_id, token_address, percent_change).
+        """
+        slots = [self.slots.get((chat_id, token_address)) for chat_id in chat_ids]
+        slots = np.array([slot for slot in slots if slot is not None], dtype=np.int64)
+        if not len(slots):
+            return []
+        last_price = self.last_price[slots]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent_change = np.abs((price - last_price) / last_price * 100)
+        triggered = (last_price > 0) & (percent_change >= self.percent[slots])
+        return [(*self.keys[slot], float(change)) for slot, change in zip(slots[triggered], percent_change[triggered])]
+    
+    def threshold_distances(self, prices):
+        """Для каждого токена из prices — сколько процентов осталось до ближайшего порога среди его подписчиков."""
+        if not self.keys or not prices:
+            return {}
+        percent_change, valid = self.percent_changes(prices)
+        slots = np.flatnonzero(valid)
+        distance_by_token = np.full(len(self.token_refs), np.inf)
+        np.minimum.at(distance_by_token, self.token_index[slots], self.percent[slots] - percent_change[slots])
+        distances = {}
+        for token_address in prices:
+            token_id = self.token_ids.get(token_address)
+            if token_id is not None and np.isfinite(distance_by_token[token_id]):
+                distances[token_address] = max(float(distance_by_token[token_id]), 0.0)
+        return distances
+
+class PollScheduler:
+    """Очередь с приоритетом (по времени следующей проверки) для адаптивного опроса токенов.
+    
+    Для каждого токена хранится сглаженная волатильность цены (% за корень секунды):
+    цена блуждает случайно, и её сдвиг растёт как корень из времени, а не линейно.
+    Следующая проверка назначается через долю ожидаемого времени (distance / volatility)²,
+    за которое цена дойдёт до ближайшего порога подписчиков: токены у порога проверяются чаще,
+    спокойные — реже. Удалённые токены вычищаются из кучи лениво.
+    """
+    
+    def __init__(self, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                 default_interval=DEFAULT_POLL_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_interval = default_interval
+        self.heap = []
+        self.next_check = {}
+        self.last_sample = {}
+        self.volatility = {}
+    
+    def __len__(self):
+        return len(self.next_check)
+    
+    def schedule(self, token_address, when):
+        self.next_check[token_address] = when
+        heapq.heappush(self.heap, (when, token_address))
+    
+    def add(self, token_address, when=None):
+        """Добавляет токен в расписание (по умолчанию — на ближайший тик); уже известный токен не трогает."""
+        if token_address not in self.next_check:
+            self.schedule(token_address, time.time() if when is None else when)
+    
+    def remove(self, token_address):
+        self.next_check.pop(token_address, None)
+        self.last_sample.pop(token_address, None)
+        self.volatility.pop(token_address, None)
+    
+    def due(self, now):
+        """Извлекает все токены, время проверки которых наступило."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, token_address = heapq.heappop(self.heap)
+            # Пропускаем удалённые токены и устаревшие записи после перепланирования
+            if self.next_check.get(token_address) == when:
+                due.append(token_address)
+        return due
+    
+    def interval(self, token_address, distance):
+        """Интервал до следующей проверки по волатильности и расстоянию до порога (в процентах)."""
+        volatility = self.volatility.get(token_address)
+        if distance is None or not volatility:
+            return self.default_interval
+        return min(max(POLL_SAFETY_FACTOR * (distance / volatility) ** 2, self.min_interval), self.max_interval)
+    
+    def observe(self, token_address, price, now, distance=None):
+        """Учитывает новую цену токена (None — запрос не удался) и планирует следующую проверку."""
+        if token_address not in self.next_check:
+            return
+        if price is not None:
+            last = self.last_sample.get(token_address)
+            if last is not None and last[0] > 0 and now > last[1]:
+                rate = abs(price - last[0]) / last[0] * 100 / math.sqrt(now - last[1])
+                previous = self.volatility.get(token_address)
+                self.volatility[token_address] = rate if previous is None else (
+                    VOLATILITY_SMOOTHING * rate + (1 - VOLATILITY_SMOOTHING) * previous
+                )
+            self.last_sample[token_address] = (price, now)
+        self.schedule(token_address, now + self.interval(token_address, distance))
+
+def build_scheduler(token_subscribers, first_check):
+    """Ставит все отслеживаемые токены в расписание на момент first_check."""
+    scheduler = PollScheduler()
+    for token_address in token_subscribers:
+        scheduler.add(token_address, first_check)
+    return scheduler
+
+def build_subscription_store(tracked_tokens):
+    """Заполняет колоночное хранилище подписок по загруженным токенам."""
+    store = SubscriptionStore()
     for chat_id, tokens in tracked_tokens.items():
         for token_address, data in tokens.items():
-            cursor.execute(
-                "INSERT INTO tracked_tokens VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (chat_id, token_address, data["last_price"], data["percent"],
-                 data["last_market_cap"], data["name"], time.time())
-            )
-    conn.commit()
-    conn.close()
+            store.set(chat_id, token_address, data["last_price"], data["percent"], data["last_market_cap"])
+    return store
 
-def load_cache():
-    """Загружает кэш токенов из базы данных."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT token_address, price, market_cap, price_change_24h, timestamp FROM token_cache")
-    rows = cursor.fetchall()
-    cache = {}
-    for row in rows:
-        token_address, price, market_cap, price_change_24h, timestamp = row
-        cache[token_address] = {
-            "data": {"price": price, "market_cap": market_cap, "price_change_24h": price_change_24h},
-            "timestamp": timestamp
-        }
-    conn.close()
-    return cache
+def load_subscription_index():
+    """Читает из базы только нужное проверке цен: подписчиков каждого токена и числовые поля подписок."""
+    token_subscribers = {}
+    store = SubscriptionStore()
+    cursor = get_db().execute("SELECT chat_id, token_address, last_price, percent, last_market_cap FROM tracked_tokens")
+    # Читаем пачками, чтобы не держать в памяти все строки сразу
+    while True:
+        rows = cursor.fetchmany(INDEX_LOAD_BATCH)
+        if not rows:
+            break
+        store.extend(rows)
+        for chat_id, token_address, *_ in rows:
+            token_subscribers.setdefault(token_address, set()).add(chat_id)
+    return token_subscribers, store
 
-def save_cache():
-    """Сохраняет кэш токенов в базу данных."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM token_cache")
-    for token_address, data in cache.items():
-        cursor.execute(
-            "INSERT INTO token_cache VALUES (?, ?, ?, ?, ?)",
-            (token_address, data["data"]["price"], data["data"]["market_cap"],
-             data["data"]["price_change_24h"], data["timestamp"])
+def build_token_subscribers(tracked_tokens):
+    """Строит обратный индекс адрес токена -> подписчики по загруженным токенам."""
+    token_subscribers = {}
+    for chat_id, tokens in tracked_tokens.items():
+        for token_address in tokens:
+            token_subscribers.setdefault(token_address, set()).add(chat_id)
+    return token_subscribers
+
+def set_tracked_token(chat_id, token_address, data):
+    """Добавляет или заменяет отслеживаемый токен, обновляя индекс подписчиков и очередь записи."""
+    tracked_tokens.setdefault(chat_id, {})[token_address] = data
+    token_subscribers.setdefault(token_address, set()).add(chat_id)
+    scheduler.add(token_address)
+    if price_stream is not None:
+        price_stream.track(token_address)
+    subscriptions.set(chat_id, token_address, data["last_price"], data["percent"], data["last_market_cap"])
+    mark_token_dirty(chat_id, token_address)
+
+def update_tracked_token(chat_id, token_address, **changes):
+    """Изменяет поля отслеживаемого токена; ничего не делает, если токен уже удалён."""
+    data = tracked_tokens.get(chat_id, {}).get(token_address)
+    if data is None:
+        return
+    data.update(changes)
+    subscriptions.set(chat_id, token_address, data["last_price"], data["percent"], data["last_market_cap"])
+    mark_token_dirty(chat_id, token_address, settings_only=SHARDED_CHECKERS and "last_price" not in changes)
+
+def apply_checker_alert(chat_id, token_address, last_price, last_market_cap):
+    """Переносит в память цены, уже записанные в базу проверяльщиком, не ставя строку в очередь записи."""
+    # Выгруженный чат не читаем: новые цены уже в базе и подхватятся при следующем обращении
+    tokens = tracked_tokens.resident(chat_id)
+    data = tokens.get(token_address) if tokens is not None else None
+    if data is not None:
+        data.update(last_price=last_price, last_market_cap=last_market_cap)
+    subscriptions.set_prices(chat_id, token_address, last_price, last_market_cap)
+
+def remove_tracked_token(chat_id, token_address):
+    """Удаляет токен из отслеживания чата, обновляя индекс подписчиков и очередь записи."""
+    tracked_tokens.get(chat_id, {}).pop(token_address, None)
+    subscribers = token_subscribers.get(token_address)
+    if subscribers is not None:
+        subscribers.discard(chat_id)
+        if not subscribers:
+            del token_subscribers[token_address]
+            scheduler.remove(token_address)
+            if price_stream is not None:
+                price_stream.untrack(token_address)
+    subscriptions.remove(chat_id, token_address)
+    mark_token_dirty(chat_id, token_address)
+
+class TokenCache:
+    """Двухуровневый кэш данных токенов: ограниченный LRU в памяти поверх таблицы token_cache.
+    
+    При промахе в памяти запись читается из SQLite. Записи старше ttl считаются
+    устаревшими и удаляются лениво при обращении, а из таблицы — периодически
+    в purge_stale(). Новые записи сохраняются в базу через очередь state_writer.
+    Попадания, промахи и вытеснения считаются и в метриках-счётчиках
+    token_cache_lookups_total{result} и token_cache_evictions_total.
+    """
+    
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def load(self, token_address):
+        """Читает запись из таблицы token_cache (второй уровень)."""
+        row = get_db().execute(
+            "SELECT price, market_cap, price_change_24h, timestamp FROM token_cache WHERE token_address = ?",
+            (token_address,)
+        ).fetchone()
+        if row is None:
+            return None
+        price, market_cap, price_change_24h, timestamp = row
+        return {"data": {"price": price, "market_cap": market_cap, "price_change_24h": price_change_24h},
+                "timestamp": timestamp}
+    
+    def remember(self, token_address, entry):
+        """Кладёт запись в память, вытесняя самые давно использованные при переполнении."""
+        self.entries[token_address] = entry
+        self.entries.move_to_end(token_address)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+            metrics.inc("token_cache_evictions_total")
+    
+    def get(self, token_address, now=None):
+        """Возвращает свежую запись {"data", "timestamp"} или None, если её нет или она устарела."""
+        now = time.time() if now is None else now
+        entry = self.entries.get(token_address)
+        from_db = False
+        if entry is None:
+            entry = self.load(token_address)
+            from_db = entry is not None
+        if entry is None or now - entry["timestamp"] >= self.ttl:
+            self.entries.pop(token_address, None)
+            self.misses += 1
+            metrics.inc("token_cache_lookups_total", result="miss")
+            return None
+        
+        if from_db:
+            self.db_hits += 1
+            metrics.inc("token_cache_lookups_total", result="db_hit")
+        else:
+            self.hits += 1
+            metrics.inc("token_cache_lookups_total", result="hit")
+        self.remember(token_address, entry)
+        return entry
+    
+    def put(self, token_address, data, timestamp):
+        """Сохраняет данные токена в память и ставит их в очередь записи в базу."""
+        self.remember(token_address, {"data": data, "timestamp": timestamp})
+        state_writer.put("token_cache", (token_address,), (
+            token_address, data["price"], data["market_cap"], data["price_change_24h"], timestamp
+        ))
+    
+    def purge_stale(self, now=None):
+        """Удаляет устаревшие записи из памяти и из таблицы token_cache."""
+        now = time.time() if now is None else now
+        for token_address in [address for address, entry in self.entries.items() if now - entry["timestamp"] >= self.ttl]:
+            del self.entries[token_address]
+        state_writer.execute("DELETE FROM token_cache WHERE timestamp < ?", (now - self.ttl,))
+    
+    def stats(self):
+        """Счётчики попаданий, промахов и вытеснений."""
+        return {"size": len(self.entries), "hits": self.hits, "db_hits": self.db_hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+cache = TokenCache(CACHE_MAX_SIZE, CACHE_TIMEOUT)
+
+class PriceHistory:
+    """История цен токенов в таблице price_history для статистики без запросов к API.
+    
+    Каждая полученная цена записывается через очередь state_writer, но не чаще
+    одного сэмпла на токен за min_interval секунд. compact() прореживает старые
+    сэмплы и удаляет совсем старые, так что объём таблицы ограничен.
+    """
+    
+    def __init__(self, min_interval=HISTORY_MIN_INTERVAL):
+        self.min_interval = min_interval
+        self.last_recorded = {}
+    
+    def record(self, token_address, data, now):
+        """Добавляет сэмпл цены, если с предыдущего прошло не меньше min_interval."""
+        ts = int(now)
+        if ts - self.last_recorded.get(token_address, 0) < self.min_interval:
+            return
+        self.last_recorded[token_address] = ts
+        state_writer.put("price_history", (token_address, ts), (token_address, ts, data["price"], data["market_cap"]))
+    
+    def window_stats(self, token_address, since):
+        """Первая и последняя цена, минимум и максимум за время с since; None, если сэмплов меньше двух."""
+        conn = get_db()
+        low, high, samples = conn.execute(
+            "SELECT MIN(price), MAX(price), COUNT(*) FROM price_history WHERE token_address = ? AND ts >= ?",
+            (token_address, since)
+        ).fetchone()
+        if samples < 2:
+            return None
+        first = conn.execute(
+            "SELECT price FROM price_history WHERE token_address = ? AND ts >= ? ORDER BY ts LIMIT 1",
+            (token_address, since)
+        ).fetchone()[0]
+        last = conn.execute(
+            "SELECT price FROM price_history WHERE token_address = ? AND ts >= ? ORDER BY ts DESC LIMIT 1",
+            (token_address, since)
+        ).fetchone()[0]
+        return {"first": first, "last": last, "min": low, "max": high, "samples": samples}
+    
+    def latest(self, token_addresses):
+        """Последний записанный сэмпл {"price", "market_cap", "ts"} для каждого адреса, у которого он есть."""
+        token_addresses = list(token_addresses)
+        if not token_addresses:
+            return {}
+        placeholders = ",".join("?" * len(token_addresses))
+        # SQLite берёт остальные столбцы из строки с MAX(ts)
+        rows = get_db().execute(
+            f"SELECT token_address, price, market_cap, MAX(ts) FROM price_history "
+            f"WHERE token_address IN ({placeholders}) GROUP BY token_address",
+            token_addresses
+        ).fetchall()
+        return {token_address: {"price": price, "market_cap": market_cap, "ts": ts}
+                for token_address, price, market_cap, ts in rows}
+    
+    def compact(self, now=None):
+        """Оставляет один сэмпл на интервал прореживания для старых данных и удаляет данные старше срока хранения."""
+        now = time.time() if now is None else now
+        state_writer.execute(
+            """DELETE FROM price_history
+               WHERE ts < ? AND EXISTS (
+                   SELECT 1 FROM price_history AS earlier
+                   WHERE earlier.token_address = price_history.token_address
+                     AND earlier.ts < price_history.ts
+                     AND earlier.ts >= price_history.ts - price_history.ts % ?)""",
+            (int(now - HISTORY_RAW_RETENTION), HISTORY_DOWNSAMPLE_BUCKET)
         )
-    conn.commit()
-    conn.close()
+        state_writer.execute("DELETE FROM price_history WHERE ts < ?", (int(now - HISTORY_RETENTION),))
+        # Отметки о последней записи нужны только для недавно записанных токенов
+        cutoff = now - self.min_interval
+        self.last_recorded = {token_address: ts for token_address, ts in self.last_recorded.items() if ts >= cutoff}
 
-def get_token_price(token_address):
-    """Получение данных о токене с кэшированием из базы данных."""
-    current_time = time.time()
-    if token_address in cache and (current_time - cache[token_address]["timestamp"]) < CACHE_TIMEOUT:
-        return cache[token_address]["data"]
-    
-    session = requests.Session()
-    retry_strategy = Retry(
-        total=3,  # Количество попыток
-        backoff_factor=1,  # Задержка между попытками (1 сек, 2 сек, 4 сек)
-        status_forcelist=[429, 500, 502, 503, 504],  # Коды ошибок для повторных попыток
+price_history = PriceHistory()
+
+async def compact_price_history(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически прореживает и обрезает историю цен."""
+    price_history.compact()
+
+async def purge_cache(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически чистит устаревшие записи кэша."""
+    cache.purge_stale()
+    logger.info("Кэш токенов: %s", cache.stats())
+
+class ConversationStore(BasePersistence):
+    """Состояние диалогов /add и /edit по ключу (имя диалога, chat_id, user_id).
+    
+    Хранит и шаг ConversationHandler (как слой persistence приложения), и данные, собранные
+    на прошлых шагах. Обе части сохраняются одной строкой таблицы conversations через
+    state_writer, так что незаконченный диалог переживает перезапуск. Диалоги без
+    активности дольше ttl секунд считаются брошенными и удаляются.
+    """
+    
+    def __init__(self, ttl):
+        # Данные пользователей, чатов и бота приложение не хранит — только шаги диалогов
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=FLUSH_INTERVAL,
+        )
+        self.ttl = ttl
+        self.entries = {}  # (name, chat_id, user_id) -> {"state", "data", "updated"}
+    
+    @staticmethod
+    def key(name, update):
+        return (name, update.effective_chat.id, update.effective_user.id)
+    
+    def load(self):
+        """Читает из базы диалоги, брошенные не раньше ttl секунд назад."""
+        rows = get_db().execute("SELECT name, chat_id, user_id, state, data, updated FROM conversations WHERE updated >= ?",
+                                (time.time() - self.ttl,))
+        for name, chat_id, user_id, state, data, updated in rows:
+            self.entries[(name, chat_id, user_id)] = {"state": state, "data": json.loads(data), "updated": updated}
+    
+    def save(self, key):
+        entry = self.entries.get(key)
+        row = None
+        if entry is not None:
+            row = (*key, entry["state"], json.dumps(entry["data"]), entry["updated"])
+        state_writer.put("conversations", key, row)
+    
+    def get(self, name, update):
+        """Данные диалога пользователя в этом чате или None, если диалога нет или он брошен."""
+        entry = self.entries.get(self.key(name, update))
+        if entry is None or not entry["data"] or time.time() - entry["updated"] > self.ttl:
+            return None
+        return entry["data"]
+    
+    def set(self, name, update, data):
+        key = self.key(name, update)
+        entry = self.entries.setdefault(key, {"state": None})
+        entry["data"] = data
+        entry["updated"] = time.time()
+        self.save(key)
+    
+    def discard(self, name, update):
+        if self.entries.pop(self.key(name, update), None) is not None:
+            self.save(self.key(name, update))
+    
+    def expire(self, now=None):
+        """Удаляет брошенные диалоги; возвращает их число."""
+        cutoff = (time.time() if now is None else now) - self.ttl
+        stale = [key for key, entry in self.entries.items() if entry["updated"] < cutoff]
+        for key in stale:
+            del self.entries[key]
+            self.save(key)
+        return len(stale)
+    
+    async def get_conversations(self, name):
+        return {(chat_id, user_id): entry["state"]
+                for (entry_name, chat_id, user_id), entry in self.entries.items()
+                if entry_name == name and entry["state"] is not None}
+    
+    async def update_conversation(self, name, key, new_state):
+        full_key = (name, *key)
+        if new_state is None:
+            # Диалог завершён или сброшен по таймауту: его данные больше не нужны
+            if self.entries.pop(full_key, None) is not None:
+                self.save(full_key)
+            return
+        entry = self.entries.setdefault(full_key, {"data": {}})
+        entry["state"] = new_state
+        entry["updated"] = time.time()
+        self.save(full_key)
+    
+    async def get_user_data(self):
+        return {}
+    
+    async def get_chat_data(self):
+        return {}
+    
+    async def get_bot_data(self):
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_user_data(self, user_id, data):
+        pass
+    
+    async def update_chat_data(self, chat_id, data):
+        pass
+    
+    async def update_bot_data(self, data):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id):
+        pass
+    
+    async def drop_user_data(self, user_id):
+        pass
+    
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+    
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+    
+    async def refresh_bot_data(self, bot_data):
+        pass
+    
+    async def flush(self):
+        # Запись идёт через state_writer, который сбрасывается при остановке бота
+        pass
+
+conversations = ConversationStore(CONVERSATION_TIMEOUT)
+
+async def expire_conversations(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически удаляет брошенные диалоги, чтобы их число в памяти не росло."""
+    conversations.expire()
+
+async def conversation_expired(update: Update):
+    await update.message.reply_text(
+        "⌛ Диалог устарел. Начните заново с <b>/add</b> или <b>/edit</b>.",
+        parse_mode="HTML"
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    session.mount("https://", adapter)
+    return ConversationHandler.END
+
+def chunk_error(token_addresses, error):
+    """Возвращает одну и ту же ошибку для всех адресов пачки."""
+    return {token_address: {"error": error} for token_address in token_addresses}
+
+class PriceSource(ABC):
+    """Источник цен: строит URL запроса для пачки адресов и разбирает ответ.
     
+    Источник ведёт скользящее окно задержек своих запросов, по которому fetch_chunk()
+    решает, когда страховаться вторым источником. После failure_threshold сбоев
+    подряд источник на cooldown секунд выводится из ротации.
+    """
+    
+    name = None
+    title = None
+    
+    def __init__(self, failure_threshold=SOURCE_FAILURE_THRESHOLD, cooldown=SOURCE_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.latencies = deque(maxlen=SOURCE_LATENCY_WINDOW)
+        self.failures = 0
+        self.down_until = 0
+    
+    @abstractmethod
+    def url(self, token_addresses):
+        """URL запроса пачки адресов."""
+    
+    @abstractmethod
+    def parse(self, data, token_addresses):
+        """Разбирает JSON ответа в словарь адрес -> данные токена или ошибка."""
+    
+    def healthy(self, now=None):
+        return (time.monotonic() if now is None else now) >= self.down_until
+    
+    def hedge_delay(self):
+        """Сколько ждать ответа, прежде чем отправить тот же запрос следующему источнику."""
+        if len(self.latencies) < SOURCE_MIN_SAMPLES:
+            return HEDGE_MAX_DELAY
+        ordered = sorted(self.latencies)
+        p95 = ordered[min(int(len(ordered) * HEDGE_PERCENTILE), len(ordered) - 1)]
+        return min(max(p95, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+    
+    def record(self, seconds, failed):
+        self.latencies.append(seconds)
+        if not failed:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.down_until = time.monotonic() + self.cooldown
+            self.failures = 0
+            logger.warning(f"Источник цен {self.name} выведен из ротации на {self.cooldown} с")
+    
+    async def fetch(self, token_addresses):
+        """Запрашивает пачку адресов; возвращает результаты и признак успешного ответа."""
+        started = time.monotonic()
+        failed = True
+        try:
+            response = await request_with_retry(self.url(token_addresses), self.name)
+            if response.status_code != 200:
+                metrics.inc("upstream_errors_total", source=self.name, kind=f"http_{response.status_code}")
+                return chunk_error(token_addresses, f"Ошибка API: {response.status_code}"), False
+            data = response.json()
+            # Проверка на None или некорректный формат данных
+            if data is None or not isinstance(data, dict):
+                metrics.inc("upstream_errors_total", source=self.name, kind="bad_response")
+                return chunk_error(token_addresses, "Неверный формат ответа от API"), False
+            results = self.parse(data, token_addresses)
+            failed = False
+            return results, True
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            metrics.inc("upstream_errors_total", source=self.name, kind="timeout")
+            return chunk_error(token_addresses, f"Тайм-аут соединения с API {self.title}"), False
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            metrics.inc("upstream_errors_total", source=self.name, kind="bad_response")
+            return chunk_error(token_addresses, f"Неверный адрес токена или ошибка данных: {str(e)}"), False
+        except Exception as e:
+            metrics.inc("upstream_errors_total", source=self.name, kind=type(e).__name__)
+            return chunk_error(token_addresses, f"Ошибка: {str(e)}"), False
+        except asyncio.CancelledError:
+            # Запрос отменён, потому что раньше ответил другой источник: это не сбой
+            failed = False
+            raise
+        finally:
+            # Задержку отменённого запроса тоже учитываем: настоящая была не меньше замеренной
+            self.record(time.monotonic() - started, failed)
+    
+    def token_results(self, found, token_addresses, parse_one):
+        """Раскладывает найденные записи по адресам пачки; для отсутствующих — ошибка «не найден»."""
+        results = {}
+        for token_address in token_addresses:
+            if token_address not in found:
+                metrics.inc("upstream_errors_total", source=self.name, kind="not_found")
+                results[token_address] = {"error": f"Токен не найден на {self.title}"}
+                continue
+            try:
+                results[token_address] = parse_one(found[token_address])
+            except (ValueError, KeyError, TypeError) as e:
+                metrics.inc("upstream_errors_total", source=self.name, kind="bad_pair")
+                results[token_address] = {"error": f"Неверный адрес токена или ошибка данных: {str(e)}"}
+        return results
+
+def liquidity_rank(liquidity, pair_id):
+    """Ключ выбора пары: самая ликвидная, при равной ликвидности — по идентификатору пары."""
     try:
-        url = f"https://api.dexscreener.com/latest/dex/tokens/{token_address}"
-        response = session.get(url, timeout=15)
-        
-        if response.status_code != 200:
-            return {"error": f"Ошибка API: {response.status_code}"}
-        
-        data = response.json()
+        liquidity = float(liquidity or 0)
+    except (TypeError, ValueError):
+        liquidity = 0.0
+    return (liquidity, pair_id or "")
+
+class DexscreenerSource(PriceSource):
+    name = "dexscreener"
+    title = "Dexscreener"
+    
+    def url(self, token_addresses):
+        return DEXSCREENER_TOKENS_URL + ",".join(token_addresses)
+    
+    def parse(self, data, token_addresses):
+        # Для каждого токена берём самую ликвидную пару, где он базовый, независимо от порядка ответа
+        wanted = set(token_addresses)
+        pairs_by_token = {}
+        for pair in data.get("pairs") or []:
+            base_address = (pair.get("baseToken") or {}).get("address")
+            if base_address not in wanted:
+                continue
+            best = pairs_by_token.get(base_address)
+            rank = liquidity_rank((pair.get("liquidity") or {}).get("usd"), pair.get("pairAddress"))
+            if best is None or rank > best[0]:
+                pairs_by_token[base_address] = (rank, pair)
+        found = {token_address: pair for token_address, (_, pair) in pairs_by_token.items()}
+        return self.token_results(found, token_addresses, parse_pair)
+
+def parse_pair(pair):
+    """Извлекает цену, Market Cap и изменение за 24ч из пары Dexscreener."""
+    price_usd = float(pair["priceUsd"])
+    market_cap = float(pair["fdv"])
+    price_change_24h = (pair.get("priceChange") or {}).get("h24", "N/A")
+    if price_change_24h != "N/A":
+        price_change_24h = float(price_change_24h)
+    return {"price": price_usd, "market_cap": market_cap, "price_change_24h": price_change_24h}
+
+class GeckoTerminalSource(PriceSource):
+    name = "geckoterminal"
+    title = "GeckoTerminal"
+    
+    def url(self, token_addresses):
+        return GECKOTERMINAL_TOKENS_URL + ",".join(token_addresses) + "?include=top_pools"
+    
+    def parse(self, data, token_addresses):
+        # Изменение за 24ч есть только у пулов: берём самый ликвидный из top_pools токена
+        pools = {item.get("id"): item.get("attributes") or {}
+                 for item in data.get("included") or [] if item.get("type") == "pool"}
+        wanted = set(token_addresses)
+        found = {}
+        for item in data.get("data") or []:
+            attributes = item.get("attributes") or {}
+            token_address = attributes.get("address")
+            if token_address not in wanted:
+                continue
+            top_pools = [(pool["id"], pools[pool["id"]])
+                         for pool in ((item.get("relationships") or {}).get("top_pools") or {}).get("data") or []
+                         if pool.get("id") in pools]
+            pool = max(top_pools, key=lambda pool: liquidity_rank(pool[1].get("reserve_in_usd"), pool[0]), default=None)
+            found[token_address] = (attributes, pool[1] if pool else {})
+        return self.token_results(found, token_addresses, parse_gecko_token)
+
+def parse_gecko_token(entry):
+    """Извлекает цену, Market Cap и изменение за 24ч из токена GeckoTerminal и его основного пула."""
+    attributes, pool = entry
+    price_usd = float(attributes["price_usd"])
+    market_cap = float(attributes.get("fdv_usd") or attributes["market_cap_usd"])
+    price_change_24h = (pool.get("price_change_percentage") or {}).get("h24", "N/A")
+    if price_change_24h != "N/A":
+        price_change_24h = float(price_change_24h)
+    return {"price": price_usd, "market_cap": market_cap, "price_change_24h": price_change_24h}
+
+PRICE_SOURCE_TYPES = {source.name: source for source in (DexscreenerSource, GeckoTerminalSource)}
+
+def build_price_sources(names):
+    unknown = [name for name in names if name not in PRICE_SOURCE_TYPES]
+    if unknown or not names:
+        raise ValueError(f"Неизвестные источники цен в PRICE_SOURCES: {', '.join(unknown) or '(пусто)'}")
+    return [PRICE_SOURCE_TYPES[name]() for name in names]
+
+price_sources = build_price_sources(PRICE_SOURCES)
+
+def retry_delay(response, attempt):
+    """Задержка перед повтором: значение Retry-After, если сервер его прислал, иначе экспоненциальная."""
+    delay = RETRY_BACKOFF * 2 ** attempt  # 1 сек, 2 сек, 4 сек
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    return min(max(delay, 0), MAX_RETRY_DELAY)
+
+async def request_with_retry(url, source):
+    """GET-запрос через общий пул соединений с повторами при 429/5xx и сетевых ошибках.
+    
+    GET идемпотентен, поэтому повторяется при любой транспортной ошибке httpx: обрыве
+    соединения, сбое протокола или тайм-ауте клиента.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        # Семафор держим только на время самого запроса, а не во время ожидания перед повтором
+        async with request_semaphore:
+            try:
+                with metrics.timer("upstream_request_seconds", source=source):
+                    response = await asyncio.wait_for(http_client.get(url), REQUEST_DEADLINE)
+                metrics.inc("upstream_requests_total", source=source, status=response.status_code)
+            except httpx.TransportError:
+                if attempt == MAX_RETRIES:
+                    raise
+        if response is not None and (response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES):
+            return response
+        await asyncio.sleep(retry_delay(response, attempt))
+
+async def fetch_chunk(token_addresses):
+    """Запрашивает пачку адресов (не более MAX_ADDRESSES_PER_REQUEST) у источников цен.
+    
+    Запрос уходит самому приоритетному здоровому источнику. Если тот не ответил за свою
+    hedge_delay() или ответил сбоем, тот же запрос отправляется следующему. Результаты
+    сводятся по токенам: данные токена от любого источника важнее ошибки. Ответ основного
+    источника окончателен, а ответ страховочного — только если в нём нашлись все токены:
+    иначе ждём основной, ведь новый токен может быть только у него. Остальные запросы
+    отменяются. Страховочные запросы уходят только на самых медленных ~5% запросов,
+    так что нагрузка на API растёт ограниченно.
+    """
+    now = time.monotonic()
+    # Нездоровые источники остаются в конце очереди на случай, если откажут все
+    candidates = sorted(price_sources, key=lambda source: not source.healthy(now))
+    primary = candidates[0]
+    backups = iter(candidates[1:])
+    tasks = {asyncio.create_task(primary.fetch(token_addresses)): primary}
+    delay = primary.hedge_delay()
+    results = {}
+    
+    def unresolved():
+        return [token_address for token_address in token_addresses if "error" in results[token_address]]
+    
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                # Источник медлит: страхуемся следующим, дальше ждём любой из двух ответов
+                delay = None
+                backup = next(backups, None)
+                if backup is not None:
+                    metrics.inc("hedged_requests_total", source=backup.name)
+                    tasks[asyncio.create_task(backup.fetch(token_addresses))] = backup
+                continue
+            for task in done:
+                source = tasks.pop(task)
+                answer, ok = task.result()
+                for token_address, result in answer.items():
+                    if "error" not in result or "error" in results.get(token_address, result):
+                        results[token_address] = result
+                if ok and (source is primary or not unresolved()):
+                    return results
+            if not tasks:
+                # Все запрошенные источники ответили сбоем или не нашли часть токенов:
+                # недостающие спрашиваем у следующего
+                backup = next(backups, None)
+                if backup is not None:
+                    metrics.inc("source_failovers_total", source=backup.name)
+                    tasks[asyncio.create_task(backup.fetch(unresolved()))] = backup
+                    delay = backup.hedge_delay()
+        return results
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def get_cached_prices(token_addresses, current_time, max_age=CACHE_TIMEOUT):
+    """Делит адреса (без дубликатов) на найденные в кэше не старше max_age секунд и отсутствующие.
+    
+    Третьим значением возвращает адреса из кэша, которые пора обновить заранее.
+    """
+    results = {}
+    missing = []
+    refresh = []
+    for token_address in dict.fromkeys(token_addresses):
+        entry = cache.get(token_address, current_time)
+        if entry is not None and current_time - entry["timestamp"] < max_age:
+            results[token_address] = entry["data"]
+            if current_time - entry["timestamp"] >= CACHE_TIMEOUT * CACHE_REFRESH_AHEAD:
+                refresh.append(token_address)
+        else:
+            missing.append(token_address)
+    metrics.inc("cache_hits_total", len(results))
+    metrics.inc("cache_misses_total", len(missing))
+    return results, missing, refresh
+
+async def fetch_and_publish(token_addresses):
+    """Запрашивает пачку адресов, кладёт данные в кэш и отдаёт результат всем ожидающим."""
+    fetched = {}
+    try:
+        fetched = await fetch_chunk(token_addresses)
+    finally:
+        # Ожидающие получают результат даже при отмене задачи, иначе они зависнут навсегда
+        current_time = time.time()
+        for token_address in token_addresses:
+            result = fetched.get(token_address, {"error": "Нет ответа от API"})
+            if "error" not in result:
+                cache.put(token_address, result, current_time)
+                price_history.record(token_address, result, current_time)
+            future = inflight.pop(token_address, None)
+            if future is not None and not future.done():
+                future.set_result(result)
+
+def start_fetch(token_addresses):
+    """Запускает запросы для адресов, которые ещё никто не запрашивает (single-flight).
+    
+    Возвращает future для каждого адреса: новые запросы и уже выполняющиеся
+    обслуживаются одинаково, так что на один адрес уходит один запрос к API.
+    """
+    loop = asyncio.get_running_loop()
+    new = [token_address for token_address in dict.fromkeys(token_addresses) if token_address not in inflight]
+    for token_address in new:
+        inflight[token_address] = loop.create_future()
+    for i in range(0, len(new), MAX_ADDRESSES_PER_REQUEST):
+        # Запрос живёт в отдельной задаче, чтобы отмена одного ожидающего не затрагивала остальных
+        task = asyncio.create_task(fetch_and_publish(new[i:i + MAX_ADDRESSES_PER_REQUEST]))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return {token_address: inflight[token_address] for token_address in token_addresses}
+
+async def async_fetch_token_prices(token_addresses, max_age=CACHE_TIMEOUT):
+    """Пакетное получение данных о токенах с кэшированием.
+    
+    Убирает дубликаты, отдаёт свежие данные из кэша, а остальные адреса
+    запрашивает пачками по MAX_ADDRESSES_PER_REQUEST параллельно, не блокируя
+    цикл событий. Одновременные запросы одного адреса объединяются, а записи,
+    близкие к истечению, обновляются в фоне. Возвращает словарь адрес -> результат
+    в том же формате, что и async_get_token_price. max_age позволяет потребовать
+    данные свежее, чем CACHE_TIMEOUT.
+    """
+    current_time = time.time()
+    results, missing, refresh = get_cached_prices(token_addresses, current_time, max_age)
+    if refresh:
+        start_fetch(refresh)
+    if not missing:
+        return results
+    
+    futures = start_fetch(missing)
+    # shield: отмена вызывающего не должна отменять общий для всех future
+    for token_address, result in zip(futures, await asyncio.gather(*(asyncio.shield(future) for future in futures.values()))):
+        results[token_address] = result
+    return results
+
+async def async_get_token_price(token_address):
+    """Получение данных о токене с кэшированием из базы данных."""
+    return (await async_fetch_token_prices([token_address]))[token_address]
+
+class TokenBucket:
+    """Token bucket: rate разрешений в секунду с запасом не больше capacity."""
+    
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now):
+        """Сколько секунд осталось до появления свободного разрешения."""
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def consume(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+class MessageDispatcher:
+    """Очередь исходящих сообщений с учётом лимитов Telegram.
+    
+    Сообщения отправляются одной фоновой задачей по приоритету (оповещения
+    раньше уведомлений об ошибках) через общий token bucket и отдельный bucket
+    на каждый чат. Сообщения чата, упёршегося в свой лимит, откладываются и не
+    задерживают остальные чаты. Оповещения одного чата, накопленные за цикл
+    проверки, склеиваются в одно сообщение в flush_alerts().
+    """
+    
+    def __init__(self, bot, global_rate=GLOBAL_SEND_RATE, chat_rate=CHAT_SEND_RATE):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}
+        self.heap = []
+        self.deferred = []
+        self.pending_alerts = {}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+    
+    def send(self, chat_id, text, priority=PRIORITY_NOTICE, **kwargs):
+        """Ставит сообщение в очередь на отправку и сразу возвращает управление."""
+        heapq.heappush(self.heap, (priority, next(self.counter), chat_id, text, kwargs))
+        self.wakeup.set()
+    
+    def add_alert(self, chat_id, text):
+        """Копит оповещение чата до конца текущего цикла проверки."""
+        self.pending_alerts.setdefault(chat_id, []).append(text)
+    
+    def flush_alerts(self):
+        """Склеивает накопленные оповещения каждого чата в минимум сообщений и ставит их в очередь."""
+        pending, self.pending_alerts = self.pending_alerts, {}
+        for chat_id, texts in pending.items():
+            message = ""
+            for text in texts:
+                if message and len(message) + 2 + len(text) > MAX_MESSAGE_LENGTH:
+                    self.send(chat_id, message, PRIORITY_ALERT, parse_mode="HTML", disable_web_page_preview=True)
+                    message = ""
+                message = f"{message}\n\n{text}" if message else text
+            if message:
+                self.send(chat_id, message, PRIORITY_ALERT, parse_mode="HTML", disable_web_page_preview=True)
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self, timeout=10):
+        """Даёт очереди до timeout секунд на отправку оставшихся сообщений и останавливает задачу."""
+        self.flush_alerts()
+        deadline = time.monotonic() + timeout
+        while (self.heap or self.deferred) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+    
+    def next_item(self, now):
+        """Возвращает следующее сообщение, которое можно отправить сейчас, или время ожидания."""
+        # Возвращаем в очередь отложенные сообщения, чей чат снова может принимать сообщения
+        ready = [item for ready_at, item in self.deferred if ready_at <= now]
+        self.deferred = [(ready_at, item) for ready_at, item in self.deferred if ready_at > now]
+        for item in ready:
+            heapq.heappush(self.heap, item)
         
-        # Проверка на None или некорректный формат данных
-        if data is None or not isinstance(data, dict):
-            return {"error": "Неверный формат ответа от API"}
+        while self.heap:
+            item = heapq.heappop(self.heap)
+            chat_id = item[2]
+            bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(self.chat_rate))
+            wait = bucket.wait_time(now)
+            if wait <= 0:
+                return item, 0
+            self.deferred.append((now + wait, item))
+        return None, min((ready_at for ready_at, _ in self.deferred), default=now + 60) - now
+    
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            item, wait = self.next_item(now)
+            if item is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            await asyncio.sleep(self.global_bucket.wait_time(now))
+            now = time.monotonic()
+            self.global_bucket.consume(now)
+            priority, seq, chat_id, text, kwargs = item
+            self.chat_buckets[chat_id].consume(now)
+            try:
+                with metrics.timer("telegram_send_seconds"):
+                    await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                metrics.inc("messages_sent_total", priority=priority)
+            except RetryAfter as e:
+                metrics.inc("telegram_flood_waits_total")
+                # Telegram сообщил о флуде: выдерживаем паузу и повторяем то же сообщение
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                heapq.heappush(self.heap, item)
+                await asyncio.sleep(retry_after)
+            except TelegramError:
+                metrics.inc("messages_failed_total", priority=priority)
+                logger.exception("Не удалось отправить сообщение в чат %s", chat_id)
+            
+            # Забываем bucket'ы чатов, которые давно ничего не получали
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {
+                    bucket_chat: bucket for bucket_chat, bucket in self.chat_buckets.items()
+                    if bucket.wait_time(now) > 0
+                }
+
+class ErrorAggregator:
+    """Сводит сбои запросов в периодические сводки и подавляет повторные уведомления.
+    
+    Сбои копятся по паре (текст ошибки, токен) и раз в окно отправляются
+    администратору одной сводкой. Пользовательские уведомления о недоступности
+    токена подавляются с экспоненциально растущим периодом, пока сбой не пройдёт.
+    """
+    
+    def __init__(self, base_backoff=ERROR_NOTICE_BACKOFF, max_backoff=MAX_ERROR_NOTICE_BACKOFF):
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.failures = {}
+        self.window_started = time.time()
+        self.suppressed = {}
+    
+    def record(self, error, token_address):
+        """Учитывает сбой для следующей сводки администратору."""
+        key = (error, token_address)
+        self.failures[key] = self.failures.get(key, 0) + 1
+    
+    def should_notify(self, chat_id, token_address, now=None):
+        """Разрешает уведомить чат о сбое токена, если период подавления истёк, и удваивает период."""
+        now = time.time() if now is None else now
+        token_state = self.suppressed.setdefault(token_address, {})
+        next_allowed, streak = token_state.get(chat_id, (0, 0))
+        if now < next_allowed:
+            return False
+        token_state[chat_id] = (now + min(self.base_backoff * 2 ** streak, self.max_backoff), streak + 1)
+        return True
+    
+    def clear(self, token_address):
+        """Сбрасывает подавление уведомлений после успешного запроса токена."""
+        self.suppressed.pop(token_address, None)
+    
+    def summary(self):
+        """Возвращает текст сводки сбоев за окно (или None, если сбоев не было) и начинает новое окно."""
+        failures, self.failures = self.failures, {}
+        started, self.window_started = self.window_started, time.time()
+        if not failures:
+            return None
         
-        if "pairs" not in data or not data["pairs"] or len(data["pairs"]) == 0:
-            return {"error": "Токен не найден на Dexscreener"}
+        by_error = {}
+        for (error, token_address), count in failures.items():
+            by_error.setdefault(error, []).append((count, token_address))
         
-        pair = data["pairs"][0]
-        price_usd = float(pair["priceUsd"])
-        market_cap = float(pair["fdv"])
-        price_change_24h = pair.get("priceChange", {}).get("h24", "N/A")
-        if price_change_24h != "N/A":
-            price_change_24h = float(price_change_24h)
-        result = {"price": price_usd, "market_cap": market_cap, "price_change_24h": price_change_24h}
-        cache[token_address] = {"data": result, "timestamp": current_time}
-        save_cache()
-        return result
-    
-    except requests.exceptions.ReadTimeout:
-        return {"error": "Тайм-аут соединения с API Dexscreener"}
-    except (ValueError, KeyError, TypeError) as e:
-        return {"error": f"Неверный адрес токена или ошибка данных: {str(e)}"}
-    except Exception as e:
-        return {"error": f"Ошибка: {str(e)}"}
+        minutes = max(1, round((self.window_started - started) / 60))
+        lines = [f"⚠️ <b>Сбои за последние {minutes} мин:</b>"]
+        for error, tokens in sorted(by_error.items(), key=lambda item: -sum(count for count, _ in item[1])):
+            total = sum(count for count, _ in tokens)
+            examples = ", ".join(f"<code>{html.escape(token_address)}</code>" for _, token_address in sorted(tokens, reverse=True)[:3])
+            more = f" и ещё {len(tokens) - 3}" if len(tokens) > 3 else ""
+            lines.append(f"• <i>{html.escape(error)}</i>: <b>{total}</b> раз, токенов: <b>{len(tokens)}</b> ({examples}{more})")
+        return "\n".join(lines)
 
-async def async_get_token_price(token_address):
-    """Асинхронная обёртка для get_token_price."""
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, get_token_price, token_address)
+error_aggregator = ErrorAggregator()
+
+async def send_error_summary(context: ContextTypes.DEFAULT_TYPE):
+    """Отправляет администратору сводку сбоев за прошедшее окно."""
+    text = error_aggregator.summary()
+    if ADMIN_CHAT_ID and text:
+        dispatcher.send(ADMIN_CHAT_ID, text, parse_mode="HTML")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -189,7 +1881,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "<b>/remove all</b> — очистить все отслеживаемые токены\n"
         "<b>/edit</b> <i>адрес_токена</i> — изменить процент отслеживания\n"
         "<b>/list</b> — показать список отслеживаемых токенов\n"
-        "<b>/stats</b> — показать статистику токенов",
+        "<b>/stats</b> [<i>1h|24h|7d</i>] — показать статистику токенов за период\n"
+        "<b>/import</b> — добавить сразу много токенов: строки <i>адрес, название, процент</i> "
+        "после команды или CSV/JSON-файл с подписью /import\n"
+        "<b>/export</b> [<i>json</i>] — выгрузить список токенов файлом",
         parse_mode="HTML"
     )
 
@@ -215,7 +1910,7 @@ async def add_token_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
     
     token_address = args[0]
-    result = get_token_price(token_address)
+    result = await async_get_token_price(token_address)
     
     if "error" in result:
         if "Неверный адрес токена" in result["error"]:
@@ -225,24 +1920,20 @@ async def add_token_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             await update.message.reply_text(
-                f"❌ Не удалось найти токен: <i>{result['error']}</i>",
-                parse_mode="HTML"
-            )
-        if ADMIN_CHAT_ID and "Тайм-аут" in result["error"]:
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=f"⚠️ Тайм-аут при запросе токена <code>{token_address}</code>",
+                f"❌ Не удалось найти токен: <i>{html.escape(result['error'])}</i>",
                 parse_mode="HTML"
             )
+        error_aggregator.record(result["error"], token_address)
         return ConversationHandler.END
     
-    temp_data["address"] = token_address
-    temp_data["price"] = result["price"]
-    temp_data["market_cap"] = result["market_cap"]
-    temp_data["chat_id"] = chat_id
+    conversations.set(ADD_CONVERSATION, update, {
+        "address": token_address,
+        "price": result["price"],
+        "market_cap": result["market_cap"],
+    })
     
     await update.message.reply_text(
-        f"✅ Токен с адресом <code>{token_address}</code> найден.\n"
+        f"✅ Токен с адресом <code>{html.escape(token_address)}</code> найден.\n"
         f"Текущая цена: <b>{format_number(result['price'], is_price=True)}</b>\n"
         f"Текущий Market Cap: <b>{format_number(result['market_cap'])}</b>\n"
         "Пожалуйста, введите <b>название токена</b>:",
@@ -251,17 +1942,24 @@ async def add_token_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return NAME
 
 async def add_token_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    flow = conversations.get(ADD_CONVERSATION, update)
+    if flow is None:
+        return await conversation_expired(update)
     token_name = update.message.text.strip()
-    temp_data["name"] = token_name
+    flow["name"] = token_name
+    conversations.set(ADD_CONVERSATION, update, flow)
     
     await update.message.reply_text(
-        f"✅ Название <b>{token_name}</b> принято.\n"
+        f"✅ Название <b>{html.escape(token_name)}</b> принято.\n"
         "Пожалуйста, введите <b>процент изменения цены</b> (от 1 до 1000):",
         parse_mode="HTML"
     )
     return PERCENT
 
 async def add_token_percent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    flow = conversations.get(ADD_CONVERSATION, update)
+    if flow is None:
+        return await conversation_expired(update)
     percent_str = update.message.text.strip()
     try:
         percent = float(percent_str)
@@ -278,22 +1976,21 @@ async def add_token_percent(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return PERCENT
     
-    token_address = temp_data["address"]
-    chat_id = temp_data["chat_id"]
-    tracked_tokens[chat_id][token_address] = {
-        "last_price": temp_data["price"],
+    token_address = flow["address"]
+    chat_id = update.effective_chat.id
+    set_tracked_token(chat_id, token_address, {
+        "last_price": flow["price"],
         "percent": percent,
-        "last_market_cap": temp_data["market_cap"],
-        "name": temp_data["name"]
-    }
-    save_tracked_tokens()
+        "last_market_cap": flow["market_cap"],
+        "name": flow["name"]
+    })
     
     await update.message.reply_text(
-        f"✅ Токен <b>{temp_data['name']}</b> (<code>{token_address}</code>) добавлен.\n"
+        f"✅ Токен <b>{html.escape(flow['name'])}</b> (<code>{html.escape(token_address)}</code>) добавлен.\n"
         f"Оповещение при изменении на <b>{percent}%</b>",
         parse_mode="HTML"
     )
-    temp_data.clear()
+    conversations.discard(ADD_CONVERSATION, update)
     return ConversationHandler.END
 
 async def edit_token_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -313,18 +2010,17 @@ async def edit_token_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     token_address = args[0]
     if token_address not in tracked_tokens[chat_id]:
         await update.message.reply_text(
-            f"❌ Токен с адресом <code>{token_address}</code> не найден в вашем списке отслеживания",
+            f"❌ Токен с адресом <code>{html.escape(token_address)}</code> не найден в вашем списке отслеживания",
             parse_mode="HTML"
         )
         return ConversationHandler.END
     
-    temp_data["address"] = token_address
-    temp_data["chat_id"] = chat_id
+    conversations.set(EDIT_CONVERSATION, update, {"address": token_address})
     current_percent = tracked_tokens[chat_id][token_address]["percent"]
     token_name = tracked_tokens[chat_id][token_address]["name"]
     
     await update.message.reply_text(
-        f"✅ Токен <b>{token_name}</b> (<code>{token_address}</code>) найден.\n"
+        f"✅ Токен <b>{html.escape(token_name)}</b> (<code>{html.escape(token_address)}</code>) найден.\n"
         f"Текущий процент отслеживания: <b>{current_percent}%</b>\n"
         "На какой процент изменить (от 1 до 1000)?",
         parse_mode="HTML"
@@ -332,6 +2028,9 @@ async def edit_token_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return EDIT_PERCENT
 
 async def edit_token_percent(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    flow = conversations.get(EDIT_CONVERSATION, update)
+    if flow is None:
+        return await conversation_expired(update)
     percent_str = update.message.text.strip()
     try:
         percent = float(percent_str)
@@ -348,22 +2047,29 @@ async def edit_token_percent(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return EDIT_PERCENT
     
-    token_address = temp_data["address"]
-    chat_id = temp_data["chat_id"]
-    token_name = tracked_tokens[chat_id][token_address]["name"]
-    tracked_tokens[chat_id][token_address]["percent"] = percent
-    save_tracked_tokens()
+    token_address = flow["address"]
+    chat_id = update.effective_chat.id
+    conversations.discard(EDIT_CONVERSATION, update)
+    # Токен могли удалить командой /remove, пока шёл диалог
+    data = tracked_tokens.get(chat_id, {}).get(token_address)
+    if data is None:
+        await update.message.reply_text(
+            f"❌ Токен с адресом <code>{html.escape(token_address)}</code> не найден в вашем списке отслеживания",
+            parse_mode="HTML"
+        )
+        return ConversationHandler.END
+    update_tracked_token(chat_id, token_address, percent=percent)
     
     await update.message.reply_text(
-        f"✅ Процент отслеживания для токена <b>{token_name}</b> (<code>{token_address}</code>) изменён на <b>{percent}%</b>",
+        f"✅ Процент отслеживания для токена <b>{html.escape(data['name'])}</b> (<code>{html.escape(token_address)}</code>) изменён на <b>{percent}%</b>",
         parse_mode="HTML"
     )
-    temp_data.clear()
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Добавление или редактирование токена <b>отменено</b>.", parse_mode="HTML")
-    temp_data.clear()
+    conversations.discard(ADD_CONVERSATION, update)
+    conversations.discard(EDIT_CONVERSATION, update)
     return ConversationHandler.END
 
 async def remove_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -382,8 +2088,8 @@ async def remove_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
     token_address = args[0]
     if token_address.lower() == "all":
         if tracked_tokens[chat_id]:
-            tracked_tokens[chat_id].clear()
-            save_tracked_tokens()
+            for tracked_address in list(tracked_tokens[chat_id]):
+                remove_tracked_token(chat_id, tracked_address)
             await update.message.reply_text(
                 "✅ Все отслеживаемые токены удалены.",
                 parse_mode="HTML"
@@ -395,10 +2101,9 @@ async def remove_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
     elif token_address in tracked_tokens[chat_id]:
         token_name = tracked_tokens[chat_id][token_address]["name"]
-        del tracked_tokens[chat_id][token_address]
-        save_tracked_tokens()
+        remove_tracked_token(chat_id, token_address)
         await update.message.reply_text(
-            f"✅ Токен <b>{token_name}</b> (<code>{token_address}</code>) удалён из отслеживания",
+            f"✅ Токен <b>{html.escape(token_name)}</b> (<code>{html.escape(token_address)}</code>) удалён из отслеживания",
             parse_mode="HTML"
         )
     else:
@@ -407,11 +2112,59 @@ async def remove_token(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="HTML"
         )
 
+def parse_window(text):
+    """Разбирает период вида 30m, 6h, 7d в секунды; None, если формат неверный."""
+    match = re.fullmatch(r"(\d+)([mhd])", text.strip().lower())
+    if not match:
+        return None
+    return int(match.group(1)) * {"m": 60, "h": 3600, "d": 86400}[match.group(2)]
+
+def format_window(seconds):
+    if seconds % 86400 == 0 and seconds > 86400:
+        return f"{seconds // 86400}д"
+    if seconds % 3600 == 0:
+        return f"{seconds // 3600}ч"
+    return f"{seconds // 60}мин"
+
+def render_stats(tokens, changes, ranges, window, loading=0):
+    """Текст ответа /stats; loading — сколько токенов ещё ждут данных от API."""
+    token_count = len(tokens)
+    avg_change = sum(changes.values()) / len(changes) if changes else 0
+    emoji_avg = "🟢" if avg_change > 0 else "🔴" if avg_change < 0 else ""
+    period = format_window(window)
+    
+    response = (f"📊 <b>Статистика:</b>\n"
+                f"Токенов отслеживается: <b>{token_count}</b>\n"
+                f"Среднее изменение за {period}: {emoji_avg} <b>{avg_change:.2f}%</b>")
+    if changes:
+        best = max(changes, key=changes.get)
+        worst = min(changes, key=changes.get)
+        response += (f"\nЛучший за {period}: <b>{html.escape(tokens[best]['name'])}</b> ({changes[best]:+.2f}%)\n"
+                     f"Худший за {period}: <b>{html.escape(tokens[worst]['name'])}</b> ({changes[worst]:+.2f}%)")
+    if ranges:
+        widest = max(ranges, key=ranges.get)
+        response += f"\nНаибольший размах (мин–макс): <b>{html.escape(tokens[widest]['name'])}</b> ({ranges[widest]:.2f}%)"
+    if changes:
+        response += f"\nЕсть данные по <b>{len(changes)}</b> из {token_count} токенов"
+    if loading:
+        response += f"\n⏳ <i>Загружаются данные ещё по {loading} токенам…</i>"
+    return response
+
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if chat_id not in tracked_tokens:
         tracked_tokens[chat_id] = {}
     
+    window = 24 * 3600
+    if context.args:
+        window = parse_window(context.args[0])
+        if window is None or not (0 < window <= HISTORY_RETENTION):
+            await update.message.reply_text(
+                "Используйте: <b>/stats</b> [<i>период</i>], например <b>/stats</b> <i>1h</i>, <i>24h</i> или <i>7d</i>",
+                parse_mode="HTML"
+            )
+            return
+    
     if not tracked_tokens[chat_id]:
         await update.message.reply_text(
             "📊 <b>Статистика:</b>\n"
@@ -420,125 +2173,1061 @@ async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    token_count = len(tracked_tokens[chat_id])
-    total_change_24h = 0
-    valid_tokens = 0
+    tokens = dict(tracked_tokens[chat_id])
+    changes = {}
+    ranges = {}
+    missing = []
     
-    # Асинхронно запрашиваем данные для всех токенов
-    tasks = [async_get_token_price(token) for token in tracked_tokens[chat_id]]
-    results = await asyncio.gather(*tasks)
+    # Считаем по локальной истории цен, без запросов к API
+    since = int(time.time() - window)
+    for token in tokens:
+        history = price_history.window_stats(token, since)
+        if history is not None and history["first"] > 0 and history["min"] > 0:
+            changes[token] = (history["last"] - history["first"]) / history["first"] * 100
+            ranges[token] = (history["max"] - history["min"]) / history["min"] * 100
+        elif window == 24 * 3600:
+            # Истории ещё мало — берём изменение за 24ч из последнего ответа Dexscreener
+            entry = cache.get(token)
+            if entry is None:
+                missing.append(token)
+            elif entry["data"]["price_change_24h"] != "N/A":
+                changes[token] = entry["data"]["price_change_24h"]
     
-    for result in results:
+    # Отвечаем сразу тем, что есть, а недостающие изменения за 24ч догружаем и дописываем правками
+    response = render_stats(tokens, changes, ranges, window, len(missing))
+    message = await update.message.reply_text(response, parse_mode="HTML")
+    if not missing:
+        return
+    
+    def on_result(token, result):
+        missing.remove(token)
         if "error" not in result and result["price_change_24h"] != "N/A":
-            total_change_24h += result["price_change_24h"]
-            valid_tokens += 1
+            changes[token] = result["price_change_24h"]
+    
+    # Правки идут отдельной задачей: пока обработчик не вернулся, ChatUpdateProcessor
+    # не пускает к обработке следующие команды этого чата
+    context.application.create_task(
+        edit_as_completed(MessageEditor(message, response), start_fetch(missing), on_result,
+                          lambda: (render_stats(tokens, changes, ranges, window, len(missing)), None)),
+        name=f"stats:{chat_id}")
+
+def parse_import_rows(text):
+    """Разбирает список токенов для /import: JSON или CSV со столбцами адрес, название, процент.
     
-    avg_change_24h = total_change_24h / valid_tokens if valid_tokens > 0 else 0
-    emoji_avg = "🟢" if avg_change_24h > 0 else "🔴" if avg_change_24h < 0 else ""
+    Название и процент необязательны. Строка без запятых, точек с запятой и табуляций
+    делится по пробелам: адрес, название, процент. Возвращает строки
+    (адрес, название или None, процент или None) и описания строк с ошибками.
+    """
+    text = text.strip()
+    items = []
+    if text.startswith(("[", "{")):
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            return [], [f"JSON: {html.escape(str(e))}"]
+        if isinstance(data, dict):
+            data = data.get("tokens") or []
+        for number, item in enumerate(data if isinstance(data, list) else [], 1):
+            if isinstance(item, str):
+                item = {"address": item}
+            elif isinstance(item, list):
+                item = dict(zip(("address", "name", "percent"), item))
+            if not isinstance(item, dict):
+                item = {}
+            items.append((number, item.get("address"), item.get("name"), item.get("percent")))
+    else:
+        for number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            delimiter = next((delimiter for delimiter in ",;\t" if delimiter in line), None)
+            if delimiter is not None:
+                cells = [cell.strip() for cell in next(csv.reader([line], delimiter=delimiter))]
+            else:
+                cells = line.split()
+                # Название может состоять из нескольких слов; процент — последнее слово, если это число
+                if len(cells) > 2:
+                    try:
+                        float(cells[-1])
+                        cells = [cells[0], " ".join(cells[1:-1]), cells[-1]]
+                    except ValueError:
+                        cells = [cells[0], " ".join(cells[1:])]
+            if cells[0].lower() in ("address", "адрес"):
+                continue
+            cells += [None] * (3 - len(cells))
+            items.append((number, *cells[:3]))
     
-    await update.message.reply_text(
-        f"📊 <b>Статистика:</b>\n"
-        f"Токенов отслеживается: <b>{token_count}</b>\n"
-        f"Среднее изменение за 24ч: {emoji_avg} <b>{avg_change_24h:.2f}%</b>",
-        parse_mode="HTML"
-    )
+    rows = []
+    errors = []
+    for number, address, name, percent in items:
+        address = str(address or "").strip()
+        if not address:
+            errors.append(f"строка {number}: нет адреса")
+            continue
+        if percent is not None and percent != "":
+            try:
+                percent = float(percent)
+            except (TypeError, ValueError):
+                errors.append(f"строка {number}: процент должен быть числом")
+                continue
+            if not (1 <= percent <= 1000):
+                errors.append(f"строка {number}: процент должен быть от 1 до 1000")
+                continue
+        else:
+            percent = None
+        rows.append((address, str(name).strip() if name else None, percent))
+    return rows, errors
 
-async def list_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def import_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    if chat_id not in tracked_tokens:
-        tracked_tokens[chat_id] = {}
+    message = update.message
+    if message.document is not None:
+        if (message.document.file_size or 0) > IMPORT_MAX_FILE_SIZE:
+            await message.reply_text(
+                f"❌ Файл больше <b>{IMPORT_MAX_FILE_SIZE // 1024} КБ</b>",
+                parse_mode="HTML"
+            )
+            return
+        file = await message.document.get_file()
+        text = bytes(await file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+    else:
+        parts = message.text.split(maxsplit=1)
+        text = parts[1] if len(parts) > 1 else ""
     
-    if not tracked_tokens[chat_id]:
-        await update.message.reply_text(
-            "📋 Ваш список токенов <b>пуст</b>",
+    rows, errors = parse_import_rows(text)
+    if not rows and not errors:
+        await message.reply_text(
+            "Используйте: <b>/import</b>, а со следующей строки — по токену на строку:\n"
+            "<i>адрес, название, процент</i>\n"
+            f"Название и процент можно не указывать (по умолчанию — {DEFAULT_IMPORT_PERCENT}%).\n"
+            "Можно также отправить CSV- или JSON-файл (например, из <b>/export</b>) с подписью <b>/import</b>.",
             parse_mode="HTML"
         )
         return
     
-    response = "📋 <b>Ваши отслеживаемые токены:</b>\n\n"
-    
-    # Асинхронно запрашиваем данные для всех токенов
-    tasks = [async_get_token_price(token) for token in tracked_tokens[chat_id]]
-    results = await asyncio.gather(*tasks)
-    
-    for token, data, result in zip(tracked_tokens[chat_id].keys(), tracked_tokens[chat_id].values(), results):
-        if "error" in result:
-            price_change_24h = "N/A"
-            emoji_24h = ""
-            price = "N/A"
-            market_cap = "N/A"
-            if ADMIN_CHAT_ID and "Тайм-аут" in result["error"]:
-                await context.bot.send_message(
-                    chat_id=ADMIN_CHAT_ID,
-                    text=f"⚠️ Тайм-аут при запросе токена <code>{token}</code> в /list",
-                    parse_mode="HTML"
-                )
+    # Повторяющиеся адреса: действует последняя строка. Новых токенов берём не больше, чем позволяет лимит
+    entries = {}
+    for address, name, percent in rows:
+        entries[address] = (name, percent)
+    tokens = tracked_tokens.setdefault(chat_id, {})
+    new_addresses = [address for address in entries if address not in tokens]
+    over_limit = new_addresses[max(MAX_TOKENS_PER_USER - len(tokens), 0):]
+    for address in over_limit:
+        del entries[address]
+    
+    # Все адреса проверяются одним пакетным запросом (до MAX_ADDRESSES_PER_REQUEST адресов на запрос к API)
+    prices = await async_fetch_token_prices(list(entries)) if entries else {}
+    
+    added = updated = 0
+    tokens = tracked_tokens.setdefault(chat_id, {})
+    # Все изменения импорта сохраняются в базу одной транзакцией
+    with state_writer.batch():
+        for address, (name, percent) in entries.items():
+            result = prices[address]
+            if "error" in result:
+                errors.append(f"<code>{html.escape(address)}</code>: {html.escape(result['error'])}")
+                continue
+            existing = tokens.get(address)
+            if existing is not None:
+                update_tracked_token(chat_id, address, name=name or existing["name"],
+                                     percent=existing["percent"] if percent is None else percent)
+                updated += 1
+            elif len(tokens) < MAX_TOKENS_PER_USER:
+                set_tracked_token(chat_id, address, {
+                    "last_price": result["price"],
+                    "percent": DEFAULT_IMPORT_PERCENT if percent is None else percent,
+                    "last_market_cap": result["market_cap"],
+                    "name": name or f"{address[:4]}…{address[-4:]}"
+                })
+                added += 1
+            else:
+                # Пока шёл запрос, токены могли добавить через /add
+                over_limit.append(address)
+    
+    response = f"📥 <b>Импорт завершён.</b> Добавлено: <b>{added}</b>, обновлено: <b>{updated}</b>"
+    if over_limit:
+        response += f"\nНе добавлено из-за лимита в {MAX_TOKENS_PER_USER} токенов: <b>{len(over_limit)}</b>"
+    if errors:
+        response += "\n\n❌ Пропущено:\n" + "\n".join(errors[:20])
+        if len(errors) > 20:
+            response += f"\n…и ещё {len(errors) - 20}"
+    await message.reply_text(response, parse_mode="HTML")
+
+async def export_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    tokens = dict(tracked_tokens.get(chat_id, {}))
+    if not tokens:
+        await update.message.reply_text("📋 Ваш список токенов <b>пуст</b>", parse_mode="HTML")
+        return
+    
+    # Формат файла совпадает с тем, что принимает /import
+    if context.args[:1] == ["json"]:
+        content = json.dumps([{"address": address, "name": data["name"], "percent": data["percent"]}
+                              for address, data in tokens.items()], ensure_ascii=False, indent=2)
+        filename = "tokens.json"
+    else:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["address", "name", "percent"])
+        writer.writerows((address, data["name"], f"{data['percent']:g}") for address, data in tokens.items())
+        content = buffer.getvalue()
+        filename = "tokens.csv"
+    await update.message.reply_document(
+        InputFile(io.BytesIO(content.encode("utf-8")), filename=filename),
+        caption=f"📤 Токенов: <b>{len(tokens)}</b>. Файл можно загрузить обратно с подписью <b>/import</b>",
+        parse_mode="HTML"
+    )
+
+class MessageEditor:
+    """Правит отправленное сообщение на месте не чаще раза в interval секунд.
+    
+    Telegram ограничивает частоту правок, поэтому промежуточные состояния
+    пропускаются, а последнее ждёт окончания интервала. text и reply_markup —
+    то, что сообщение показывает сейчас, если бот только что его отправил.
+    active() позволяет прекратить правки, если сообщение уже показывает другое
+    (например, другую страницу).
+    """
+    
+    def __init__(self, message, text=None, reply_markup=None, interval=EDIT_INTERVAL, active=None):
+        self.message = message
+        self.interval = interval
+        self.active = active
+        self.shown = (text, reply_markup)
+        # Чужое или давнее сообщение можно править сразу
+        self.last_edit = time.monotonic() if text is not None else 0.0
+    
+    def remaining(self):
+        """Сколько секунд осталось до следующей допустимой правки."""
+        return max(0.0, self.last_edit + self.interval - time.monotonic())
+    
+    def is_active(self):
+        return self.active is None or self.active()
+    
+    async def edit(self, text, reply_markup=None):
+        """Заменяет текст и кнопки сообщения, если они изменились, выждав интервал после прошлой правки."""
+        if (text, reply_markup) == self.shown:
+            return
+        await asyncio.sleep(self.remaining())
+        # Пока ждали интервал, сообщение могли перехватить
+        if not self.is_active():
+            return
+        try:
+            await self.message.edit_text(text, parse_mode="HTML", reply_markup=reply_markup,
+                                         disable_web_page_preview=True)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"Не удалось обновить сообщение: {e}")
+        except TelegramError as e:
+            # RetryAfter и сетевые ошибки: эту правку пропускаем, следующая принесёт актуальный текст
+            logger.warning(f"Не удалось обновить сообщение: {e}")
+        self.shown = (text, reply_markup)
+        self.last_edit = time.monotonic()
+
+async def edit_as_completed(editor, futures, on_result, render):
+    """Передаёт в on_result результаты future по адресам по мере готовности и перерисовывает сообщение.
+    
+    render() возвращает текст и кнопки. Готовые за интервал результаты попадают
+    в одну правку; последняя правка делается, когда готово всё. Если editor
+    перестал быть активным, правки прекращаются.
+    """
+    pending = {future: token_address for token_address, future in futures.items()}
+    dirty = False
+    while pending:
+        done, _ = await asyncio.wait(pending, timeout=editor.remaining() if dirty else None,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            on_result(pending.pop(future), future.result())
+            dirty = True
+        if not editor.is_active():
+            return
+        if dirty and (not pending or editor.remaining() == 0):
+            await editor.edit(*render())
+            dirty = False
+
+def render_token_fragment(token_address, data, result=None, stale=None, now=None):
+    """HTML-фрагмент одного токена для /list.
+    
+    result — ответ API или None, пока он не получен: тогда показывается последний
+    сэмпл из истории цен stale с отметкой о его возрасте либо признак загрузки.
+    """
+    dexscreener_url = f"https://dexscreener.com/solana/{token_address}"
+    fragment = (f"<b>{html.escape(data['name'])}</b> (<code>{html.escape(token_address)}</code>)\n"
+                f"Оповещение: <b>{data['percent']}%</b>\n")
+    if result is not None and "error" not in result:
+        price_change_24h = result["price_change_24h"]
+        if price_change_24h == "N/A":
+            fragment += "Изменение за 24ч: <b>N/A</b>\n"
         else:
-            price_change_24h = result["price_change_24h"]
             emoji_24h = "🟢" if price_change_24h > 0 else "🔴" if price_change_24h < 0 else ""
-            price = result["price"]
-            market_cap = result["market_cap"]
+            fragment += f"Изменение за 24ч: {emoji_24h} <b>{price_change_24h}%</b>\n"
+        fragment += (f"Цена: <b>{format_number(result['price'], is_price=True)}</b> | "
+                     f"Market Cap: <b>{format_number(result['market_cap'])}</b>\n")
+    elif result is not None:
+        fragment += "Изменение за 24ч: <b>N/A</b>\nЦена: <b>N/A</b> | Market Cap: <b>N/A</b>\n"
+    elif stale is not None:
+        minutes = max(1, int((now - stale["ts"]) // 60))
+        fragment += (f"Цена: <b>{format_number(stale['price'], is_price=True)}</b> | "
+                     f"Market Cap: <b>{format_number(stale['market_cap'])}</b>\n"
+                     f"🕓 <i>данные {minutes} мин назад, обновляются…</i>\n")
+    else:
+        fragment += "⏳ <i>загрузка…</i>\n"
+    return fragment + f"<a href='{dexscreener_url}'><i>Чарт на Dexscreener</i></a>"
+
+def render_list_page(fragments, page, pages):
+    """Текст страницы /list из готовых фрагментов и кнопки перехода между страницами."""
+    header = "📋 <b>Ваши отслеживаемые токены:</b>"
+    if pages == 1:
+        return header + "\n\n" + "\n\n".join(fragments), None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"list:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"list:{page + 1}"))
+    text = f"{header} (стр. {page + 1}/{pages})\n\n" + "\n\n".join(fragments)
+    return text, InlineKeyboardMarkup([buttons])
+
+# Какой показ страницы сейчас владеет сообщением /list: (чат, сообщение) -> метка показа
+list_views = {}
+
+async def show_token_list(application, chat_id, page, reply_to=None, message=None):
+    """Показывает страницу /list сразу по кэшу и истории цен, затем дописывает её по мере ответов API.
+    
+    Отвечает на reply_to новым сообщением или правит message (переход по кнопкам).
+    Дописывание идёт задачей application, чтобы обработчик сразу освободил очередь чата.
+    """
+    # Показ регистрируется до первой правки: если пользователь перелистнул страницу,
+    # старый показ перестаёт править сообщение
+    view = object()
+    key = None
+    
+    def active():
+        return list_views.get(key) is view
+    
+    def register(message):
+        nonlocal key
+        key = (chat_id, message.message_id)
+        list_views[key] = view
+    
+    def release():
+        if active():
+            del list_views[key]
+    
+    if message is not None:
+        register(message)
+    streaming = False
+    try:
+        tokens = dict(tracked_tokens.get(chat_id, {}))
+        if not tokens:
+            text = "📋 Ваш список токенов <b>пуст</b>"
+            if message is None:
+                await reply_to.reply_text(text, parse_mode="HTML")
+            else:
+                await MessageEditor(message, active=active).edit(text)
+            return
+        
+        pages = -(-len(tokens) // LIST_PAGE_SIZE)
+        page = min(max(page, 0), pages - 1)
+        page_tokens = list(tokens)[page * LIST_PAGE_SIZE:(page + 1) * LIST_PAGE_SIZE]
+        
+        now = time.time()
+        results, missing, refresh = get_cached_prices(page_tokens, now)
+        if refresh:
+            start_fetch(refresh)
+        stale = price_history.latest(missing)
+        fragments = {token: render_token_fragment(token, tokens[token], results.get(token), stale.get(token), now)
+                     for token in page_tokens}
+        
+        def render():
+            return render_list_page([fragments[token] for token in page_tokens], page, pages)
+        
+        text, reply_markup = render()
+        if message is None:
+            message = await reply_to.reply_text(text, parse_mode="HTML", reply_markup=reply_markup,
+                                                disable_web_page_preview=True)
+            register(message)
+            editor = MessageEditor(message, text, reply_markup, active=active)
+        else:
+            editor = MessageEditor(message, active=active)
+            await editor.edit(text, reply_markup)
+        if not missing:
+            return
+        
+        def on_result(token, result):
+            if "error" in result:
+                error_aggregator.record(result["error"], token)
+            fragments[token] = render_token_fragment(token, tokens[token], result)
         
-        dexscreener_url = f"https://dexscreener.com/solana/{token}"
-        response += (f"<b>{data['name']}</b> (<code>{token}</code>)\n"
-                     f"Оповещение: <b>{data['percent']}%</b>\n"
-                     f"Изменение за 24ч: {emoji_24h} <b>{price_change_24h}%</b>\n"
-                     f"Цена: <b>{format_number(price, is_price=True)}</b> | Market Cap: <b>{format_number(market_cap)}</b>\n"
-                     f"<a href='{dexscreener_url}'><i>Чарт на Dexscreener</i></a>\n\n")
-    await update.message.reply_text(response, parse_mode="HTML", disable_web_page_preview=True)
+        async def stream(futures):
+            try:
+                await edit_as_completed(editor, futures, on_result, render)
+            finally:
+                release()
+        
+        application.create_task(stream(start_fetch(missing)), name=f"list:{chat_id}")
+        streaming = True
+    finally:
+        # Если правки ушли в задачу, показ снимет с регистрации она
+        if not streaming:
+            release()
+
+async def list_tokens(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await show_token_list(context.application, update.effective_chat.id, 0, reply_to=update.message)
+
+async def list_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if not query.message.is_accessible:
+        return
+    await show_token_list(context.application, query.message.chat.id, int(query.data.split(":")[1]),
+                          message=query.message)
 
 async def check_prices(context: ContextTypes.DEFAULT_TYPE):
-    for chat_id in tracked_tokens:
-        for token_address, data in list(tracked_tokens[chat_id].items()):
-            result = get_token_price(token_address)
-            if "error" in result:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"❌ Ошибка для <b>{data['name']}</b> (<code>{token_address}</code>): <i>{result['error']}</i>",
-                    parse_mode="HTML"
-                )
-                if ADMIN_CHAT_ID and "Тайм-аут" in result["error"]:
-                    await context.bot.send_message(
-                        chat_id=ADMIN_CHAT_ID,
-                        text=f"⚠️ Тайм-аут при проверке токена <code>{token_address}</code>",
-                        parse_mode="HTML"
-                    )
+    # Пропускаем тик, если предыдущая проверка ещё не завершилась
+    if check_lock.locked():
+        metrics.inc("sweeps_skipped_total")
+        return
+    async with check_lock:
+        with metrics.timer("sweep_seconds"):
+            await run_price_check(context)
+
+async def run_price_check(context: ContextTypes.DEFAULT_TYPE):
+    # Проверяем только токены, которым по расписанию пора обновиться
+    started = time.time()
+    due = scheduler.due(started)
+    # Извлечённые из кучи токены планируются заново, даже если проверка упала:
+    # иначе их больше никто не опросит. Без цены и расстояния до порога
+    # берётся интервал по умолчанию
+    current_prices = {}
+    distances = {}
+    try:
+        if price_stream is not None:
+            due = price_stream.filter_due(due, started)
+        if not due:
+            return
+        
+        # Одним пакетом запрашиваем каждый такой токен один раз и раздаём результат его подписчикам.
+        # Кэш допускается только не старше минимального интервала, иначе проверка видела бы старые цены
+        prices = await async_fetch_token_prices(due, max_age=MIN_POLL_INTERVAL)
+        metrics.inc("tokens_checked_total", len(due))
+        if price_stream is not None:
+            # Пока шёл запрос, поток мог прислать более свежую цену, и пороги по ней уже проверены
+            prices = price_stream.drop_outdated(prices, started)
+        
+        notices = []
+        for token_address, result in prices.items():
+            if "error" not in result:
+                error_aggregator.clear(token_address)
                 continue
-            
-            current_price = result["price"]
-            current_market_cap = result["market_cap"]
-            last_price = data["last_price"]
-            percent_change = abs((current_price - last_price) / last_price * 100)
-            
-            if percent_change >= data["percent"]:
-                direction = "выросла" if current_price > last_price else "упала"
-                emoji = "🟢" if current_price > last_price else "🔴"
-                dexscreener_url = f"https://dexscreener.com/solana/{token_address}"
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"{emoji} Цена токена <b>{data['name']}</b> {direction} на <b>{percent_change:.2f}%</b>!\n"
-                         f"Цена: <b>{format_number(current_price, is_price=True)}</b>\n"
-                         f"Market Cap: <b>{format_number(current_market_cap)}</b>\n\n"
-                         f"<a href='{dexscreener_url}'><i>Чарт на Dexscreener</i></a>",
-                    parse_mode="HTML",
-                    disable_web_page_preview=True
-                )
-                tracked_tokens[chat_id][token_address]["last_price"] = current_price
-                tracked_tokens[chat_id][token_address]["last_market_cap"] = current_market_cap
-                save_tracked_tokens()
+            # Сбой учитывается один раз на токен, а не на каждого подписчика
+            error_aggregator.record(result["error"], token_address)
+            for chat_id in list(token_subscribers.get(token_address, ())):
+                # Название нужно только для уведомления, поэтому чат читается уже после проверки подавления.
+                # Подписка могла быть удалена, пока шёл запрос или отправка сообщений
+                if not error_aggregator.should_notify(chat_id, token_address):
+                    continue
+                data = tracked_tokens.get(chat_id, {}).get(token_address)
+                if data is None:
+                    continue
+                notices.append((
+                    chat_id,
+                    f"❌ Ошибка для <b>{html.escape(data['name'])}</b> (<code>{html.escape(token_address)}</code>): <i>{html.escape(result['error'])}</i>"
+                ))
+        
+        # Пороги всех подписок проверяются одним векторным проходом
+        current_prices = {token_address: result["price"] for token_address, result in prices.items() if "error" not in result}
+        alerts = build_alerts(prices, subscriptions.find_triggered(current_prices))
+        send_check_results(alerts, notices)
+        
+        # Планируем следующую проверку с учётом уже обновлённых после оповещений цен
+        distances = subscriptions.threshold_distances(current_prices)
+    finally:
+        now = time.time()
+        for token_address in due:
+            scheduler.observe(token_address, current_prices.get(token_address), now, distances.get(token_address))
 
-def main():
-    # Инициализация и загрузка данных из базы данных
+def build_alerts(prices, triggered):
+    """Тексты оповещений для сработавших подписок (chat_id, token_address, percent_change).
+    
+    Возвращает список (chat_id, token_address, текст, новая цена, новый Market Cap).
+    """
+    alerts = []
+    for chat_id, token_address, percent_change in triggered:
+        data = tracked_tokens.get(chat_id, {}).get(token_address)
+        if data is None:
+            continue
+        metrics.inc("alerts_fired_total")
+        result = prices[token_address]
+        current_price = result["price"]
+        current_market_cap = result["market_cap"]
+        last_price = data["last_price"]
+        direction = "выросла" if current_price > last_price else "упала"
+        emoji = "🟢" if current_price > last_price else "🔴"
+        dexscreener_url = f"https://dexscreener.com/solana/{token_address}"
+        alerts.append((
+            chat_id, token_address,
+            f"{emoji} Цена токена <b>{html.escape(data['name'])}</b> {direction} на <b>{percent_change:.2f}%</b>!\n"
+            f"Цена: <b>{format_number(current_price, is_price=True)}</b>\n"
+            f"Market Cap: <b>{format_number(current_market_cap)}</b>\n\n"
+            f"<a href='{dexscreener_url}'><i>Чарт на Dexscreener</i></a>",
+            current_price, current_market_cap
+        ))
+    return alerts
+
+def send_check_results(alerts, notices):
+    """Отправляет оповещения и уведомления о сбоях и переносит новые цены в подписки."""
+    # Проверяльщик не отправляет сообщения сам, а передаёт их процессу бота через alert_outbox
+    if checker_id is not None:
+        publish_to_outbox(alerts, notices)
+        return
+    for chat_id, text in notices:
+        dispatcher.send(chat_id, text, parse_mode="HTML")
+    for chat_id, token_address, text, current_price, current_market_cap in alerts:
+        dispatcher.add_alert(chat_id, text)
+        update_tracked_token(chat_id, token_address,
+                             last_price=current_price, last_market_cap=current_market_cap)
+    # Все оповещения чата за цикл уходят одним сообщением
+    dispatcher.flush_alerts()
+
+def parse_stream_price(item):
+    """Адрес и данные токена из сообщения потока; None, если адреса, цены или Market Cap нет."""
+    if not isinstance(item, dict) or not isinstance(item.get("token"), str):
+        return None
+    try:
+        price = float(item["price"])
+        market_cap = float(item["market_cap"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if price <= 0:
+        return None
+    price_change_24h = item.get("price_change_24h")
+    if not isinstance(price_change_24h, (int, float)):
+        price_change_24h = "N/A"
+    return item["token"], {"price": price, "market_cap": market_cap, "price_change_24h": price_change_24h}
+
+def apply_stream_prices(updates, now):
+    """Обрабатывает цены из потока: кэш, история и проверка порогов только у подписчиков этих токенов."""
+    triggered = []
+    for token_address, data in updates.items():
+        subscribers = token_subscribers.get(token_address)
+        if not subscribers:
+            continue
+        cache.put(token_address, data, now)
+        price_history.record(token_address, data, now)
+        error_aggregator.clear(token_address)
+        triggered.extend(subscriptions.triggered_for(token_address, data["price"], subscribers))
+    metrics.inc("stream_updates_total", len(updates))
+    if triggered:
+        send_check_results(build_alerts(updates, triggered), [])
+
+class PriceStream:
+    """Долгоживущая подписка на цены отслеживаемых токенов по WebSocket.
+    
+    wanted — адреса, на которые нужно быть подписанным; серверу отправляется
+    только разница с subscribed, так что добавление токена не переподписывает
+    остальные. Токены, по которым поток присылает цены, не опрашиваются через API.
+    После разрыва соединения они сразу возвращаются в опрос, а клиент
+    переподключается с растущей задержкой.
+    """
+    
+    def __init__(self, url):
+        self.url = url
+        self.wanted = set()
+        self.subscribed = set()
+        self.last_update = {}
+        self.connected = False
+        self.changed = asyncio.Event()
+        self.task = None
+    
+    def sync(self, token_addresses):
+        """Задаёт весь набор адресов подписки (при запуске и после перечитывания доли проверяльщика)."""
+        self.wanted = set(token_addresses)
+        for token_address in list(self.last_update):
+            if token_address not in self.wanted:
+                del self.last_update[token_address]
+        self.changed.set()
+    
+    def track(self, token_address):
+        self.wanted.add(token_address)
+        self.changed.set()
+    
+    def untrack(self, token_address):
+        self.wanted.discard(token_address)
+        self.last_update.pop(token_address, None)
+        self.changed.set()
+    
+    def filter_due(self, due, now):
+        """Убирает из due токены, по которым поток недавно присылал цену, и переносит их проверку."""
+        if not self.connected:
+            return due
+        polled = []
+        for token_address in due:
+            last_update = self.last_update.get(token_address)
+            if last_update is not None and now - last_update < STREAM_STALE_AFTER:
+                scheduler.schedule(token_address, last_update + STREAM_STALE_AFTER)
+            else:
+                polled.append(token_address)
+        return polled
+    
+    def drop_outdated(self, prices, started):
+        """Убирает результаты опроса, начатого в started, если поток с тех пор прислал цену токена."""
+        return {token_address: result for token_address, result in prices.items()
+                if self.last_update.get(token_address, 0) < started}
+    
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+    
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+    
+    async def run(self):
+        delay = STREAM_RECONNECT_DELAY
+        while True:
+            try:
+                async with websockets.connect(self.url) as connection:
+                    logger.info("Потоковый источник цен подключён")
+                    self.connected = True
+                    delay = STREAM_RECONNECT_DELAY
+                    sender = asyncio.create_task(self.send_changes(connection))
+                    try:
+                        async for message in connection:
+                            self.handle(message)
+                    except asyncio.CancelledError:
+                        # Останавливаемся: закрываем соединение штатно, а не с кодом ошибки
+                        await connection.close()
+                        raise
+                    finally:
+                        sender.cancel()
+            except Exception as e:
+                logger.warning(f"Потоковый источник цен недоступен: {e}")
+            finally:
+                if self.connected:
+                    self.disconnected()
+            logger.warning(f"Токены проверяются опросом, переподключение к потоку цен через {delay} с")
+            metrics.inc("stream_reconnects_total")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, STREAM_MAX_RECONNECT_DELAY)
+    
+    async def send_changes(self, connection):
+        """Отправляет серверу подписки и отписки по разнице между wanted и subscribed."""
+        try:
+            while True:
+                self.changed.clear()
+                added = list(self.wanted - self.subscribed)
+                removed = list(self.subscribed - self.wanted)
+                for op, token_addresses in (("unsubscribe", removed), ("subscribe", added)):
+                    for i in range(0, len(token_addresses), STREAM_SUBSCRIBE_BATCH):
+                        batch = token_addresses[i:i + STREAM_SUBSCRIBE_BATCH]
+                        await connection.send(json.dumps({"op": op, "tokens": batch}))
+                self.subscribed.difference_update(removed)
+                self.subscribed.update(added)
+                await self.changed.wait()
+        except websockets.ConnectionClosed:
+            pass
+    
+    def handle(self, message):
+        """Разбирает сообщение сервера и проверяет пороги по пришедшим ценам."""
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            logger.warning("Потоковый источник цен прислал не JSON")
+            return
+        items = payload.get("prices", [payload]) if isinstance(payload, dict) else payload
+        updates = {}
+        for item in items if isinstance(items, list) else ():
+            parsed = parse_stream_price(item)
+            if parsed is not None:
+                updates[parsed[0]] = parsed[1]
+        if not updates:
+            return
+        now = time.time()
+        for token_address in updates:
+            if token_address in self.wanted:
+                self.last_update[token_address] = now
+        apply_stream_prices(updates, now)
+    
+    def disconnected(self):
+        """Возвращает в опрос токены, которые покрывал поток: без него их цены никто не обновит."""
+        self.connected = False
+        self.subscribed = set()
+        now = time.time()
+        for token_address in self.last_update:
+            if token_address in scheduler.next_check:
+                scheduler.schedule(token_address, now)
+        self.last_update.clear()
+
+def open_price_stream():
+    """Подключается к потоковому источнику цен, если он задан, и подписывается на отслеживаемые токены."""
+    global price_stream
+    if not PRICE_STREAM_URL:
+        return
+    price_stream = PriceStream(PRICE_STREAM_URL)
+    price_stream.sync(token_subscribers)
+    price_stream.start()
+
+def hash_key(value):
+    """Стабильный между процессами 64-битный хэш строки (встроенный hash() рандомизирован)."""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    """Консистентное хэширование адресов токенов по проверяльщикам.
+    
+    Каждый проверяльщик занимает replicas точек на кольце; токен принадлежит первому
+    проверяльщику по часовой стрелке от своего хэша. При появлении или уходе одного
+    проверяльщика хозяина меняет лишь примерно 1/N токенов.
+    """
+    
+    def __init__(self, workers, replicas=HASH_RING_REPLICAS):
+        self.workers = tuple(sorted(workers))
+        points = sorted((hash_key(f"{worker}#{i}"), worker) for worker in self.workers for i in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [worker for _, worker in points]
+    
+    def owner(self, token_address):
+        index = bisect.bisect(self.hashes, hash_key(token_address)) % len(self.hashes)
+        return self.owners[index]
+
+def checker_heartbeat(now):
+    """Отмечает текущего проверяльщика живым и возвращает ID всех живых проверяльщиков."""
+    conn = get_db()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO checker_workers (worker_id, heartbeat) VALUES (?, ?)", (checker_id, now))
+        # Давно выбывшие записи больше не нужны
+        conn.execute("DELETE FROM checker_workers WHERE heartbeat < ?", (now - 10 * WORKER_HEARTBEAT_TTL,))
+    rows = conn.execute("SELECT worker_id FROM checker_workers WHERE heartbeat >= ?", (now - WORKER_HEARTBEAT_TTL,))
+    return {worker_id for worker_id, in rows}
+
+def load_shard(ring):
+    """Перечитывает из базы подписки на токены, которыми по кольцу владеет этот проверяльщик."""
+    global tracked_tokens, token_subscribers, subscriptions, shard_owners, shard_workers
+    known = shard_owners if ring.workers == shard_workers else {}
+    owned = {}
+    shard = {}
+    token_subscribers = {}
+    subscriptions = SubscriptionStore()
+    cursor = get_db().execute(
+        "SELECT chat_id, token_address, last_price, percent, last_market_cap, name FROM tracked_tokens"
+    )
+    # Как и при старте бота, строки читаются пачками, а колонки подписок заполняются срезами.
+    # Сборщик мусора на время чтения отключается: циклов новые объекты не образуют
+    gc.disable()
+    try:
+        while True:
+            rows = cursor.fetchmany(INDEX_LOAD_BATCH)
+            if not rows:
+                break
+            batch = []
+            for row in rows:
+                chat_id, token_address, last_price, percent, last_market_cap, name = row
+                is_owned = owned.get(token_address)
+                if is_owned is None:
+                    is_owned = known.get(token_address)
+                    if is_owned is None:
+                        is_owned = ring.owner(token_address) == checker_id
+                    owned[token_address] = is_owned
+                if not is_owned:
+                    continue
+                shard.setdefault(chat_id, {})[token_address] = {
+                    "last_price": last_price, "percent": percent, "last_market_cap": last_market_cap, "name": name
+                }
+                token_subscribers.setdefault(token_address, set()).add(chat_id)
+                batch.append(row[:5])
+            subscriptions.extend(batch)
+    finally:
+        gc.enable()
+    tracked_tokens = ChatTokenStore(shard)
+    # Удалённые токены выпадают из кэша принадлежности вместе со старой долей
+    shard_owners, shard_workers = owned, ring.workers
+    # Расписание и оценки волатильности оставшихся токенов сохраняются между перечитываниями
+    for token_address in list(scheduler.next_check):
+        if token_address not in token_subscribers:
+            scheduler.remove(token_address)
+    for token_address in token_subscribers:
+        scheduler.add(token_address)
+
+def publish_to_outbox(alerts, notices):
+    """Записывает сообщения проверяльщика в alert_outbox одной транзакцией.
+    
+    Новая цена подписки сохраняется условным UPDATE: он проходит, только если в базе всё ещё
+    та цена, от которой считалось изменение. Поэтому, когда токен на время перестроения
+    кольца проверяют два проверяльщика, оповещение записывает только первый из них.
+    """
+    if not alerts and not notices:
+        return
+    conn = get_db()
+    stale = []
+    published = []
+    with conn:
+        for chat_id, text in notices:
+            conn.execute("INSERT INTO alert_outbox (chat_id, text, priority) VALUES (?, ?, ?)",
+                         (chat_id, text, PRIORITY_NOTICE))
+        for chat_id, token_address, text, current_price, current_market_cap in alerts:
+            data = tracked_tokens[chat_id][token_address]
+            updated = conn.execute(
+                "UPDATE tracked_tokens SET last_price = ?, last_market_cap = ?, timestamp = ? "
+                "WHERE chat_id = ? AND token_address = ? AND last_price IS ?",
+                (current_price, current_market_cap, time.time(), chat_id, token_address, data["last_price"])
+            ).rowcount
+            if not updated:
+                stale.append((chat_id, token_address))
+                continue
+            conn.execute(
+                "INSERT INTO alert_outbox (chat_id, token_address, text, priority, last_price, last_market_cap) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, token_address, text, PRIORITY_ALERT, current_price, current_market_cap)
+            )
+            published.append((chat_id, token_address, current_price, current_market_cap))
+    # Новые цены переносятся в память только после фиксации транзакции: если она откатилась,
+    # память должна совпадать с базой
+    for chat_id, token_address, current_price, current_market_cap in published:
+        apply_checker_alert(chat_id, token_address, current_price, current_market_cap)
+    # Подписку уже изменил другой проверяльщик или пользователь: берём из базы актуальные значения
+    for chat_id, token_address in stale:
+        metrics.inc("alerts_deduplicated_total")
+        row = conn.execute("SELECT last_price, last_market_cap FROM tracked_tokens WHERE chat_id = ? AND token_address = ?",
+                           (chat_id, token_address)).fetchone()
+        if row is None:
+            remove_shard_token(chat_id, token_address)
+        else:
+            apply_checker_alert(chat_id, token_address, *row)
+
+def remove_shard_token(chat_id, token_address):
+    """Убирает из доли проверяльщика подписку, удалённую в процессе бота."""
+    tracked_tokens.get(chat_id, {}).pop(token_address, None)
+    subscribers = token_subscribers.get(token_address)
+    if subscribers is not None:
+        subscribers.discard(chat_id)
+        if not subscribers:
+            del token_subscribers[token_address]
+            scheduler.remove(token_address)
+            if price_stream is not None:
+                price_stream.untrack(token_address)
+    subscriptions.remove(chat_id, token_address)
+
+async def deliver_outbox(context: ContextTypes.DEFAULT_TYPE):
+    """Рассылает сообщения, записанные проверяльщиками в alert_outbox.
+    
+    Строки удаляются из таблицы тем же запросом, которым забираются, ещё до отправки:
+    если бот перезапустится, уже переданное в рассылку сообщение не уйдёт второй раз.
+    """
+    with get_db() as conn:
+        rows = conn.execute(
+            "DELETE FROM alert_outbox WHERE id IN (SELECT id FROM alert_outbox ORDER BY id LIMIT ?) "
+            "RETURNING id, chat_id, token_address, text, priority, last_price, last_market_cap",
+            (OUTBOX_BATCH_SIZE,)
+        ).fetchall()
+    if not rows:
+        return
+    # RETURNING не гарантирует порядок строк
+    rows.sort()
+    for _, chat_id, token_address, text, priority, last_price, last_market_cap in rows:
+        if token_address is None:
+            dispatcher.send(chat_id, text, priority, parse_mode="HTML")
+        else:
+            dispatcher.add_alert(chat_id, text)
+            apply_checker_alert(chat_id, token_address, last_price, last_market_cap)
+    dispatcher.flush_alerts()
+
+async def run_checker():
+    """Цикл проверяльщика: отметка в checker_workers, перечитывание своей доли и проверка цен по расписанию."""
+    global checker_id, scheduler
+    checker_id = WORKER_ID
     init_db()
-    global tracked_tokens, cache
-    tracked_tokens = load_tracked_tokens()
-    cache = load_cache()
+    scheduler = PollScheduler()
+    state_writer.start()
+    open_http_client()
+    open_price_stream()
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
     
-    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    if not bot_token:
-        raise ValueError("TELEGRAM_BOT_TOKEN не задан в переменных окружения")
+    workers = None
+    last_reload = 0
+    last_summary = time.time()
+    logger.info(f"Проверяльщик {checker_id} запущен")
+    try:
+        while not stopping.is_set():
+            try:
+                now = time.time()
+                live = checker_heartbeat(now)
+                # Состав проверяльщиков изменился — перестраиваем кольцо сразу, не дожидаясь планового перечитывания
+                if live != workers or now - last_reload >= SHARD_RELOAD_INTERVAL:
+                    if live != workers:
+                        logger.info(f"Проверяльщики: {', '.join(sorted(live))}")
+                    load_shard(HashRing(live))
+                    if price_stream is not None:
+                        price_stream.sync(token_subscribers)
+                    workers = live
+                    last_reload = now
+                async with check_lock:
+                    with metrics.timer("sweep_seconds"):
+                        await run_price_check(None)
+                if now - last_summary >= ERROR_SUMMARY_WINDOW:
+                    text = error_aggregator.summary()
+                    if ADMIN_CHAT_ID and text:
+                        publish_to_outbox([], [(ADMIN_CHAT_ID, f"<b>{checker_id}</b>\n{text}")])
+                    last_summary = now
+            except sqlite3.OperationalError as e:
+                # База временно недоступна (например, «database is locked» под нагрузкой записи):
+                # пропускаем тик, следующий повторит всё с начала
+                metrics.inc("checker_db_errors_total")
+                logger.warning(f"Ошибка базы данных в проверяльщике, повтор на следующем тике: {e}")
+            try:
+                await asyncio.wait_for(stopping.wait(), SCHEDULER_TICK)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        # Уходим из кольца сразу, чтобы остальные забрали нашу долю на следующем тике
+        with get_db() as conn:
+            conn.execute("DELETE FROM checker_workers WHERE worker_id = ?", (checker_id,))
+        if price_stream is not None:
+            await price_stream.stop()
+        await http_client.aclose()
+        state_writer.stop()
+        close_db()
+        logger.info(f"Проверяльщик {checker_id} остановлен")
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает несколько обновлений одновременно, но обновления одного чата — строго по очереди.
+    
+    ConversationHandler рассчитывает на последовательную обработку: иначе следующий ответ
+    в диалоге мог бы обработаться раньше, чем закончился предыдущий шаг.
     
-    application = Application.builder().token(bot_token).build()
+    Базовый класс держит слот своего семафора всё время do_process_update, в том числе
+    пока обновление ждёт очереди своего чата: очередь одного чата заняла бы все слоты.
+    Поэтому его предел снят, а слот workers занимается только тогда, когда подошла очередь чата.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(sys.maxsize)
+        self.workers = asyncio.Semaphore(max_concurrent_updates)
+        # chat_id -> [блокировка, число обновлений чата в обработке или в ожидании]
+        self.chat_locks = {}
+    
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            async with self.workers:
+                await coroutine
+            return
+        entry = self.chat_locks.get(chat.id)
+        if entry is None:
+            entry = self.chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self.workers:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chat_locks[chat.id]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+def collect_gauges():
+    """Текущие размеры очередей и структур в памяти для метрик."""
+    return {
+        "subscriptions": len(subscriptions) if subscriptions is not None else 0,
+        "chats_in_memory": len(tracked_tokens),
+        "tracked_tokens": len(token_subscribers),
+        "inflight_lookups": len(inflight),
+        "write_queue_depth": len(state_writer.pending),
+        "send_queue_depth": len(dispatcher.heap) + len(dispatcher.deferred) if dispatcher is not None else 0,
+        "cache_size": len(cache),
+        "stream_connected": int(price_stream is not None and price_stream.connected),
+    }
+
+async def serve_metrics(reader, writer):
+    """Отдаёт метрики в формате Prometheus на любой HTTP-запрос."""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+        pass
+    body = metrics.render(collect_gauges()).encode()
+    writer.write(
+        b"HTTP/1.1 200 OK\r\n"
+        b"Content-Type: text/plain; version=0.0.4\r\n"
+        b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+        b"Connection: close\r\n\r\n" + body
+    )
+    try:
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /metrics — сводка метрик, доступна только администратору."""
+    if not ADMIN_CHAT_ID or str(update.effective_chat.id) != str(ADMIN_CHAT_ID):
+        return
+    if not metrics.enabled:
+        await update.message.reply_text(
+            "📈 Сбор метрик выключен. Задайте переменную окружения <b>METRICS_ENABLED=1</b>.",
+            parse_mode="HTML"
+        )
+        return
+    await update.message.reply_text(metrics.summary(collect_gauges()), parse_mode="HTML")
+
+def open_http_client():
+    """Создаёт общий HTTP-клиент с пулом keep-alive соединений и семафор запросов."""
+    global http_client, request_semaphore
+    http_client = httpx.AsyncClient(
+        timeout=REQUEST_DEADLINE,
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_POOL_SIZE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+async def post_init(application: Application):
+    """Создаёт HTTP-клиент и очередь сообщений внутри цикла событий приложения."""
+    global dispatcher, metrics_server
+    open_http_client()
+    dispatcher = MessageDispatcher(application.bot)
+    dispatcher.start()
+    # При выделенных проверяльщиках поток цен нужен им, а не процессу бота
+    if not SHARDED_CHECKERS:
+        open_price_stream()
+    if metrics.enabled:
+        metrics_server = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+
+async def post_stop(application: Application):
+    """Досылает накопленные сообщения, пока бот ещё может отправлять запросы."""
+    if price_stream is not None:
+        await price_stream.stop()
+    if dispatcher is not None:
+        await dispatcher.stop()
+
+async def post_shutdown(application: Application):
+    """Закрывает общий HTTP-клиент и сервер метрик."""
+    if http_client is not None:
+        await http_client.aclose()
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+def build_application(builder):
+    """Собирает приложение из подготовленного builder: обработчики команд и периодические задачи."""
+    application = (
+        builder
+        .concurrent_updates(ChatUpdateProcessor(UPDATE_WORKERS))
+        .persistence(conversations)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Обработчик для добавления токенов
     add_handler = ConversationHandler(
@@ -547,7 +3236,10 @@ def main():
             NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_token_name)],
             PERCENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_token_percent)],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name=ADD_CONVERSATION,
+        persistent=True
     )
     
     # Обработчик для редактирования процентов
@@ -556,7 +3248,10 @@ def main():
         states={
             EDIT_PERCENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, edit_token_percent)],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
+        name=EDIT_CONVERSATION,
+        persistent=True
     )
     
     application.add_handler(add_handler)
@@ -564,16 +3259,84 @@ def main():
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("remove", remove_token))
     application.add_handler(CommandHandler("list", list_tokens))
+    application.add_handler(CallbackQueryHandler(list_page, pattern=r"^list:\d+$"))
     application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(CommandHandler("import", import_tokens))
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import(@\w+)?(\s|$)"), import_tokens))
+    application.add_handler(CommandHandler("export", export_tokens))
+    application.add_handler(CommandHandler("metrics", metrics_command))
     
-    application.job_queue.run_repeating(check_prices, interval=60, first=10)
+    if SHARDED_CHECKERS:
+        application.job_queue.run_repeating(deliver_outbox, interval=OUTBOX_POLL_INTERVAL, first=1)
+    else:
+        application.job_queue.run_repeating(check_prices, interval=SCHEDULER_TICK, first=10)
+    application.job_queue.run_repeating(compact_price_history, interval=HISTORY_COMPACT_INTERVAL, first=HISTORY_COMPACT_INTERVAL)
+    application.job_queue.run_repeating(purge_cache, interval=CACHE_PURGE_INTERVAL, first=CACHE_PURGE_INTERVAL)
+    application.job_queue.run_repeating(expire_conversations, interval=CONVERSATION_TIMEOUT, first=CONVERSATION_TIMEOUT)
+    application.job_queue.run_repeating(send_error_summary, interval=ERROR_SUMMARY_WINDOW, first=ERROR_SUMMARY_WINDOW)
+    if LAZY_CHAT_LOADING:
+        application.job_queue.run_repeating(evict_idle_chats, interval=CHAT_EVICT_INTERVAL, first=CHAT_EVICT_INTERVAL)
+    return application
+
+def load_state():
+    """Загружает из базы состояние, нужное до приёма обновлений: подписки, расписание проверки и диалоги."""
+    global tracked_tokens, token_subscribers, subscriptions, scheduler
+    # Загрузка создаёт сотни тысяч долгоживущих объектов без циклов: сборщик мусора на это время
+    # отключается, а загруженное переносится в постоянное поколение, чтобы сборки его больше не обходили
+    gc.disable()
+    try:
+        if LAZY_CHAT_LOADING:
+            # Проверке цен хватает индекса подписок, а чаты читаются при первом обращении
+            tracked_tokens = ChatTokenStore(lazy=True)
+            token_subscribers, subscriptions = load_subscription_index()
+        else:
+            chats = load_tracked_tokens()
+            tracked_tokens = ChatTokenStore(chats)
+            token_subscribers = build_token_subscribers(chats)
+            subscriptions = build_subscription_store(chats)
+        scheduler = build_scheduler(token_subscribers, time.time() + 10)
+        conversations.load()
+    finally:
+        gc.enable()
+    gc.freeze()
+
+def main():
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s", level=LOG_LEVEL)
+    # httpx пишет в INFO каждый запрос к API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    # `python bot.py checker` запускает проверяльщика цен без Telegram
+    if sys.argv[1:] == ["checker"]:
+        asyncio.run(run_checker())
+        return
+    
+    # Инициализация и загрузка данных из базы данных
+    init_db()
+    load_state()
+    state_writer.start()
     
-    # Сохраняем данные при завершении работы
+    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not bot_token:
+        raise ValueError("TELEGRAM_BOT_TOKEN не задан в переменных окружения")
+    
+    application = build_application(Application.builder().token(bot_token))
+    
+    # Сохраняем данные при завершении работы. Оба режима по SIGTERM перестают принимать обновления,
+    # дожидаются начатых обработчиков и досылают очередь сообщений, после чего сбрасывается очередь записи
     try:
-        application.run_polling()
+        if WEBHOOK_URL:
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            application.run_polling()
     finally:
-        save_tracked_tokens()
-        save_cache()
+        state_writer.stop()
+        close_db()
 
 if __name__ == "__main__":
     main()